@@ -0,0 +1,189 @@
+// Service worker che mantiene una porta persistente verso l'app nativa.
+// Il processo Python resta attivo finché la porta è aperta: ogni bookmark
+// evita così l'avvio dell'interprete e l'import di pypdf.
+//
+// Le modifiche ai PDF vengono inviate come job asincroni: l'app risponde subito
+// con un job_id, poi invia messaggi "progress" e un messaggio finale "done" o
+// "error". I risultati restano qui anche se il popup viene chiuso nel frattempo.
+// I singoli bookmark vengono invece accorpati: l'app li registra in un journal,
+// conferma subito e li salva tutti insieme dopo qualche secondo di inattività
+// (messaggio "flushed").
+//
+// I messaggi oltre il limite di 1 MB per frame viaggiano a blocchi in entrambe
+// le direzioni (vedi native_app/chunked_messages.py): il testo JSON viene diviso
+// in messaggi {"type": "chunk", "stream", "seq", "data", "final"} e ricomposto
+// all'arrivo dell'ultimo blocco.
+
+const NATIVE_HOST = 'com.guido.bookmarker';
+const ASYNC_ACTIONS = ["add_bookmarks"];
+const COALESCE_ACTIONS = ["add_bookmark"];
+const MAX_RECENT_RESULTS = 20;
+// Limite dell'host per un singolo frame in ingresso
+const MAX_FRAME_BYTES = 1024 * 1024;
+// Caratteri per blocco: anche con escape \u00XX (6 byte per carattere) il frame resta sotto il limite
+const CHUNK_CHARS = 128 * 1024;
+
+let port = null;
+let nextRequestId = 1;
+const pending = new Map(); // request_id -> sendResponse
+const recentResults = [];  // ultimi risultati dei job, il più recente in fondo
+const incomingStreams = new Map(); // stream -> { parts, nextSeq }
+const outgoingStreams = new Map(); // stream -> request_id, per riportare gli errori di ricomposizione
+let nextStreamId = 1;
+
+function notifyPopup(message) {
+    // Il popup potrebbe essere chiuso: in quel caso nessuno riceve il messaggio
+    chrome.runtime.sendMessage(message).catch(() => {});
+}
+
+// Accoda un blocco; restituisce il messaggio ricomposto all'ultimo blocco, altrimenti null
+function assembleChunk(chunk) {
+    let stream = incomingStreams.get(chunk.stream);
+    if (!stream) {
+        if (chunk.seq !== 0) {
+            console.warn("Blocco senza l'inizio dello stream, scartato:", chunk.stream, chunk.seq);
+            return null;
+        }
+        stream = { parts: [], nextSeq: 0 };
+        incomingStreams.set(chunk.stream, stream);
+    }
+    if (chunk.seq !== stream.nextSeq) {
+        console.warn("Blocco fuori sequenza, stream scartato:", chunk.stream, chunk.seq);
+        incomingStreams.delete(chunk.stream);
+        return null;
+    }
+    stream.parts.push(chunk.data);
+    stream.nextSeq++;
+    if (!chunk.final) {
+        return null;
+    }
+    incomingStreams.delete(chunk.stream);
+    return JSON.parse(stream.parts.join(""));
+}
+
+// Invia il messaggio in un frame solo se sta nel limite, altrimenti a blocchi
+function postToNative(message) {
+    const text = JSON.stringify(message);
+    if (text.length * 3 <= MAX_FRAME_BYTES || new TextEncoder().encode(text).length <= MAX_FRAME_BYTES) {
+        port.postMessage(message);
+        return;
+    }
+    const stream = "e" + nextStreamId++;
+    outgoingStreams.set(stream, message.request_id);
+    for (let seq = 0, start = 0; start < text.length; seq++) {
+        let end = Math.min(start + CHUNK_CHARS, text.length);
+        // Una coppia surrogata non va divisa tra due blocchi
+        const code = text.charCodeAt(end - 1);
+        if (end < text.length && code >= 0xD800 && code <= 0xDBFF) {
+            end--;
+        }
+        const chunk = { type: "chunk", stream: stream, seq: seq, data: text.slice(start, end) };
+        if (end === text.length) {
+            chunk.final = true;
+        }
+        port.postMessage(chunk);
+        start = end;
+    }
+}
+
+function handleNativeMessage(response) {
+    if (response.type === "chunk") {
+        let message;
+        try {
+            message = assembleChunk(response);
+        } catch (e) {
+            console.error("Messaggio a blocchi non valido:", e);
+            return;
+        }
+        if (message !== null) {
+            handleNativeMessage(message);
+        }
+        return;
+    }
+    if (response.stream !== undefined && response.request_id === undefined && outgoingStreams.has(response.stream)) {
+        // L'host ha scartato un nostro messaggio a blocchi: l'errore va alla richiesta originale
+        response.request_id = outgoingStreams.get(response.stream);
+    }
+    if (response.request_id !== undefined) {
+        for (const [stream, requestId] of outgoingStreams) {
+            if (requestId === response.request_id) {
+                outgoingStreams.delete(stream);
+            }
+        }
+    }
+    if (response.type === "progress") {
+        notifyPopup({ type: "job_progress", progress: response });
+        return;
+    }
+    if (response.type === "flushed") {
+        recentResults.push({ ...response, finished_at: Date.now() });
+        if (recentResults.length > MAX_RECENT_RESULTS) {
+            recentResults.shift();
+        }
+        notifyPopup({ type: "job_progress", progress: { stage: "flushed", status: response.status, message: response.message } });
+        return;
+    }
+    if (response.type === "done" || response.type === "error") {
+        recentResults.push({ ...response, finished_at: Date.now() });
+        if (recentResults.length > MAX_RECENT_RESULTS) {
+            recentResults.shift();
+        }
+    }
+    if (response.status === "accepted") {
+        // Il job è in coda: la risposta definitiva arriverà con lo stesso request_id
+        notifyPopup({ type: "job_progress", progress: { job_id: response.job_id, stage: "queued" } });
+        return;
+    }
+    const callback = pending.get(response.request_id);
+    if (callback) {
+        pending.delete(response.request_id);
+        callback(response);
+    } else {
+        console.warn("Risposta senza richiesta associata:", response);
+    }
+}
+
+function connect() {
+    port = chrome.runtime.connectNative(NATIVE_HOST);
+
+    port.onMessage.addListener(handleNativeMessage);
+
+    port.onDisconnect.addListener(() => {
+        const reason = chrome.runtime.lastError ? chrome.runtime.lastError.message : "porta chiusa";
+        console.error("Disconnessione app nativa:", reason);
+        port = null;
+        // Le richieste in sospeso non riceveranno più risposta
+        for (const callback of pending.values()) {
+            callback({ status: "error", message: "Connessione all'app nativa persa: " + reason });
+        }
+        pending.clear();
+        incomingStreams.clear();
+        outgoingStreams.clear();
+    });
+}
+
+function sendToNative(message, sendResponse) {
+    if (!port) {
+        connect();
+    }
+    const requestId = nextRequestId++;
+    pending.set(requestId, sendResponse);
+    postToNative({
+        ...message,
+        request_id: requestId,
+        async: ASYNC_ACTIONS.includes(message.action),
+        coalesce: COALESCE_ACTIONS.includes(message.action)
+    });
+}
+
+chrome.runtime.onMessage.addListener((request, sender, sendResponse) => {
+    if (request.type === "native") {
+        sendToNative(request.message, sendResponse);
+        return true; // risposta asincrona
+    }
+    if (request.type === "recent_results") {
+        sendResponse(recentResults);
+        return false;
+    }
+    return false;
+});
@@ -1,3 +1,42 @@
+// Avanzamento dei job in corso (inviato dal service worker)
+chrome.runtime.onMessage.addListener((request) => {
+    if (request.type !== "job_progress") {
+        return;
+    }
+    const progress = request.progress;
+    const messageDiv = document.getElementById("message");
+    let text = "In corso...";
+    let color = "gray";
+    if (progress.stage === "cloning") {
+        text = `Copia pagine: ${progress.pages_cloned}/${progress.total_pages}`;
+    } else if (progress.stage === "writing") {
+        text = `Scrittura: ${Math.round(progress.bytes_written / 1024)} KB`;
+    } else if (progress.stage === "queued") {
+        text = "In coda...";
+    } else if (progress.stage === "flushed") {
+        if (progress.status === "success") {
+            text = "Salvato: " + progress.message;
+            color = "green";
+        } else {
+            text = "Errore nel salvataggio: " + progress.message;
+            color = "red";
+        }
+    }
+    messageDiv.style.color = color;
+    messageDiv.textContent = text;
+});
+
+// All'apertura mostra l'esito dell'ultima modifica, anche se il popup era stato chiuso
+chrome.runtime.sendMessage({ type: "recent_results" }, function (results) {
+    if (chrome.runtime.lastError || !results || results.length === 0) {
+        return;
+    }
+    const last = results[results.length - 1];
+    const messageDiv = document.getElementById("message");
+    messageDiv.style.color = last.status === "success" ? "green" : "red";
+    messageDiv.textContent = "Ultima modifica: " + last.message;
+});
+
 document.getElementById("send-button").addEventListener("click", () => {
     const messageDiv = document.getElementById("message");
 
@@ -30,7 +69,8 @@ document.getElementById("send-button").addEventListener("click", () => {
 
         console.log("Invio messaggio:", JSON.stringify(message));
 
-        chrome.runtime.sendNativeMessage('com.guido.bookmarker', message, function (response) {
+        // Il service worker inoltra il messaggio sulla porta persistente verso l'app nativa
+        chrome.runtime.sendMessage({ type: "native", message: message }, function (response) {
             if (chrome.runtime.lastError) {
                 console.error("Errore Native Messaging:", chrome.runtime.lastError.message);
                 messageDiv.style.color = "red";
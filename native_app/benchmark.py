@@ -0,0 +1,467 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark riproducibile dell'host nativo su un corpus di PDF sintetici.
+
+Genera localmente PDF da 10 a 10.000 pagine con outline da 0 a 20.000 voci,
+piatti o profondamente annidati, e pilota native_app.py esattamente come fa il
+browser: processo figlio con messaggi JSON preceduti dalla lunghezza a 4 byte
+su stdin/stdout. Per `add_bookmark` e `add_bookmarks` misura:
+
+- latenza "cold" (avvio di un nuovo host per ogni richiesta, come sendNativeMessage)
+- latenza "warm" (stesso host per tutte le richieste, come connectNative)
+- picco di memoria residente (RSS) dell'host
+- byte scritti su disco e throughput
+- tempo di avvio dell'host fino alla prima risposta
+
+Con --daemon il browser viene simulato lanciando native_host.py, il client
+leggero che inoltra i messaggi al daemon condiviso (avviato alla prima richiesta).
+
+I risultati vengono scritti in JSON (con commit, versioni e piattaforma) per
+confrontare le prestazioni tra commit diversi:
+
+    python benchmark.py --quick
+    python benchmark.py --output dopo.json --compare prima.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import struct
+import argparse
+import signal
+import platform
+import tempfile
+import subprocess
+
+from pypdf import PdfWriter, __version__ as pypdf_version
+from pypdf.generic import NameObject, StreamObject
+
+import host_daemon
+from chunked_messages import ChunkAssembler, encode_frames
+
+HOST_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "native_app.py")
+SHIM_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "native_host.py")
+
+# Matrice completa e ridotta (--quick)
+PAGE_COUNTS = (10, 1000, 10000)
+OUTLINE_SIZES = (0, 2000, 20000)
+QUICK_PAGE_COUNTS = (10, 1000)
+QUICK_OUTLINE_SIZES = (0, 200)
+SHAPES = ("flat", "nested")
+ACTIONS = ("add_bookmark", "add_bookmarks", "get_outline")
+
+# Profondità delle catene negli outline annidati
+NESTED_DEPTH = 64
+# Byte di contenuto grafico per pagina, così la dimensione del file cresce con le pagine
+PAGE_CONTENT_BYTES = 1024
+# Bookmark per messaggio nelle richieste add_bookmarks
+BATCH_SIZE = 50
+# Avvii dell'host misurati per il tempo alla prima risposta
+STARTUP_RUNS = 10
+# Inattività dopo cui termina il daemon lanciato dal benchmark (secondi)
+BENCHMARK_DAEMON_IDLE = 30
+# Rallentamento (rapporto sul p50 warm) oltre il quale --compare segnala una regressione
+REGRESSION_THRESHOLD = 1.10
+
+
+# --- Corpus sintetico ---
+
+def _page_content(rng, size):
+    """Rettangoli pieni a coordinate casuali: contenuto valido e poco comprimibile."""
+    ops = []
+    length = 0
+    while length < size:
+        op = f"{rng.randint(0, 600)} {rng.randint(0, 780)} {rng.randint(1, 50)} {rng.randint(1, 50)} re f\n"
+        ops.append(op)
+        length += len(op)
+    return "".join(ops).encode("ascii")
+
+
+def generate_pdf(path, pages, outline_nodes=0, shape="flat", page_bytes=PAGE_CONTENT_BYTES, seed=0):
+    """Scrive in `path` un PDF sintetico.
+
+    Con shape="flat" tutte le voci dell'outline sono al primo livello; con
+    shape="nested" formano catene di NESTED_DEPTH livelli. Le voci puntano a
+    pagine crescenti, come in un indice reale.
+    """
+    rng = random.Random(seed)
+    writer = PdfWriter()
+    for _ in range(pages):
+        page = writer.add_blank_page(612, 792)
+        if page_bytes:
+            stream = StreamObject()
+            stream.set_data(_page_content(rng, page_bytes))
+            page[NameObject("/Contents")] = writer._add_object(stream)
+
+    last = None
+    for i in range(outline_nodes):
+        parent = last if shape == "nested" and i % NESTED_DEPTH else None
+        last = writer.add_outline_item(f"Voce {i + 1}", i * pages // outline_nodes, parent=parent)
+
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as f:
+        writer.write(f)
+    os.replace(temp_path, path)
+
+
+def corpus_file(corpus_dir, pages, outline_nodes, shape):
+    """Percorso del PDF sintetico richiesto, generato solo se non esiste già."""
+    path = os.path.join(corpus_dir, f"corpus_p{pages}_o{outline_nodes}_{shape}.pdf")
+    if not os.path.isfile(path):
+        print(f"Genero {os.path.basename(path)}...", flush=True)
+        generate_pdf(path, pages, outline_nodes, shape)
+    return path
+
+
+# --- Host nativo via stdio ---
+
+class HostProcess:
+    """Host avviato come farebbe il browser, con framing a 4 byte su stdin/stdout.
+
+    Con `daemon_dir` l'host è il client native_host.py e la memoria misurata è
+    quella del daemon registrato in quella directory.
+    """
+
+    def __init__(self, env=None, script=HOST_SCRIPT, daemon_dir=None):
+        self.daemon_dir = daemon_dir
+        self._assembler = ChunkAssembler()
+        self.proc = subprocess.Popen(
+            [sys.executable, script],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            env=env,
+        )
+
+    def send(self, message):
+        # Come l'estensione: i messaggi oltre 1 MB partono a blocchi
+        for encoded in encode_frames(json.dumps(message)):
+            self.proc.stdin.write(struct.pack("@I", len(encoded)))
+            self.proc.stdin.write(encoded)
+        self.proc.stdin.flush()
+
+    def receive(self):
+        """Prossimo messaggio completo, ricomponendo quelli inviati a blocchi."""
+        while True:
+            raw_length = self.proc.stdout.read(4)
+            if len(raw_length) < 4:
+                raise RuntimeError("L'host ha chiuso stdout senza rispondere.")
+            length = struct.unpack("@I", raw_length)[0]
+            message = self._assembler.feed(json.loads(self.proc.stdout.read(length).decode("utf-8")))
+            if message is not None:
+                return message
+
+    def request(self, message):
+        """Invia un messaggio e attende la risposta diretta, ignorando le notifiche (progress, flushed)."""
+        self.send(message)
+        while True:
+            response = self.receive()
+            if "type" not in response:
+                return response
+
+    def peak_rss(self):
+        """Picco di memoria residente in byte, o None se non misurabile su questa piattaforma."""
+        pid = self.proc.pid
+        if self.daemon_dir is not None:
+            info = host_daemon.read_info(self.daemon_dir)
+            if info is None:
+                return None
+            pid = info["pid"]
+        try:
+            with open(f"/proc/{pid}/status", "r") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        try:
+            import psutil  # opzionale
+        except ImportError:
+            return None
+        info = psutil.Process(pid).memory_info()
+        return getattr(info, "peak_wset", None) or getattr(info, "rss", None)
+
+    def close(self):
+        """Chiude stdin (fine sessione) e attende l'uscita. Restituisce il picco RSS."""
+        rss = self.peak_rss()
+        self.proc.stdin.close()
+        self.proc.wait(timeout=120)
+        self.proc.stdout.close()
+        return rss
+
+
+# --- Misure ---
+
+def percentile(values, pct):
+    """Percentile con metodo nearest-rank."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * pct // 100))
+    return ordered[int(rank) - 1]
+
+
+def summarize(latencies):
+    if not latencies:
+        return None
+    return {
+        "runs": len(latencies),
+        "mean_ms": round(1000 * sum(latencies) / len(latencies), 3),
+        "p50_ms": round(1000 * percentile(latencies, 50), 3),
+        "p90_ms": round(1000 * percentile(latencies, 90), 3),
+        "p99_ms": round(1000 * percentile(latencies, 99), 3),
+        "max_ms": round(1000 * max(latencies), 3),
+    }
+
+
+def build_message(action, path, pages, counter):
+    """Richiesta come quella inviata dall'estensione; `counter` rende unici i titoli."""
+    if action == "get_outline":
+        # Apertura del popup: lettura dall'indice degli outline, nessun bookmark scritto
+        return {"file_directory": path, "action": action, "timings": True, "params": {}}, 0
+    if action == "add_bookmark":
+        page = (counter * 7919) % pages + 1
+        return {"file_directory": path, "action": action, "timings": True,
+                "params": {"bookmark_name": f"Benchmark {counter}", "page": page}}, 1
+    bookmarks = [
+        {"bookmark_name": f"Benchmark {counter}.{i}", "page": ((counter + i) * 7919) % pages + 1}
+        for i in range(BATCH_SIZE)
+    ]
+    return {"file_directory": path, "action": action, "timings": True, "params": {"bookmarks": bookmarks}}, BATCH_SIZE
+
+
+def timed_request(host, message, path):
+    """Esegue una richiesta e restituisce (latenza, byte scritti, tempi per fase riportati dall'host).
+
+    Se il file è stato riscritto (nuovo inode) conta l'intero file, altrimenti
+    solo i byte aggiunti dall'aggiornamento incrementale.
+    """
+    before = os.stat(path)
+    start = time.perf_counter()
+    response = host.request(message)
+    elapsed = time.perf_counter() - start
+    if response.get("status") != "success":
+        raise RuntimeError(f"Richiesta fallita: {response.get('message')}")
+    after = os.stat(path)
+    rewritten = (after.st_ino, after.st_dev) != (before.st_ino, before.st_dev)
+    return elapsed, after.st_size if rewritten else after.st_size - before.st_size, response.get("timings", {})
+
+
+def measure_startup(launch, runs):
+    """Tempi dall'avvio dell'host alla risposta a un messaggio 'status', che non tocca alcun PDF.
+
+    Il primo avvio viene riportato a parte: in modalità daemon include l'avvio del daemon.
+    """
+    latencies = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        host = launch()
+        host.request({"action": "status"})
+        latencies.append(time.perf_counter() - start)
+        host.close()
+    return {"first_ms": round(1000 * latencies[0], 3), "next": summarize(latencies[1:])}
+
+
+def stop_daemon(data_dir, timeout=10.0):
+    """Termina il daemon rimasto da un'esecuzione precedente del benchmark, se c'è."""
+    info = host_daemon.read_info(data_dir)
+    if info is None:
+        return
+    try:
+        os.kill(info["pid"], signal.SIGTERM)
+    except OSError:
+        return
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            host_daemon.connect(data_dir, timeout=0.2).close()
+        except OSError:
+            return
+        time.sleep(0.05)
+
+
+def run_scenario(source, work_dir, pages, action, cold_runs, warm_runs, launch):
+    """Misura un'azione su una copia di `source`; `launch()` avvia un host. Restituisce i risultati."""
+    path = os.path.join(work_dir, "bench_target.pdf")
+    shutil.copyfile(source, path)
+    counter = 0
+    bytes_written = []
+    bookmarks = 0
+
+    cold = []
+    cold_rss = []
+    for _ in range(cold_runs):
+        counter += 1
+        message, count = build_message(action, path, pages, counter)
+        start = time.perf_counter()
+        host = launch()
+        _, written, _ = timed_request(host, message, path)
+        cold.append(time.perf_counter() - start)
+        cold_rss.append(host.close())
+        bytes_written.append(written)
+
+    warm = []
+    phases = {}
+    host = launch()
+    try:
+        # La prima richiesta paga import e analisi del file: non fa parte delle misure warm
+        counter += 1
+        host.request(build_message(action, path, pages, counter)[0])
+        for _ in range(warm_runs):
+            counter += 1
+            message, count = build_message(action, path, pages, counter)
+            elapsed, written, timings = timed_request(host, message, path)
+            warm.append(elapsed)
+            for phase, ms in timings.items():
+                phases[phase] = phases.get(phase, 0.0) + ms
+            bytes_written.append(written)
+            bookmarks += count
+    finally:
+        warm_rss = host.close()
+
+    total_written = sum(bytes_written)
+    warm_time = sum(warm)
+    rss_values = [rss for rss in cold_rss + [warm_rss] if rss is not None]
+    return {
+        "cold": summarize(cold),
+        "warm": summarize(warm),
+        # Media per fase (parse, clone, outline_build, serialize, commit) delle richieste warm
+        "warm_phases_ms": {phase: round(ms / len(warm), 3) for phase, ms in phases.items()} if warm else {},
+        "peak_rss_bytes": max(rss_values) if rss_values else None,
+        "bytes_written_mean": round(total_written / len(bytes_written)) if bytes_written else None,
+        "bookmarks_per_second": round(bookmarks / warm_time, 2) if warm_time else None,
+        "write_mb_per_second": round(sum(bytes_written[cold_runs:]) / warm_time / 1e6, 3) if warm_time else None,
+        "final_size_bytes": os.path.getsize(path),
+    }
+
+
+def scenarios(page_counts, outline_sizes, shapes):
+    for pages in page_counts:
+        for nodes in outline_sizes:
+            # Senza outline la forma non conta: un solo scenario
+            for shape in (shapes[:1] if nodes == 0 else shapes):
+                yield pages, nodes, shape
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=os.path.dirname(HOST_SCRIPT),
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def scenario_key(result):
+    return (result["pages"], result["outline_nodes"], result["shape"], result["action"])
+
+
+def compare(results, baseline_path):
+    """Stampa il rapporto dei p50 warm rispetto a un file di risultati precedente."""
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = {scenario_key(r): r for r in json.load(f)["results"]}
+    regressions = 0
+    print(f"\nConfronto con {baseline_path} (p50 warm, nuovo / precedente):")
+    for result in results:
+        old = baseline.get(scenario_key(result))
+        if old is None or not old.get("warm") or not result.get("warm"):
+            continue
+        ratio = result["warm"]["p50_ms"] / old["warm"]["p50_ms"] if old["warm"]["p50_ms"] else float("inf")
+        flag = "  REGRESSIONE" if ratio > REGRESSION_THRESHOLD else ""
+        regressions += bool(flag)
+        pages, nodes, shape, action = scenario_key(result)
+        print(f"  {action:14} p={pages:<6} o={nodes:<6} {shape:6} {ratio:6.2f}x{flag}")
+    return regressions
+
+
+def parse_counts(value):
+    return tuple(int(v) for v in value.split(",") if v.strip())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark dell'host nativo su PDF sintetici.")
+    parser.add_argument("--quick", action="store_true", help="matrice ridotta per una verifica veloce")
+    parser.add_argument("--pages", type=parse_counts, help="numeri di pagine, separati da virgola")
+    parser.add_argument("--outlines", type=parse_counts, help="dimensioni degli outline, separate da virgola")
+    parser.add_argument("--shapes", default=",".join(SHAPES), help="forme dell'outline: flat, nested")
+    parser.add_argument("--actions", default=",".join(ACTIONS), help="azioni da misurare")
+    parser.add_argument("--cold-runs", type=int, help="richieste con un nuovo host ciascuna")
+    parser.add_argument("--warm-runs", type=int, help="richieste sullo stesso host")
+    parser.add_argument("--workdir", default=os.path.join(tempfile.gettempdir(), "edge_pdf_benchmark"),
+                        help="directory del corpus (riutilizzato tra un'esecuzione e l'altra)")
+    parser.add_argument("--output", default="benchmark_results.json", help="file JSON dei risultati")
+    parser.add_argument("--compare", help="file JSON di un'esecuzione precedente da confrontare")
+    parser.add_argument("--daemon", action="store_true", help="usa il client native_host.py e il daemon condiviso")
+    args = parser.parse_args(argv)
+
+    page_counts = args.pages or (QUICK_PAGE_COUNTS if args.quick else PAGE_COUNTS)
+    outline_sizes = args.outlines or (QUICK_OUTLINE_SIZES if args.quick else OUTLINE_SIZES)
+    shapes = tuple(s for s in args.shapes.split(",") if s)
+    actions = tuple(a for a in args.actions.split(",") if a)
+    cold_runs = args.cold_runs if args.cold_runs is not None else (2 if args.quick else 5)
+    warm_runs = args.warm_runs if args.warm_runs is not None else (5 if args.quick else 20)
+
+    corpus_dir = os.path.join(args.workdir, "corpus")
+    work_dir = os.path.join(args.workdir, "run")
+    host_home = os.path.join(args.workdir, "home")
+    for directory in (corpus_dir, work_dir, host_home):
+        os.makedirs(directory, exist_ok=True)
+    # Log e dati dell'host restano nella directory del benchmark, non nella home dell'utente
+    env = dict(os.environ, HOME=host_home, USERPROFILE=host_home,
+               EDGE_PDF_NATIVE_APP_DAEMON_IDLE=str(BENCHMARK_DAEMON_IDLE))
+    daemon_dir = os.path.join(host_home, ".edge_pdf_native_app") if args.daemon else None
+
+    def launch():
+        return HostProcess(env, SHIM_SCRIPT if args.daemon else HOST_SCRIPT, daemon_dir)
+
+    if daemon_dir is not None:
+        stop_daemon(daemon_dir)
+    startup = measure_startup(launch, STARTUP_RUNS)
+    print(f"Avvio host: primo {startup['first_ms']} ms, successivi p50 {startup['next']['p50_ms']} ms")
+
+    results = []
+    for pages, nodes, shape in scenarios(page_counts, outline_sizes, shapes):
+        source = corpus_file(corpus_dir, pages, nodes, shape)
+        for action in actions:
+            print(f"{action:14} p={pages:<6} o={nodes:<6} {shape:6} ", end="", flush=True)
+            measures = run_scenario(source, work_dir, pages, action, cold_runs, warm_runs, launch)
+            result = {"pages": pages, "outline_nodes": nodes, "shape": shape, "action": action,
+                      "source_size_bytes": os.path.getsize(source), **measures}
+            results.append(result)
+            cold, warm = result["cold"] or {}, result["warm"] or {}
+            rss = result["peak_rss_bytes"]
+            print(f"cold p50 {cold.get('p50_ms', '-'):>9} ms  warm p50 {warm.get('p50_ms', '-'):>9} ms  "
+                  f"rss {rss / 1e6 if rss else 0:7.1f} MB  scritti {result['bytes_written_mean']} B")
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "pypdf": pypdf_version,
+            "platform": platform.platform(),
+            "cold_runs": cold_runs,
+            "warm_runs": warm_runs,
+            "batch_size": BATCH_SIZE,
+            "mode": "daemon" if args.daemon else "stdio",
+        },
+        "startup": startup,
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nRisultati scritti in {args.output}")
+    if daemon_dir is not None:
+        stop_daemon(daemon_dir)
+
+    if args.compare:
+        return 1 if compare(results, args.compare) else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
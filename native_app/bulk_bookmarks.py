@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Aggiunta di bookmark a molti PDF da riga di comando, senza browser.
+
+Le modifiche arrivano da un manifest CSV (colonne path, title, page e, facoltative,
+parent e parent_page) o JSON lines (un oggetto per riga con le stesse chiavi), oppure da
+un glob di file a cui applicare lo stesso bookmark (--title/--page) o i titoli
+proposti da suggest_outline (--suggest). Le modifiche vengono raggruppate per
+file, così ogni PDF viene aperto e scritto una sola volta, e i file vengono
+elaborati su un pool di processi con un numero limitato di file in corso.
+
+Ogni file completato viene registrato in un checkpoint (JSON lines) insieme a
+un'impronta delle modifiche richieste: rilanciando lo stesso comando i file già
+elaborati con le stesse modifiche vengono saltati, mentre un comando diverso
+(altro titolo o pagina, --suggest, righe del manifest cambiate) li rielabora.
+Anche un file scritto ma non ancora registrato non riceve bookmark doppi,
+perché le entry già presenti nell'outline (stesso titolo e pagina) vengono scartate.
+
+Per default le modifiche in blocco non aggiornano l'indice degli outline né la
+cronologia per undo/redo nella directory dei dati dell'utente (un file per PDF);
+con --keep-history vengono registrate come le modifiche fatte dal browser.
+
+    python bulk_bookmarks.py manifest.csv
+    python bulk_bookmarks.py --glob "D:/corsi/**/*.pdf" --suggest --suggest-limit 50
+"""
+
+import os
+import sys
+import csv
+import glob
+import json
+import time
+import hashlib
+import signal
+import logging
+import argparse
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+# File in coda per processo del pool: abbastanza da non lasciarli mai inattivi
+QUEUED_FILES_PER_WORKER = 2
+# Intervallo tra due righe di avanzamento (secondi)
+PROGRESS_INTERVAL = 5.0
+# Errori riportati per esteso nel riepilogo finale
+MAX_REPORTED_FAILURES = 20
+
+
+# --- Lettura delle modifiche ---
+
+def _manifest_rows(manifest_path):
+    """(numero di riga, dizionario) per ogni riga del manifest CSV o JSON lines."""
+    with open(manifest_path, "r", encoding="utf-8-sig", newline="") as f:
+        if manifest_path.lower().endswith(".csv"):
+            for line_number, row in enumerate(csv.DictReader(f), start=2):
+                yield line_number, row
+            return
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                yield line_number, f"JSON non valido: {e}"
+                continue
+            yield line_number, row if isinstance(row, dict) else "ogni riga deve essere un oggetto JSON"
+
+
+def read_manifest(manifest_path, parse_bookmark_params):
+    """Raggruppa per file le modifiche del manifest, nell'ordine in cui compaiono.
+
+    I percorsi relativi sono relativi alla directory del manifest. Restituisce
+    ({percorso: [(titolo, indice_pagina_0, genitore)]}, [errori per riga]).
+    """
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    groups = {}
+    errors = []
+    for line_number, row in _manifest_rows(manifest_path):
+        if isinstance(row, str):
+            errors.append(f"riga {line_number}: {row}")
+            continue
+        path = (row.get("path") or "").strip()
+        if not path:
+            errors.append(f"riga {line_number}: colonna 'path' mancante")
+            continue
+        title, page_index, error = parse_bookmark_params(
+            {"bookmark_name": row.get("title", row.get("bookmark_name")), "page": row.get("page")})
+        if error is not None:
+            errors.append(f"riga {line_number}: {error}")
+            continue
+        parent = (row.get("parent") or "").strip() or None
+        if parent is not None and str(row.get("parent_page") or "").strip():
+            # Con parent_page il genitore è distinto dagli altri bookmark con lo stesso titolo
+            _, parent_page, error = parse_bookmark_params({"bookmark_name": parent, "page": row["parent_page"]})
+            if error is not None:
+                errors.append(f"riga {line_number}: parent_page: {error}")
+                continue
+            parent = (parent, parent_page)
+        path = os.path.normpath(os.path.join(base_dir, path))
+        groups.setdefault(path, []).append((title, page_index, parent))
+    return groups, errors
+
+
+def job_key(entries, suggest_limit=None):
+    """Impronta delle modifiche richieste per un file, registrata nel checkpoint."""
+    if entries is None:
+        request = {"suggest": suggest_limit}
+    else:
+        request = {"entries": [list(entry) for entry in entries]}
+    return hashlib.sha1(json.dumps(request, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+def glob_files(pattern):
+    return sorted(os.path.abspath(p) for p in glob.glob(pattern, recursive=True)
+                  if p.lower().endswith(".pdf") and os.path.isfile(p))
+
+
+# --- Elaborazione di un file (nei processi del pool) ---
+
+def _configure_logging(verbose):
+    # Gli esiti sono già nel checkpoint e nel riepilogo: il log di native_app solo con --verbose
+    logging.basicConfig(level=logging.INFO if verbose else logging.CRITICAL, format="%(process)d %(levelname)s %(message)s")
+
+
+def _init_worker(verbose):
+    # Ctrl+C arriva a tutto il gruppo di processi: lo gestisce solo il processo principale,
+    # così un file non viene interrotto a metà scrittura
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _configure_logging(verbose)
+    import heading_detection
+    # Il parallelismo è già tra i file: l'estrazione del testo resta nel processo
+    heading_detection.POOL_WORKERS = 1
+
+
+def process_file(path, entries, suggest_limit=None, keep_history=False):
+    """Aggiunge a `path` le entry (o i titoli proposti se `entries` è None) con una sola scrittura."""
+    import native_app
+
+    start = time.perf_counter()
+    result = {"path": path, "status": "error", "added": 0, "skipped": 0, "rejected": 0, "bytes": 0}
+    try:
+        result["bytes"] = os.path.getsize(path)
+        if entries is None:
+            response = native_app.suggest_outline(path, {"limit": suggest_limit} if suggest_limit else {})
+            if response["status"] != "success":
+                result["message"] = response["message"]
+                return result
+            entries, _, _ = native_app.parse_bookmark_entries(response["candidates"])
+
+        # Entry già presenti (es. file scritto prima di un'interruzione): non vanno duplicate
+        existing = {(node.title, node.page) for node in native_app.document_cache.get(path).outline}
+        new_entries = [entry for entry in entries if (entry[0], entry[1]) not in existing]
+        result["skipped"] = len(entries) - len(new_entries)
+        if not new_entries:
+            result["status"] = "success"
+            return result
+
+        success, message, errors = native_app.add_bookmarks_to_pdf(path, new_entries, keep_history=keep_history)
+        # Le entry non valide (pagina oltre la fine, genitore assente) non rendono fallito il file
+        rejected = [error for error in errors if error is not None]
+        result["rejected"] = len(rejected)
+        if success:
+            result["added"] = errors.count(None)
+        if success or len(rejected) == len(new_entries):
+            result["status"] = "success"
+            if rejected:
+                result["message"] = f"{len(rejected)} bookmark scartati: {rejected[0]}"
+        else:
+            result["message"] = message
+    except Exception as e:
+        result["message"] = f"{type(e).__name__}: {e}"
+    finally:
+        # Ogni file viene elaborato una volta: la cache del processo non serve
+        native_app.document_cache.invalidate(path)
+        result["seconds"] = round(time.perf_counter() - start, 3)
+    return result
+
+
+# --- Checkpoint ---
+
+def read_checkpoint(checkpoint_path, retry_failed=False):
+    """Coppie (percorso, impronta delle modifiche) già elaborate in un'esecuzione precedente
+    (esclusi i file falliti con `retry_failed`)."""
+    done = set()
+    try:
+        with open(checkpoint_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # riga troncata da un'interruzione
+                if not retry_failed or record.get("status") == "success":
+                    done.add((record["path"], record.get("job")))
+    except FileNotFoundError:
+        pass
+    return done
+
+
+class Summary:
+    """Contatori dell'esecuzione e riepilogo della velocità."""
+
+    def __init__(self, total_files):
+        self.total_files = total_files
+        self.interrupted = False
+        self.files = 0
+        self.failed = []
+        self.added = 0
+        self.rejected = 0
+        self.bytes = 0
+        self.start = time.perf_counter()
+
+    def add(self, result):
+        self.files += 1
+        self.added += result["added"]
+        self.rejected += result["rejected"]
+        self.bytes += result["bytes"]
+        if result["status"] != "success":
+            self.failed.append(result)
+
+    def line(self):
+        elapsed = time.perf_counter() - self.start
+        return (f"{self.files}/{self.total_files} file, {len(self.failed)} errori, {self.added} bookmark "
+                f"({self.rejected} scartati), "
+                f"{self.files / elapsed if elapsed else 0:.1f} file/s, {self.bytes / elapsed / 1e6 if elapsed else 0:.1f} MB/s")
+
+
+def _record(checkpoint, summary, future, key, verbose):
+    try:
+        result = future.result()
+    except Exception as e:
+        # Processo del pool terminato in modo anomalo: il file verrà ripreso alla prossima esecuzione
+        print(f"ERRORE nel pool: {type(e).__name__}: {e}", file=sys.stderr)
+        return
+    result["job"] = key
+    checkpoint.write(json.dumps(result, ensure_ascii=False) + "\n")
+    summary.add(result)
+    if result["status"] != "success" and verbose:
+        print(f"ERRORE {result['path']}: {result.get('message')}", file=sys.stderr)
+
+
+def run(jobs, checkpoint_path, workers, suggest_limit=None, verbose=False, keep_history=False):
+    """Elabora `jobs` ({percorso: entry o None}) e registra ogni esito nel checkpoint. Restituisce il Summary.
+
+    Con Ctrl+C i file in corso vengono completati e registrati, gli altri restano
+    per la prossima esecuzione (`summary.interrupted`).
+    """
+    summary = Summary(len(jobs))
+    pending = iter(jobs.items())
+    in_flight = {}  # future → impronta delle modifiche
+    last_report = time.monotonic()
+    with open(checkpoint_path, "a", encoding="utf-8") as checkpoint, \
+            ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(verbose,)) as pool:
+        try:
+            while True:
+                # Al più QUEUED_FILES_PER_WORKER file per processo in attesa: la memoria non cresce con il manifest
+                while len(in_flight) < workers * QUEUED_FILES_PER_WORKER:
+                    item = next(pending, None)
+                    if item is None:
+                        break
+                    future = pool.submit(process_file, item[0], item[1], suggest_limit, keep_history)
+                    in_flight[future] = job_key(item[1], suggest_limit)
+                if not in_flight:
+                    break
+                finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    _record(checkpoint, summary, future, in_flight.pop(future), verbose)
+                checkpoint.flush()
+                if time.monotonic() - last_report >= PROGRESS_INTERVAL:
+                    last_report = time.monotonic()
+                    print(summary.line(), file=sys.stderr)
+        except KeyboardInterrupt:
+            print("Interruzione: attendo i file in corso...", file=sys.stderr)
+            summary.interrupted = True
+            for future in in_flight:
+                future.cancel()
+            for future, key in in_flight.items():
+                if not future.cancelled():
+                    _record(checkpoint, summary, future, key, verbose)
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Aggiunge bookmark a molti PDF (manifest CSV/JSON lines o glob).")
+    parser.add_argument("manifest", nargs="?", help="manifest .csv o .jsonl con path, title, page, parent")
+    parser.add_argument("--glob", help="file PDF da elaborare (es. \"archivio/**/*.pdf\"), al posto del manifest")
+    parser.add_argument("--title", help="con --glob: titolo del bookmark da aggiungere a ogni file")
+    parser.add_argument("--page", type=int, default=1, help="con --title: pagina del bookmark (1-based)")
+    parser.add_argument("--suggest", action="store_true", help="con --glob: aggiunge i titoli proposti da suggest_outline")
+    parser.add_argument("--suggest-limit", type=int, help="titoli proposti al massimo per file")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="processi in parallelo")
+    parser.add_argument("--checkpoint", help="file di checkpoint (default: <manifest>.checkpoint.jsonl)")
+    parser.add_argument("--retry-failed", action="store_true", help="rielabora i file falliti nel checkpoint")
+    parser.add_argument("--keep-history", action="store_true",
+                        help="aggiorna indice degli outline e cronologia per undo/redo (un file per PDF nei dati utente)")
+    parser.add_argument("--verbose", action="store_true", help="log dei processi ed errori su stderr")
+    args = parser.parse_args(argv)
+    _configure_logging(args.verbose)
+
+    # native_app viene importato qui (e nei processi del pool), non all'avvio dello script
+    from native_app import parse_bookmark_params
+
+    if bool(args.manifest) == bool(args.glob):
+        parser.error("indicare un manifest oppure --glob")
+    if args.glob and bool(args.title) == args.suggest:
+        parser.error("con --glob indicare --title oppure --suggest")
+
+    errors = []
+    if args.manifest:
+        groups, errors = read_manifest(args.manifest, parse_bookmark_params)
+        for error in errors:
+            print(f"Manifest: {error}", file=sys.stderr)
+        checkpoint_path = args.checkpoint or args.manifest + ".checkpoint.jsonl"
+    else:
+        files = glob_files(args.glob)
+        if args.title:
+            title, page_index, error = parse_bookmark_params({"bookmark_name": args.title, "page": args.page})
+            if error is not None:
+                parser.error(error)
+            groups = {path: [(title, page_index, None)] for path in files}
+        else:
+            groups = {path: None for path in files}
+        checkpoint_path = args.checkpoint or "bulk_bookmarks.checkpoint.jsonl"
+
+    done = read_checkpoint(checkpoint_path, args.retry_failed)
+    jobs = {path: entries for path, entries in groups.items() if (path, job_key(entries, args.suggest_limit)) not in done}
+    print(f"{len(groups)} file, {len(groups) - len(jobs)} già elaborati (checkpoint: {checkpoint_path})", file=sys.stderr)
+
+    summary = run(jobs, checkpoint_path, max(1, args.workers), args.suggest_limit, args.verbose, args.keep_history)
+
+    print(summary.line())
+    for result in summary.failed[:MAX_REPORTED_FAILURES]:
+        print(f"  {result['path']}: {result.get('message')}")
+    if len(summary.failed) > MAX_REPORTED_FAILURES:
+        print(f"  ... e altri {len(summary.failed) - MAX_REPORTED_FAILURES} (vedi {checkpoint_path})")
+    if summary.interrupted:
+        print("Esecuzione interrotta: rilanciare lo stesso comando per riprendere.", file=sys.stderr)
+        return 130
+    return 1 if summary.failed or errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Messaggi a blocchi sopra il framing Native Messaging (prefisso di lunghezza a 4 byte).
+
+Il browser non accetta dall'host messaggi oltre 1 MB, e anche l'host rifiuta i
+frame più grandi. Un messaggio che non sta in un frame viene serializzato una
+volta sola e il suo testo JSON viene spedito in più frame consecutivi:
+
+    {"type": "chunk", "stream": "h1", "seq": 0, "data": "<porzione del JSON>"}
+    {"type": "chunk", "stream": "h1", "seq": 1, "data": "...", "final": true}
+
+Il destinatario accoda i `data` nell'ordine di `seq` e decodifica il JSON
+all'arrivo del blocco con `final`. L'estensione (extension/background.js)
+ricompone allo stesso modo le risposte grandi (es. get_outline senza `limit`)
+e spezza nello stesso formato i messaggi grandi diretti all'host (es. migliaia
+di bookmark in add_bookmarks), con blocchi più piccoli perché il suo testo può
+contenere caratteri non ASCII.
+Blocchi di stream diversi possono alternarsi sullo stesso canale, quindi un
+trasferimento lungo non blocca le notifiche dei job.
+
+In ingresso il testo di un messaggio viene tenuto in memoria finché non arriva
+l'ultimo blocco, invece di essere decodificato man mano: è un adattamento
+voluto. La libreria standard non ha un parser JSON incrementale, e uno scritto
+in Python sarebbe molto più lento di json.loads su decine di MB. Inoltre il
+messaggio decodificato deve comunque essere tutto in memoria, perché
+handle_message lavora su un dizionario completo: la decodifica incrementale non
+abbasserebbe il picco sotto la dimensione del messaggio. La memoria resta
+limitata da MAX_MESSAGE_LENGTH per stream e da MAX_OPEN_STREAMS stream aperti.
+
+Il modulo usa solo la libreria standard, perché lo importa anche il client del daemon.
+"""
+
+import json
+import itertools
+import threading
+
+# Limite del browser per un singolo messaggio dall'host (e dell'host per un frame in ingresso)
+MAX_FRAME_LENGTH = 1 * 1024 * 1024
+# Caratteri di JSON per blocco: anche con l'escape di ogni carattere (\" e \\) il frame resta sotto il limite
+CHUNK_CHARS = 256 * 1024
+# Dimensione massima di un messaggio ricomposto e stream in ingresso aperti contemporaneamente
+MAX_MESSAGE_LENGTH = 64 * 1024 * 1024
+MAX_OPEN_STREAMS = 8
+# Stream in uscita scritti contemporaneamente: gli altri attendono il loro turno
+MAX_OUTGOING_STREAMS = 2
+
+_stream_ids = itertools.count(1)
+
+
+class ChunkError(ValueError):
+    """Blocco non valido o fuori sequenza: lo stream a cui appartiene viene scartato."""
+
+    def __init__(self, message, stream=None):
+        super().__init__(message)
+        self.stream = stream
+
+
+def is_chunk(message):
+    return isinstance(message, dict) and message.get("type") == "chunk"
+
+
+def encode_frames(text, max_frame=MAX_FRAME_LENGTH, chunk_chars=CHUNK_CHARS):
+    """Corpi dei frame per il testo JSON di un messaggio: uno solo se sta nel limite, altrimenti i blocchi.
+
+    `text` è l'output di json.dumps (ASCII), quindi caratteri e byte coincidono.
+    """
+    if len(text) <= max_frame:
+        yield text.encode("utf-8")
+        return
+    stream = f"h{next(_stream_ids)}"
+    last = (len(text) - 1) // chunk_chars
+    for seq in range(last + 1):
+        chunk = {"type": "chunk", "stream": stream, "seq": seq, "data": text[seq * chunk_chars:(seq + 1) * chunk_chars]}
+        if seq == last:
+            chunk["final"] = True
+        yield json.dumps(chunk).encode("utf-8")
+
+
+class ChunkedWriter:
+    """Scrive messaggi su un canale a frame, spezzando in blocchi quelli oltre il limite.
+
+    `write_frame(body)` scrive un frame completo ed è responsabile del proprio
+    lock: ogni blocco viene scritto a sé, così i messaggi piccoli di altri thread
+    passano tra un blocco e l'altro. La scrittura bloccante sul canale fa da
+    contropressione; al più `max_streams` messaggi a blocchi sono in corso
+    insieme, gli altri thread attendono invece di accumulare dati in memoria.
+    """
+
+    def __init__(self, write_frame, max_streams=MAX_OUTGOING_STREAMS):
+        self._write_frame = write_frame
+        self._slots = threading.BoundedSemaphore(max_streams)
+
+    def send(self, text):
+        if len(text) <= MAX_FRAME_LENGTH:
+            self._write_frame(text.encode("utf-8"))
+            return
+        with self._slots:
+            for body in encode_frames(text):
+                self._write_frame(body)
+
+
+class _Stream:
+    __slots__ = ("parts", "next_seq", "length")
+
+    def __init__(self):
+        self.parts = []
+        self.next_seq = 0
+        self.length = 0
+
+
+class ChunkAssembler:
+    """Ricompone i messaggi a blocchi in arrivo su un canale.
+
+    `feed(message)` restituisce i messaggi normali così come sono, None per i
+    blocchi intermedi e il messaggio decodificato all'ultimo blocco. Sequenza e
+    dimensione vengono verificate a ogni blocco; il testo viene unito e
+    decodificato all'ultimo (vedi la nota nel docstring del modulo).
+    """
+
+    def __init__(self, max_length=MAX_MESSAGE_LENGTH, max_streams=MAX_OPEN_STREAMS):
+        self.max_length = max_length
+        self.max_streams = max_streams
+        self._streams = {}
+
+    def feed(self, message):
+        if not is_chunk(message):
+            return message
+        stream_id, seq, data = message.get("stream"), message.get("seq"), message.get("data")
+        if not isinstance(stream_id, (str, int)) or not isinstance(seq, int) or not isinstance(data, str):
+            raise ChunkError("Blocco non valido: servono 'stream', 'seq' (intero) e 'data' (stringa).", stream_id)
+
+        stream = self._streams.get(stream_id)
+        if stream is None:
+            if seq != 0:
+                raise ChunkError(f"Blocco {seq} dello stream {stream_id} senza il blocco iniziale.", stream_id)
+            if len(self._streams) >= self.max_streams:
+                raise ChunkError(f"Troppi stream aperti (massimo {self.max_streams}).", stream_id)
+            stream = self._streams[stream_id] = _Stream()
+        if seq != stream.next_seq:
+            del self._streams[stream_id]
+            raise ChunkError(f"Blocco {seq} dello stream {stream_id} fuori sequenza (atteso {stream.next_seq}).", stream_id)
+        stream.length += len(data)
+        if stream.length > self.max_length:
+            del self._streams[stream_id]
+            raise ChunkError(f"Messaggio a blocchi oltre il limite di {self.max_length} caratteri.", stream_id)
+        stream.parts.append(data)
+        stream.next_seq += 1
+
+        if not message.get("final"):
+            return None
+        del self._streams[stream_id]
+        try:
+            return json.loads("".join(stream.parts))
+        except ValueError as e:
+            raise ChunkError(f"Messaggio a blocchi non valido (JSON): {e}", stream_id) from e
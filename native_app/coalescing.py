@@ -0,0 +1,407 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Accorpamento (debounce) delle modifiche ravvicinate allo stesso PDF.
+
+Ogni bookmark richiesto viene registrato in un piccolo journal accanto al PDF
+(`<file>.pdf.journal`, una riga JSON per modifica) e confermato subito. Dopo
+una finestra di inattività, su richiesta esplicita (`flush`) o alla chiusura
+dell'host, tutte le modifiche in sospeso vengono applicate con una sola
+scrittura. Un registro centrale dei journal aperti permette di riapplicare al
+prossimo avvio le modifiche rimaste in sospeso dopo un crash.
+
+Ogni journal appartiene all'host che lo ha creato, che tiene un lock esclusivo
+sul file `<file>.pdf.journal.lock` (con il proprio PID) finché le modifiche
+non sono salvate. All'avvio vengono recuperati solo i journal orfani, con il
+lock libero: quelli di un altro host ancora attivo restano a lui. Prima di
+scrivere il PDF nel journal viene annotato lo stato del file (riga
+`applying`); se al recupero il file risulta cambiato e le modifiche sono già
+nell'outline, la scrittura era riuscita e non vengono riapplicate.
+
+Un flush fallito viene riprovato solo se l'errore è temporaneo (OSError, ad
+esempio un file bloccato da un altro programma), con un nuovo timer e attese
+crescenti fino a RETRY_MAX_SECONDS. Le entry rifiutate dal salvataggio (pagina
+non valida, genitore inesistente) o un PDF non leggibile non guariscono
+riprovando: vengono scartate, riportate nell'esito e tolte dal journal.
+"""
+
+import os
+import json
+import logging
+import threading
+
+from document_cache import normalize_path
+
+JOURNAL_SUFFIX = ".journal"
+LOCK_SUFFIX = ".lock"
+# Attesa massima tra due tentativi dopo errori temporanei (raddoppia a ogni fallimento)
+RETRY_MAX_SECONDS = 300.0
+
+
+class JournalBusy(Exception):
+    """Il journal del file appartiene a un altro host attivo: la modifica va applicata senza accorparla."""
+
+
+def journal_path(pdf_path):
+    return pdf_path + JOURNAL_SUFFIX
+
+
+def read_journal(path):
+    """Legge le entry (titolo, indice_pagina_0, genitore) da un journal, ignorando righe troncate.
+
+    Restituisce (entry, applying): `applying` è l'ultima annotazione scritta prima
+    di salvare il PDF ({"entries", "size", "mtime_ns"}) o None.
+    """
+    entries = []
+    applying = None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                    if "applying" in record:
+                        applying = record["applying"]
+                        continue
+                    parent = record.get("parent")
+                    if isinstance(parent, list):
+                        # Genitore indicato da titolo e pagina, salvato come lista JSON
+                        parent = (parent[0], int(parent[1]))
+                    entries.append((record["title"], int(record["page"]), parent))
+                except (ValueError, KeyError, TypeError):
+                    # Una riga incompleta può restare solo se il processo è morto durante la scrittura
+                    logging.warning("Riga non valida nel journal %s, ignorata.", path)
+    except FileNotFoundError:
+        pass
+    return entries, applying
+
+
+class _JournalLock:
+    """Lock esclusivo su `<journal>.lock`, rilasciato dal sistema anche se l'host termina in modo anomalo."""
+
+    def __init__(self, path):
+        self.path = path
+        self._f = None
+
+    def acquire(self):
+        while True:
+            f = open(self.path, "a+")
+            try:
+                if os.name == "nt":
+                    import msvcrt
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+                else:
+                    import fcntl
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                f.close()
+                return False
+            if os.name != "nt":
+                # Il proprietario precedente può aver eliminato il file tra open e flock:
+                # il lock vale solo se è ancora quello presente su disco
+                try:
+                    current = os.path.samestat(os.fstat(f.fileno()), os.stat(self.path))
+                except FileNotFoundError:
+                    current = False
+                if not current:
+                    f.close()
+                    continue
+            f.seek(0)
+            f.truncate()
+            f.write(str(os.getpid()))
+            f.flush()
+            self._f = f
+            return True
+
+    def release(self, remove=True):
+        if self._f is None:
+            return
+        if remove and os.name != "nt":
+            # Eliminato mentre il lock è ancora tenuto, così nessun altro host lo acquisisce sul file vecchio
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+        self._f.close()
+        self._f = None
+        if remove and os.name == "nt":
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass  # già riaperto da un altro host
+
+
+class EditCoalescer:
+    """Raccoglie le modifiche per file e le applica in blocco dopo `idle_seconds` di inattività.
+
+    `apply_edits(pdf_path, entries)` esegue la scrittura e restituisce
+    (successo, percorso_o_errore, errori_per_entry), come add_bookmarks_to_pdf;
+    solleva OSError per gli errori temporanei, dopo i quali le modifiche vengono
+    riprovate. `notify(message)` riceve l'esito di ogni flush. `is_applied(pdf_path, entries)`
+    dice se le entry sono già presenti nell'outline del file: serve al recupero
+    dopo un crash avvenuto tra la scrittura del PDF e la pulizia del journal.
+    """
+
+    def __init__(self, apply_edits, registry_path, idle_seconds=3.0, notify=None, is_applied=None):
+        self._apply_edits = apply_edits
+        self._registry_path = registry_path
+        self.idle_seconds = idle_seconds
+        self._notify = notify
+        self._is_applied = is_applied
+        self._pending = {}  # chiave normalizzata → (percorso, [entry])
+        self._applying = {}  # chiave normalizzata → entry in corso di scrittura
+        self._failures = {}  # chiave normalizzata → errori temporanei consecutivi
+        self._timers = {}
+        self._owned = {}  # chiave normalizzata → lock dei journal di questo host
+        self._lock = threading.Lock()
+
+    # --- Registro dei journal aperti ---
+
+    def _read_registry(self):
+        try:
+            with open(self._registry_path, "r", encoding="utf-8") as f:
+                return [line.rstrip("\n") for line in f if line.strip()]
+        except FileNotFoundError:
+            return []
+
+    def _write_registry(self, paths):
+        os.makedirs(os.path.dirname(self._registry_path), exist_ok=True)
+        temp_path = self._registry_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.writelines(path + "\n" for path in paths)
+        os.replace(temp_path, self._registry_path)
+
+    def _register(self, pdf_path):
+        paths = self._read_registry()
+        if pdf_path not in paths:
+            paths.append(pdf_path)
+            self._write_registry(paths)
+
+    def _unregister(self, pdf_path):
+        paths = self._read_registry()
+        if pdf_path in paths:
+            paths.remove(pdf_path)
+            self._write_registry(paths)
+
+    # --- Proprietà dei journal ---
+
+    def _claim(self, key, path):
+        """Acquisisce il journal di `path` per questo host. False se appartiene a un altro host attivo."""
+        if key in self._owned:
+            return True
+        lock = _JournalLock(journal_path(path) + LOCK_SUFFIX)
+        if not lock.acquire():
+            return False
+        self._owned[key] = lock
+        return True
+
+    def _release(self, key):
+        lock = self._owned.pop(key, None)
+        if lock is not None:
+            lock.release()
+
+    # --- Modifiche ---
+
+    def add(self, pdf_path, entries):
+        """Registra le entry nel journal e rimanda la scrittura. Restituisce il numero di modifiche in sospeso.
+
+        Solleva JournalBusy se il journal del file appartiene a un altro host.
+        """
+        key = normalize_path(pdf_path)
+        with self._lock:
+            path, pending = self._pending.get(key, (pdf_path, []))
+            if not self._claim(key, path):
+                raise JournalBusy(path)
+            with open(journal_path(path), "a", encoding="utf-8") as f:
+                for title, page_index, parent in entries:
+                    f.write(json.dumps({"title": title, "page": page_index, "parent": parent}) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            if not pending:
+                self._register(path)
+            pending.extend(entries)
+            self._pending[key] = (path, pending)
+            self._schedule(key)
+            return len(pending)
+
+    def pending(self, pdf_path):
+        """Entry di `pdf_path` accettate e non ancora salvate (comprese quelle in scrittura)."""
+        key = normalize_path(pdf_path)
+        with self._lock:
+            return self._applying.get(key, []) + self._pending.get(key, (pdf_path, []))[1]
+
+    def _rewrite_journal(self, path, entries):
+        temp_path = journal_path(path) + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            for title, page_index, parent in entries:
+                f.write(json.dumps({"title": title, "page": page_index, "parent": parent}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, journal_path(path))
+
+    def _schedule(self, key, delay=None):
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        timer = threading.Timer(self.idle_seconds if delay is None else delay, self.flush, args=(key,))
+        timer.daemon = True
+        self._timers[key] = timer
+        timer.start()
+
+    def flush(self, pdf_path=None):
+        """Applica le modifiche in sospeso di un file (o di tutti se `pdf_path` è None).
+
+        Restituisce la lista degli esiti, uno per file scritto.
+        """
+        with self._lock:
+            keys = list(self._pending) if pdf_path is None else [normalize_path(pdf_path)]
+            batches = []
+            for key in keys:
+                timer = self._timers.pop(key, None)
+                if timer is not None:
+                    timer.cancel()
+                if key in self._pending:
+                    path, entries = self._pending.pop(key)
+                    self._applying[key] = entries
+                    batches.append((path, entries))
+
+        outcomes = []
+        for path, entries in batches:
+            outcomes.append(self._flush_file(path, entries))
+        return outcomes
+
+    def _mark_applying(self, path, count):
+        """Annota nel journal lo stato del file prima della scrittura delle prime `count` entry."""
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return  # il flush fallirà e il journal verrà eliminato
+        with self._lock:
+            with open(journal_path(path), "a", encoding="utf-8") as f:
+                f.write(json.dumps({"applying": {"entries": count, "size": st.st_size, "mtime_ns": st.st_mtime_ns}}) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _flush_file(self, path, entries):
+        logging.info("Applico %s modifiche accorpate a %s", len(entries), path)
+        try:
+            self._mark_applying(path, len(entries))
+            success, result, errors = self._apply_edits(path, entries)
+        except OSError as e:
+            # Errore temporaneo (file bloccato, disco pieno): il PDF non è stato modificato
+            logging.error("Modifiche accorpate non applicate a %s, riprovo più tardi: %s", path, e)
+            self._retry(path, entries)
+            return self._report(path, entries, False, f"Errore durante la scrittura del PDF, nuovo tentativo a breve: {e}", [])
+        except Exception as e:
+            logging.exception("Errore durante l'applicazione delle modifiche accorpate: %s", e)
+            success, result, errors = False, f"Errore interno durante la modifica del PDF: {e}", []
+
+        if not success:
+            # Entry rifiutate o PDF non modificabile: riprovare darebbe lo stesso errore
+            logging.error("Modifiche accorpate scartate per %s: %s", path, result)
+        # Nel journal restano solo le modifiche arrivate nel frattempo, se ce ne sono
+        with self._lock:
+            path_key = normalize_path(path)
+            self._applying.pop(path_key, None)
+            self._failures.pop(path_key, None)
+            remaining = self._pending.get(path_key, (path, []))[1]
+            if remaining:
+                self._rewrite_journal(path, remaining)
+            else:
+                try:
+                    os.remove(journal_path(path))
+                except FileNotFoundError:
+                    pass
+                self._unregister(path)
+                self._release(path_key)
+        return self._report(path, entries, success, result, errors)
+
+    def _retry(self, path, entries):
+        """Rimette in sospeso le entry dopo un errore temporaneo e pianifica un nuovo tentativo."""
+        with self._lock:
+            path_key = normalize_path(path)
+            self._applying.pop(path_key, None)
+            _, pending = self._pending.get(path_key, (path, []))
+            pending = entries + pending
+            self._pending[path_key] = (path, pending)
+            failures = self._failures.get(path_key, 0) + 1
+            self._failures[path_key] = failures
+            try:
+                # Senza le annotazioni dei tentativi falliti, che non hanno scritto nulla
+                self._rewrite_journal(path, pending)
+            except OSError as e:
+                logging.warning("Journal di %s non riscritto: %s", path, e)
+            self._schedule(path_key, min(self.idle_seconds * 2 ** failures, RETRY_MAX_SECONDS))
+
+    def _report(self, path, entries, success, result, errors):
+        outcome = {
+            "type": "flushed",
+            "file": path,
+            "status": "success" if success else "error",
+            "applied": errors.count(None) if success else 0,
+            "failed": len(entries) - errors.count(None) if success else len(entries),
+            "message": f"{errors.count(None)} bookmark salvati." if success else result,
+        }
+        rejected = [error for error in errors if error is not None]
+        if rejected:
+            outcome["errors"] = rejected
+        if self._notify is not None:
+            self._notify(outcome)
+        return outcome
+
+    def recover(self):
+        """Ricarica i journal orfani (di host non più attivi) e ne pianifica l'applicazione."""
+        recovered = 0
+        for path in self._read_registry():
+            key = normalize_path(path)
+            with self._lock:
+                if key in self._pending or not self._claim(key, path):
+                    logging.info("Journal di %s in uso da un altro host, non lo recupero.", path)
+                    continue
+            entries, applying = read_journal(journal_path(path))
+            if applying is not None and entries and self._already_applied(path, entries, applying):
+                logging.info("Le prime %s modifiche del journal di %s erano già salvate.", applying["entries"], path)
+                entries = entries[applying["entries"]:]
+                if entries:
+                    self._rewrite_journal(path, entries)
+            if not entries:
+                try:
+                    os.remove(journal_path(path))
+                except FileNotFoundError:
+                    pass
+                with self._lock:
+                    self._unregister(path)
+                    self._release(key)
+                continue
+            with self._lock:
+                _, pending = self._pending.get(key, (path, []))
+                self._pending[key] = (path, entries + pending)
+                self._schedule(key)
+            recovered += len(entries)
+            logging.info("Recuperate %s modifiche non salvate per %s", len(entries), path)
+        return recovered
+
+    def _already_applied(self, path, entries, applying):
+        """True se la scrittura annotata nel journal è arrivata sul PDF prima dell'interruzione."""
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return False
+        if st.st_size == applying.get("size") and st.st_mtime_ns == applying.get("mtime_ns"):
+            return False  # file invariato: la scrittura non è avvenuta
+        count = applying.get("entries", 0)
+        if not 0 < count <= len(entries) or self._is_applied is None:
+            return False
+        try:
+            return self._is_applied(path, entries[:count])
+        except Exception as e:
+            logging.warning("Impossibile verificare le modifiche già salvate in %s: %s", path, e)
+            return False
+
+    def shutdown(self):
+        """Applica subito tutte le modifiche in sospeso e lascia i journal non salvati al prossimo avvio."""
+        outcomes = self.flush()
+        with self._lock:
+            for lock in self._owned.values():
+                lock.release(remove=False)
+            self._owned.clear()
+        return outcomes
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Cache LRU dei documenti PDF già analizzati.
+
+Quando l'host resta attivo per più messaggi, modifiche consecutive allo stesso
+file riutilizzano il PdfReader, la mappa pagina→indice e l'outline già letti,
+evitando di rianalizzare xref e albero delle pagine. Le entry sono indicizzate
+per percorso normalizzato e vengono scartate automaticamente quando mtime o
+dimensione del file cambiano.
+
+Il file viene mappato in memoria invece di essere letto per intero: pypdf legge
+solo le parti che gli servono (xref, albero delle pagine, outline) e i dati di
+immagini e font restano su disco finché nessuno li richiede. La mappa resta
+aperta solo mentre una richiesta usa il documento (vedi DocumentCache.open):
+tra una richiesta e l'altra in cache restano l'outline e l'indice delle pagine,
+e il file non resta aperto (su Windows impedirebbe ad altri programmi di
+sostituirlo o eliminarlo).
+"""
+
+import os
+import mmap
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from pypdf import PdfReader
+
+from outline_tree import OutlineTree
+from page_index import PageIndex
+
+# Stima grossolana della memoria occupata da ogni item dell'outline
+_OUTLINE_ITEM_BYTES = 512
+
+
+def normalize_path(path):
+    """Percorso assoluto e normalizzato (case-insensitive su Windows) usato come chiave."""
+    return os.path.normcase(os.path.abspath(path))
+
+
+def open_reader(path):
+    """PdfReader sul file mappato in memoria. Restituisce (reader, mappa o None)."""
+    with open(path, "rb") as f:
+        try:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # File vuoto: non mappabile, pypdf riporterà l'errore
+            return PdfReader(path), None
+    try:
+        return PdfReader(mapped), mapped
+    except ValueError as e:
+        # La riparazione della xref di pypdf (startxref oltre la fine del file o non
+        # aggiornato) cerca posizioni che una mappa non consente: il file va letto in memoria
+        mapped.close()
+        logging.info("Xref di %s da riparare (%s), leggo il file senza mapparlo.", path, e)
+        return PdfReader(path), None
+    except Exception:
+        mapped.close()
+        raise
+
+
+def _map_unchanged(path, mtime_ns, size):
+    """Mappa di nuovo il file, o None se non è più quello analizzato (mtime o dimensione diversi)."""
+    with open(path, "rb") as f:
+        st = os.fstat(f.fileno())
+        if (st.st_mtime_ns, st.st_size) != (mtime_ns, size):
+            return None
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class CachedDocument:
+    """Documento analizzato: reader, indice delle pagine (PageIndex) e outline (OutlineTree).
+
+    Outline, indice delle pagine e numero di pagine restano sempre disponibili;
+    il reader legge dal file solo tra acquire() e release(), che contano gli
+    utilizzi: la mappa viene riaperta al primo e chiusa all'ultimo.
+    """
+
+    __slots__ = ("path", "mtime_ns", "size", "reader", "mapped", "pages", "outline", "num_pages", "cost",
+                 "_mappable", "_users", "_closed", "_lock")
+
+    def __init__(self, path, mtime_ns, size, reader, mapped=None):
+        self.path = path
+        self.mtime_ns = mtime_ns
+        self.size = size
+        self.reader = reader
+        self.mapped = mapped
+        self._mappable = mapped is not None
+        self._users = 1  # il documento appena creato è in uso da chi lo ha analizzato
+        self._closed = False
+        self._lock = threading.Lock()
+        self.pages = PageIndex(reader)
+        self.num_pages = self.pages.num_pages
+        self.outline = OutlineTree.from_reader(reader, self.pages)
+        # Con il file mappato conta solo la parte letta da pypdf, stimata come una frazione del file
+        self.cost = (size // 8 if mapped is not None else size) + _OUTLINE_ITEM_BYTES * (len(self.outline) + self.num_pages)
+
+    def outline_copy(self):
+        """Copia modificabile dell'outline, da usare per preparare un salvataggio."""
+        return self.outline.copy()
+
+    def acquire(self):
+        """Segna il documento in uso, riaprendo la mappa se serve.
+
+        Restituisce False se il documento è stato chiuso o il file su disco non è
+        più quello analizzato: in quel caso va riletto.
+        """
+        with self._lock:
+            if self._closed:
+                return False
+            if self._mappable and self.mapped is None:
+                try:
+                    mapped = _map_unchanged(self.path, self.mtime_ns, self.size)
+                except (OSError, ValueError):
+                    return False
+                if mapped is None:
+                    return False
+                self.mapped = self.reader.stream = mapped
+            self._users += 1
+            return True
+
+    def release(self):
+        """Fine di un utilizzo: l'ultimo chiude la mappa."""
+        with self._lock:
+            self._users -= 1
+            if self._users <= 0:
+                self._unmap()
+
+    def close(self):
+        """Il file sta per essere sostituito: il documento non verrà più usato e la mappa viene rilasciata.
+
+        Va chiamata dopo aver tolto il documento dalla cache (DocumentCache.invalidate).
+        Se altri thread lo stanno ancora leggendo, la mappa viene chiusa al loro release().
+        """
+        with self._lock:
+            self._closed = True
+            if self._users <= 1:
+                self._unmap()
+
+    def _unmap(self):
+        if self.mapped is not None:
+            self.mapped.close()
+            self.mapped = None
+
+
+class DocumentCache:
+    """Cache LRU con budget sul numero di entry e sulla memoria stimata."""
+
+    def __init__(self, max_entries=8, max_bytes=512 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._total_cost = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path):
+        """Restituisce il CachedDocument aggiornato per `path`, analizzando il file se necessario.
+
+        Il documento non tiene aperto il file: ne vanno usati solo outline, pagine e
+        numero di pagine. Per leggere dal reader si usa open().
+        """
+        doc = self.acquire(path)
+        doc.release()
+        return doc
+
+    @contextmanager
+    def open(self, path):
+        """Come get(), ma il reader può leggere dal file fino all'uscita dal blocco `with`."""
+        doc = self.acquire(path)
+        try:
+            yield doc
+        finally:
+            doc.release()
+
+    def acquire(self, path):
+        """Come open(), per chi non può usare un blocco `with`: al termine va chiamato doc.release()."""
+        key = normalize_path(path)
+        st = os.stat(path)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.mtime_ns == st.st_mtime_ns and entry.size == st.st_size:
+                self._entries.move_to_end(key)
+            elif entry is not None:
+                logging.debug("Cache documenti: %s modificato su disco, rianalizzo.", path)
+                self._remove(key)
+                entry = None
+        if entry is not None:
+            if entry.acquire():
+                with self._lock:
+                    self.hits += 1
+                logging.debug("Cache documenti: hit per %s", path)
+                return entry
+            # Cambiato tra os.stat e la riapertura, o chiuso da un salvataggio
+            with self._lock:
+                if self._entries.get(key) is entry:
+                    self._remove(key)
+        with self._lock:
+            self.misses += 1
+
+        reader, mapped = open_reader(path)
+        try:
+            entry = CachedDocument(key, st.st_mtime_ns, st.st_size, reader, mapped)
+        except Exception:
+            if mapped is not None:
+                mapped.close()
+            raise
+
+        # Se il file è cambiato durante la lettura, non mettiamo in cache un'analisi incoerente
+        st_after = os.stat(path)
+        if (st_after.st_mtime_ns, st_after.st_size) != (st.st_mtime_ns, st.st_size):
+            logging.debug("Cache documenti: %s modificato durante la lettura, non memorizzato.", path)
+            return entry
+
+        if self.max_entries > 0 and entry.cost <= self.max_bytes:
+            with self._lock:
+                if key in self._entries:
+                    self._remove(key)
+                self._entries[key] = entry
+                self._total_cost += entry.cost
+                self._evict()
+        return entry
+
+    def invalidate(self, path):
+        """Scarta l'entry di `path` (da chiamare dopo ogni scrittura sul file)."""
+        with self._lock:
+            self._remove(normalize_path(path))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._total_cost = 0
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._total_cost -= entry.cost
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_entries or self._total_cost > self.max_bytes):
+            key, entry = self._entries.popitem(last=False)
+            self._total_cost -= entry.cost
+            logging.debug("Cache documenti: scarto %s", key)
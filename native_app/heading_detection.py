@@ -0,0 +1,369 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Proposta automatica dell'outline dai titoli presenti nel testo del PDF.
+
+Per ogni pagina viene estratto il testo con la dimensione effettiva del font
+(righe brevi candidate a titolo e istogramma dei caratteri per dimensione). Le
+pagine vengono elaborate in parallelo su un pool di processi, a blocchi, e il
+risultato di ogni pagina viene salvato in una cache su disco indicizzata
+dall'impronta del suo contenuto: rieseguendo l'analisi dopo una modifica (es.
+l'aggiunta di bookmark, che non tocca le pagine) si estraggono solo le pagine
+nuove o cambiate.
+
+I titoli vengono poi scelti confrontando ogni riga con la dimensione del testo
+normale del documento: righe più grandi (o in grassetto) e brevi, escluse
+intestazioni e piè di pagina ripetuti, ordinate per punteggio e con un livello
+ricavato dalle dimensioni distinte dei titoli.
+"""
+
+import os
+import re
+import json
+import math
+import hashlib
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from document_cache import normalize_path, open_reader
+
+# Da incrementare quando cambia ciò che viene estratto da ogni pagina
+EXTRACTION_VERSION = 1
+CACHE_SUFFIX = ".json"
+
+# Pagine minime per attività inviata al pool (ogni attività riapre il file) e
+# sotto cui l'estrazione resta nel processo corrente
+PAGES_PER_TASK = 16
+PARALLEL_MIN_PAGES = 32
+# Processi del pool e attività per processo, per bilanciare pagine di costo diverso
+POOL_WORKERS = os.cpu_count() or 1
+TASKS_PER_WORKER = 4
+# Righe più lunghe di così non sono titoli e non vengono salvate
+MAX_HEADING_CHARS = 120
+# Rapporto minimo tra dimensione del titolo e del testo normale
+HEADING_SIZE_RATIO = 1.15
+# Una riga presente su più di questa frazione di pagine è un'intestazione o un piè di pagina
+RUNNING_TEXT_RATIO = 0.3
+# Livelli massimi proposti (le dimensioni più piccole confluiscono nell'ultimo)
+MAX_LEVELS = 3
+# Indicatori di grassetto nel nome del font
+_BOLD_RE = re.compile(r"bold|black|heavy|semibold|demi", re.IGNORECASE)
+_DIGITS_RE = re.compile(r"\d+")
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+# --- Estrazione (eseguita nei processi del pool) ---
+
+def page_fingerprint(page):
+    """Impronta del contenuto di una pagina: dati grezzi dei content stream e dimensioni della pagina."""
+    digest = hashlib.sha1(str(EXTRACTION_VERSION).encode("ascii"))
+    digest.update(repr([float(v) for v in page.mediabox]).encode("ascii"))
+    contents = page.get("/Contents")
+    contents = contents.get_object() if contents is not None else None
+    streams = contents if isinstance(contents, list) else [contents] if contents is not None else []
+    for stream in streams:
+        stream = stream.get_object()
+        # Dati ancora codificati: l'impronta non richiede di decomprimere lo stream
+        digest.update(getattr(stream, "_data", b"") or b"")
+    return digest.hexdigest()
+
+
+def _multiply(a, b):
+    return [
+        a[0] * b[0] + a[1] * b[2], a[0] * b[1] + a[1] * b[3],
+        a[2] * b[0] + a[3] * b[2], a[2] * b[1] + a[3] * b[3],
+        a[4] * b[0] + a[5] * b[2] + b[4], a[4] * b[1] + a[5] * b[3] + b[5],
+    ]
+
+
+def _is_bold(font_dict):
+    if not font_dict:
+        return False
+    name = str(font_dict.get("/BaseFont", ""))
+    return bool(_BOLD_RE.search(name))
+
+
+def extract_page(page):
+    """Righe candidate a titolo e istogramma delle dimensioni di una pagina.
+
+    Restituisce {"sizes": {dimensione: caratteri}, "lines": [[testo, dimensione, grassetto, y]]},
+    con `y` la distanza dal bordo superiore in frazione dell'altezza della pagina.
+    """
+    runs = []
+
+    def visitor(text, cm, tm, font_dict, font_size):
+        if not text or not text.strip():
+            return
+        m = _multiply(tm, cm)
+        size = font_size * math.hypot(m[2], m[3])
+        runs.append((text, round(size * 2) / 2, _is_bold(font_dict), m[5]))
+
+    page.extract_text(visitor_text=visitor)
+
+    box = page.mediabox
+    top, height = float(box.top), float(box.height) or 1.0
+    sizes = {}
+    lines = []
+    current = None  # [parti del testo, dimensione, grassetto, y]
+    for text, size, bold, y in runs:
+        sizes[size] = sizes.get(size, 0) + len(text.strip())
+        # Stessa riga se la y coincide entro metà altezza del font
+        if current is not None and abs(current[3] - y) < max(size, current[1]) / 2:
+            current[0].append(text)
+            current[1] = max(current[1], size)
+            current[2] = current[2] and bold
+        else:
+            if current is not None:
+                lines.append(current)
+            current = [[text], size, bold, y]
+    if current is not None:
+        lines.append(current)
+
+    # Le righe normali nella dimensione prevalente della pagina non possono essere titoli: non vengono salvate
+    page_body = max(sizes.items(), key=lambda item: item[1])[0] if sizes else 0
+    candidates = []
+    for parts, size, bold, y in lines:
+        if size <= page_body and not bold:
+            continue
+        text = " ".join("".join(parts).split())
+        if 0 < len(text) <= MAX_HEADING_CHARS:
+            candidates.append([text, size, bold, round(min(max((top - y) / height, 0.0), 1.0), 3)])
+    return {"sizes": {str(size): count for size, count in sizes.items()}, "lines": candidates}
+
+
+def _extract_from_reader(reader, page_numbers):
+    results = []
+    for number in page_numbers:
+        page = reader.pages[number]
+        try:
+            results.append((number, page_fingerprint(page), extract_page(page)))
+        except Exception as e:
+            results.append((number, None, f"{type(e).__name__}: {e}"))
+    return results
+
+
+def extract_pages(path, page_numbers):
+    """Estrae le pagine indicate (nel processo del pool).
+
+    Restituisce una lista di (pagina, impronta, risultato o messaggio di errore).
+    Il file viene chiuso alla fine: una mappa aperta impedirebbe su Windows di
+    sostituirlo al salvataggio successivo.
+    """
+    reader, mapped = open_reader(path)
+    try:
+        return _extract_from_reader(reader, page_numbers)
+    finally:
+        if mapped is not None:
+            mapped.close()
+
+
+def _get_pool():
+    """Pool di processi condiviso, creato alla prima analisi che ne ha bisogno."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn anche su Linux: l'host ha già thread attivi (job, logging) e fork non è sicuro
+            _pool = ProcessPoolExecutor(max_workers=POOL_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+
+def shutdown():
+    """Chiude il pool di processi, se è stato creato."""
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+# --- Cache per pagina ---
+
+class PageTextCache:
+    """Risultati di estrazione per file, indicizzati dall'impronta di ogni pagina, in un JSON per file.
+
+    Oltre `max_files` file o `max_bytes` byte vengono eliminati quelli usati meno di
+    recente (la data di modifica viene aggiornata a ogni lettura riuscita).
+    """
+
+    def __init__(self, directory, max_files=1000, max_bytes=256 * 1024 * 1024):
+        self.directory = directory
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+
+    def _cache_path(self, pdf_path):
+        digest = hashlib.sha1(normalize_path(pdf_path).encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, digest + CACHE_SUFFIX)
+
+    def load(self, pdf_path):
+        cache_path = self._cache_path(pdf_path)
+        try:
+            with open(cache_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logging.warning("Cache del testo di %s non leggibile, la ricostruisco: %s", pdf_path, e)
+            return {}
+        if data.get("version") != EXTRACTION_VERSION or data.get("path") != normalize_path(pdf_path):
+            return {}
+        try:
+            os.utime(cache_path)  # usato di recente: l'ultimo a essere eliminato
+        except OSError:
+            pass
+        return data.get("pages", {})
+
+    def save(self, pdf_path, pages):
+        cache_path = self._cache_path(pdf_path)
+        temp_path = f"{cache_path}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump({"version": EXTRACTION_VERSION, "path": normalize_path(pdf_path), "pages": pages},
+                          f, ensure_ascii=False, separators=(",", ":"))
+            os.replace(temp_path, cache_path)
+        except OSError as e:
+            logging.warning("Impossibile salvare la cache del testo di %s: %s", pdf_path, e)
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            return
+        self._prune()
+
+    def _prune(self):
+        """Elimina i file usati meno di recente oltre `max_files` o `max_bytes` (PDF spostati o cancellati)."""
+        try:
+            files = []
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(CACHE_SUFFIX):
+                    st = entry.stat()
+                    files.append((st.st_mtime, st.st_size, entry.path))
+            total = sum(size for _, size, _ in files)
+            if len(files) <= self.max_files and total <= self.max_bytes:
+                return
+            files.sort()
+            count = len(files)
+            for _, size, path in files:
+                if count <= self.max_files and total <= self.max_bytes:
+                    break
+                os.remove(path)
+                count -= 1
+                total -= size
+        except OSError as e:
+            logging.debug("Pulizia della cache del testo non riuscita: %s", e)
+
+
+def collect_pages(doc, pdf_path, cache, progress):
+    """Risultati di estrazione di tutte le pagine (in ordine), estraendo solo quelle non in cache."""
+    cached = cache.load(pdf_path)
+    fingerprints = [page_fingerprint(page) for page in doc.reader.pages]
+    results = [cached.get(fp) for fp in fingerprints]
+    missing = [i for i, result in enumerate(results) if result is None]
+    total = len(results)
+    done = total - len(missing)
+    progress(stage="extracting", pages_done=done, total_pages=total)
+    if missing:
+        logging.info("Estrazione del testo di %s pagine su %s: %s", len(missing), total, pdf_path)
+        futures = []
+        if len(missing) < PARALLEL_MIN_PAGES or POOL_WORKERS == 1:
+            tasks = [missing[i:i + PAGES_PER_TASK] for i in range(0, len(missing), PAGES_PER_TASK)]
+            batches = (_extract_from_reader(doc.reader, task) for task in tasks)
+        else:
+            pool = _get_pool()
+            size = max(PAGES_PER_TASK, -(-len(missing) // (POOL_WORKERS * TASKS_PER_WORKER)))
+            futures = [pool.submit(extract_pages, pdf_path, missing[i:i + size]) for i in range(0, len(missing), size)]
+            batches = (future.result() for future in as_completed(futures))
+        try:
+            for batch in batches:
+                for number, fingerprint, result in batch:
+                    if isinstance(result, str):
+                        logging.warning("Estrazione del testo fallita a pagina %s: %s", number + 1, result)
+                        result = {"sizes": {}, "lines": []}
+                    else:
+                        cached[fingerprint] = result
+                    results[number] = result
+                done += len(batch)
+                progress(stage="extracting", pages_done=done, total_pages=total)
+        except BaseException:
+            # Annullamento del job o errore: le attività non ancora avviate non servono più
+            for future in futures:
+                future.cancel()
+            raise
+        # Restano in cache solo le pagine del file attuale
+        cache.save(pdf_path, {fp: cached[fp] for fp in set(fingerprints) if fp in cached})
+    return results
+
+
+# --- Scelta dei titoli ---
+
+def _body_size(pages):
+    counts = {}
+    for page in pages:
+        for size, count in page["sizes"].items():
+            counts[size] = counts.get(size, 0) + count
+    if not counts:
+        return None
+    return float(max(counts.items(), key=lambda item: item[1])[0])
+
+
+def _running_key(text):
+    return _DIGITS_RE.sub("#", text.casefold())
+
+
+def rank_headings(pages, limit=None):
+    """Titoli candidati in ordine di documento, al più `limit` scelti per punteggio.
+
+    Ogni candidato è {"bookmark_name", "page" (1-based), "level", "parent", "parent_page",
+    "score", "font_size"}: `bookmark_name`, `page`, `parent` e `parent_page` sono già nel
+    formato di add_bookmarks. Il genitore è indicato da titolo e pagina, perché lo stesso
+    titolo (es. "Introduzione" in ogni capitolo) può comparire più volte.
+    """
+    body = _body_size(pages)
+    if body is None:
+        return []
+
+    # Righe ripetute su molte pagine (intestazioni, piè di pagina, numeri di pagina)
+    occurrences = {}
+    for page in pages:
+        for key in {_running_key(line[0]) for line in page["lines"]}:
+            occurrences[key] = occurrences.get(key, 0) + 1
+    running_limit = max(2, RUNNING_TEXT_RATIO * len(pages))
+
+    candidates = []
+    for number, page in enumerate(pages):
+        for order, (text, size, bold, y) in enumerate(page["lines"]):
+            if size < body * HEADING_SIZE_RATIO and not (bold and size >= body and len(text) <= MAX_HEADING_CHARS // 2):
+                continue
+            if not any(c.isalpha() for c in text) or occurrences[_running_key(text)] > running_limit:
+                continue
+            # Più grande, in grassetto e vicino al bordo superiore: più probabile che sia un titolo
+            score = size / body + (0.2 if bold else 0.0) + 0.1 * (1.0 - y) - len(text) / (4 * MAX_HEADING_CHARS)
+            candidates.append((number, order, text, size, round(score, 3)))
+
+    if limit is not None and len(candidates) > limit:
+        best = sorted(candidates, key=lambda c: -c[4])[:limit]
+        candidates = sorted(best, key=lambda c: (c[0], c[1]))
+
+    heading_sizes = sorted({c[3] for c in candidates}, reverse=True)
+    level_of = {size: min(i, MAX_LEVELS - 1) for i, size in enumerate(heading_sizes)}
+    result = []
+    last_at_level = {}  # livello → (titolo, pagina 1-based) dell'ultimo candidato di quel livello
+    for number, _, text, size, score in candidates:
+        level = level_of[size]
+        parent = next((last_at_level[l] for l in range(level - 1, -1, -1) if l in last_at_level), None)
+        last_at_level[level] = (text, number + 1)
+        for deeper in [l for l in last_at_level if l > level]:
+            del last_at_level[deeper]
+        result.append({
+            "bookmark_name": text,
+            "page": number + 1,
+            "level": level,
+            "parent": parent[0] if parent else None,
+            "parent_page": parent[1] if parent else None,
+            "score": score,
+            "font_size": size,
+        })
+    return result
@@ -0,0 +1,416 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Daemon condiviso dell'host nativo e relativo client.
+
+In modalità daemon un solo processo residente (`native_app.py --daemon`) tiene
+cache dei documenti, pool dei job e modifiche accorpate, e accetta connessioni
+su un socket locale. Il processo avviato dal browser (native_host.py) diventa un
+ponte che inoltra i frame con prefisso di lunghezza tra stdin/stdout e il
+socket, senza importare pypdf: il primo messaggio non paga più l'avvio completo
+dell'host.
+
+Il socket è Unix dove disponibile, altrimenti TCP su 127.0.0.1. Indirizzo, PID
+e un token casuale vengono scritti all'avvio in un file leggibile solo
+dall'utente; ogni client si autentica inviando il token come primo frame. Il
+daemon termina da solo dopo `idle_seconds` senza client connessi.
+
+I messaggi oltre il limite di un frame viaggiano a blocchi (vedi
+chunked_messages): il daemon li ricompone e li spezza, mentre il client
+inoltra i singoli frame senza interpretarli.
+
+Il modulo usa solo la libreria standard, perché lo importa anche il client.
+"""
+
+import os
+import sys
+import json
+import time
+import hmac
+import socket
+import struct
+import logging
+import secrets
+import threading
+
+from chunked_messages import MAX_FRAME_LENGTH, ChunkAssembler, ChunkError, encode_frames
+
+INFO_FILE = "daemon.json"
+LOCK_FILE = "daemon.lock"
+SOCKET_FILE = "daemon.sock"
+# Secondi di attesa del lock quando un altro daemon sta terminando
+LOCK_WAIT_SECONDS = 5.0
+
+_HEADER = struct.Struct("@I")
+
+
+# --- Framing ---
+
+def _recv_exact(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 65536))
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def recv_frame(sock):
+    """Legge un frame (prefisso di lunghezza + corpo). Restituisce None a fine stream."""
+    header = _recv_exact(sock, _HEADER.size)
+    if header is None:
+        return None
+    length = _HEADER.unpack(header)[0]
+    if length > MAX_FRAME_LENGTH:
+        raise ValueError(f"Frame di {length} byte oltre il limite di {MAX_FRAME_LENGTH}.")
+    return _recv_exact(sock, length) if length else b""
+
+
+def send_frame(sock, body):
+    sock.sendall(_HEADER.pack(len(body)) + body)
+
+
+# --- File di stato del daemon ---
+
+def read_info(data_dir):
+    """Indirizzo, PID e token del daemon in esecuzione, o None se non c'è il file."""
+    try:
+        with open(os.path.join(data_dir, INFO_FILE), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_private(path, text):
+    temp_path = path + ".tmp"
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(temp_path, path)
+
+
+class _SingleInstanceLock:
+    """Lock esclusivo su file, rilasciato dal sistema anche se il daemon termina in modo anomalo."""
+
+    def __init__(self, path):
+        self._path = path
+        self._f = None
+
+    def acquire(self):
+        f = open(self._path, "a+")
+        try:
+            if os.name == "nt":
+                import msvcrt
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        self._f = f
+        return True
+
+    def release(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+
+# --- Server ---
+
+class DaemonServer:
+    """Accetta i client sul socket locale e passa ogni messaggio a `handle(message, send)`.
+
+    `handle` restituisce la risposta diretta; `send(message)` invia al client della
+    sessione i messaggi successivi (avanzamento e fine dei job).
+    """
+
+    def __init__(self, handle, data_dir, idle_seconds=600.0):
+        self._handle = handle
+        self.data_dir = data_dir
+        self.idle_seconds = idle_seconds
+        self._sessions = {}  # socket → lock di scrittura
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._last_activity = time.monotonic()
+
+    def broadcast(self, message):
+        """Invia un messaggio a tutti i client connessi (es. esito delle modifiche accorpate)."""
+        with self._lock:
+            sessions = list(self._sessions.items())
+        for sock, write_lock in sessions:
+            self._send(sock, write_lock, message)
+
+    def _send(self, sock, write_lock, message):
+        try:
+            # Un blocco alla volta: i messaggi di altri thread possono inserirsi tra due blocchi
+            for body in encode_frames(json.dumps(message)):
+                with write_lock:
+                    send_frame(sock, body)
+        except OSError as e:
+            # Il client si è disconnesso: la sessione verrà chiusa dal suo thread
+            logging.debug("Invio al client fallito: %s", e)
+
+    def _listen(self):
+        if hasattr(socket, "AF_UNIX") and os.name != "nt":
+            path = os.path.join(self.data_dir, SOCKET_FILE)
+            if os.path.exists(path):
+                os.remove(path)  # residuo di un daemon terminato: il lock garantisce che non sia in uso
+            server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            server.bind(path)
+            os.chmod(path, 0o600)
+            address = {"family": "unix", "address": path}
+        else:
+            server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server.bind(("127.0.0.1", 0))
+            address = {"family": "tcp", "address": list(server.getsockname())}
+        server.listen(16)
+        server.settimeout(1.0)
+        return server, address
+
+    def serve_forever(self, on_start=None, on_stop=None):
+        """Serve i client finché non resta inattivo per `idle_seconds`.
+
+        `on_start()` viene chiamata dopo aver ottenuto il lock di istanza unica e
+        prima di accettare client, `on_stop()` alla fine, ancora con il lock: i
+        servizi (job, recupero dei journal) partono solo nel daemon che vince.
+        Restituisce False senza fare nulla se un altro daemon resta attivo.
+        """
+        os.makedirs(self.data_dir, exist_ok=True)
+        lock = _SingleInstanceLock(os.path.join(self.data_dir, LOCK_FILE))
+        # Un daemon in chiusura tiene il lock ancora per poco: chi lo ha avviato sta già attendendo
+        deadline = time.monotonic() + LOCK_WAIT_SECONDS
+        while not lock.acquire():
+            if time.monotonic() >= deadline:
+                logging.info("Un altro daemon è già attivo, esco.")
+                return False
+            time.sleep(0.05)
+
+        info_path = os.path.join(self.data_dir, INFO_FILE)
+        server = None
+        started = False
+        try:
+            if on_start is not None:
+                on_start()
+            started = True
+            # Stesso token per tutta la vita del daemon: un client che ha letto il file di stato
+            # prima di una ripubblicazione si autentica comunque
+            self._token = secrets.token_hex(32)
+            server = self._publish(info_path)
+            while not self._stopping.is_set():
+                try:
+                    sock, _ = server.accept()
+                except socket.timeout:
+                    if not self._is_idle():
+                        continue
+                    # Prima si ritira l'indirizzo (i nuovi client avvieranno un altro daemon),
+                    # poi si accettano le connessioni già in coda: nessuna viene chiusa senza risposta
+                    self._withdraw(info_path)
+                    late = self._drain(server)
+                    server.close()
+                    server = None
+                    if not late:
+                        break
+                    logging.info("%s client connessi durante la chiusura, il daemon resta attivo.", len(late))
+                    for sock in late:
+                        self._start_session(sock)
+                    server = self._publish(info_path)
+                    continue
+                self._start_session(sock)
+        finally:
+            if server is not None:
+                server.close()
+            self._withdraw(info_path)
+            try:
+                if started and on_stop is not None:
+                    on_stop()
+            finally:
+                lock.release()
+        logging.info("Daemon terminato dopo %.0f secondi di inattività.", self.idle_seconds)
+        return True
+
+    def _publish(self, info_path):
+        server, address = self._listen()
+        _write_private(info_path, json.dumps({**address, "pid": os.getpid(), "token": self._token}))
+        logging.info("Daemon in ascolto su %s (pid %s)", address["address"], os.getpid())
+        return server
+
+    def _withdraw(self, info_path):
+        """Rimuove file di stato e socket Unix di questo daemon: i client non lo trovano più."""
+        info = read_info(self.data_dir)
+        if info is not None and info.get("pid") == os.getpid():
+            os.remove(info_path)
+            if info.get("family") == "unix" and os.path.exists(info["address"]):
+                os.remove(info["address"])
+
+    @staticmethod
+    def _drain(server):
+        """Accetta senza attendere le connessioni già in coda sul socket in ascolto."""
+        server.setblocking(False)
+        late = []
+        while True:
+            try:
+                sock, _ = server.accept()
+            except (BlockingIOError, socket.timeout):
+                return late
+            except OSError as e:
+                logging.debug("Accettazione durante la chiusura fallita: %s", e)
+                return late
+            late.append(sock)
+
+    def _start_session(self, sock):
+        sock.setblocking(True)
+        with self._lock:
+            # La sessione si registra solo dopo il token: fino ad allora il daemon non è inattivo
+            self._last_activity = time.monotonic()
+        threading.Thread(target=self._session, args=(sock,), name="daemon-session", daemon=True).start()
+
+    def _is_idle(self):
+        with self._lock:
+            return not self._sessions and time.monotonic() - self._last_activity >= self.idle_seconds
+
+    def _session(self, sock):
+        try:
+            token = recv_frame(sock)
+            if token is None or not hmac.compare_digest(token, self._token.encode("ascii")):
+                logging.warning("Connessione al daemon rifiutata: token non valido.")
+                return
+        except (OSError, ValueError):
+            return
+
+        write_lock = threading.Lock()
+        with self._lock:
+            self._sessions[sock] = write_lock
+        logging.info("Client connesso al daemon (%s attivi).", len(self._sessions))
+
+        def send(message):
+            self._send(sock, write_lock, message)
+
+        assembler = ChunkAssembler()
+        try:
+            while True:
+                try:
+                    body = recv_frame(sock)
+                except (OSError, ValueError) as e:
+                    logging.error("Lettura dal client fallita: %s", e)
+                    break
+                if body is None:
+                    break
+                try:
+                    message = json.loads(body.decode("utf-8"))
+                except (ValueError, UnicodeDecodeError) as e:
+                    send({"status": "error", "message": f"Messaggio non valido (JSON/UTF-8): {e}"})
+                    continue
+                try:
+                    message = assembler.feed(message)
+                except ChunkError as e:
+                    logging.error("Messaggio a blocchi scartato: %s", e)
+                    send({"status": "error", "message": str(e), "stream": e.stream})
+                    continue
+                if message is not None:
+                    send(self._handle(message, send))
+        finally:
+            with self._lock:
+                self._sessions.pop(sock, None)
+                self._last_activity = time.monotonic()
+            sock.close()
+            logging.info("Client disconnesso dal daemon.")
+
+
+# --- Client ---
+
+def connect(data_dir, timeout=2.0):
+    """Si connette al daemon in esecuzione e si autentica. Solleva OSError se non è raggiungibile."""
+    info = read_info(data_dir)
+    if info is None:
+        raise ConnectionRefusedError("Nessun daemon in esecuzione.")
+    if info["family"] == "unix":
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        address = info["address"]
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        address = tuple(info["address"])
+    try:
+        sock.settimeout(timeout)
+        sock.connect(address)
+        sock.settimeout(None)
+        send_frame(sock, info["token"].encode("ascii"))
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def spawn(command):
+    """Avvia il daemon staccato dal processo corrente (e dal job object del browser su Windows)."""
+    import subprocess
+
+    options = {"stdin": subprocess.DEVNULL, "stdout": subprocess.DEVNULL, "stderr": subprocess.DEVNULL, "close_fds": True}
+    if os.name == "nt":
+        flags = subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP
+        try:
+            # Senza breakaway il browser terminerebbe il daemon insieme all'host che lo ha avviato
+            return subprocess.Popen(command, creationflags=flags | subprocess.CREATE_BREAKAWAY_FROM_JOB, **options)
+        except OSError:
+            return subprocess.Popen(command, creationflags=flags, **options)
+    return subprocess.Popen(command, start_new_session=True, **options)
+
+
+def connect_or_spawn(data_dir, command, wait=10.0):
+    """Connessione al daemon, avviandolo con `command` se non è in esecuzione."""
+    try:
+        return connect(data_dir)
+    except (OSError, ValueError, KeyError):
+        pass
+    spawn(command)
+    deadline = time.monotonic() + wait
+    while True:
+        try:
+            return connect(data_dir)
+        except (OSError, ValueError, KeyError):
+            if time.monotonic() >= deadline:
+                raise
+            time.sleep(0.01)
+
+
+def relay(sock, stdin=None, stdout=None):
+    """Inoltra i frame tra stdin/stdout del browser e il daemon finché uno dei due lati chiude."""
+    stdin = stdin or sys.stdin.buffer
+    stdout = stdout or sys.stdout.buffer
+
+    def upstream():
+        try:
+            while True:
+                header = stdin.read(_HEADER.size)
+                if len(header) < _HEADER.size:
+                    break
+                length = _HEADER.unpack(header)[0]
+                if length > MAX_FRAME_LENGTH:
+                    break
+                body = stdin.read(length)
+                if len(body) < length:
+                    break
+                sock.sendall(header + body)
+        except OSError:
+            pass
+        # Fine sessione del browser: il daemon chiude la connessione dopo le ultime risposte
+        try:
+            sock.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+    threading.Thread(target=upstream, name="relay-stdin", daemon=True).start()
+    try:
+        while True:
+            body = recv_frame(sock)
+            if body is None:
+                break
+            stdout.write(_HEADER.pack(len(body)) + body)
+            stdout.flush()
+    except (OSError, ValueError):
+        pass
+    finally:
+        sock.close()
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Salvataggio incrementale (append-only) degli outline di un PDF.
+
+Invece di riscrivere l'intero documento, in coda al file originale vengono
+aggiunti solo gli oggetti modificati: i nuovi item dell'outline, il dizionario
+/Outlines, il catalogo aggiornato e una nuova sezione xref con trailer /Prev.
+Il costo dipende quindi dalla dimensione dell'outline e non da quella del PDF.
+"""
+
+import io
+import os
+import re
+import logging
+
+from pypdf.generic import (
+    ArrayObject,
+    DictionaryObject,
+    FloatObject,
+    IndirectObject,
+    NameObject,
+    NullObject,
+    NumberObject,
+    StreamObject,
+    create_string_object,
+)
+
+from instrumentation import timed
+
+# Quanti byte in coda al file leggere per trovare 'startxref'
+_TAIL_SIZE = 2048
+_OBJ_HEADER_RE = re.compile(rb"\s*\d+\s+\d+\s+obj\b")
+
+
+def _find_startxref(f, file_size):
+    """Restituisce l'offset indicato dall'ultimo 'startxref' del file, o None."""
+    f.seek(max(0, file_size - _TAIL_SIZE))
+    tail = f.read()
+    pos = tail.rfind(b"startxref")
+    if pos < 0:
+        return None
+    match = re.match(rb"startxref\s+(\d+)", tail[pos:])
+    return int(match.group(1)) if match else None
+
+
+def _xref_kind(f, startxref):
+    """Indica se la xref finale è una tabella classica ('table') o uno stream ('stream')."""
+    f.seek(startxref)
+    head = f.read(64)
+    if head.lstrip().startswith(b"xref"):
+        return "table"
+    if _OBJ_HEADER_RE.match(head):
+        return "stream"
+    return None
+
+
+def check_appendable(reader, pdf_path):
+    """Verifica se il PDF può essere aggiornato in modo incrementale.
+
+    Restituisce (True, tipo_xref) oppure (False, motivo). I file cifrati o con
+    xref non coerente vanno riscritti per intero.
+    """
+    if reader.is_encrypted:
+        return False, "PDF cifrato"
+    if getattr(reader, "xref_index", 0):
+        return False, "tabella xref con indici sfasati"
+    try:
+        file_size = os.path.getsize(pdf_path)
+        with open(pdf_path, "rb") as f:
+            startxref = _find_startxref(f, file_size)
+            if startxref is None or startxref >= file_size:
+                return False, "startxref mancante o non valido"
+            kind = _xref_kind(f, startxref)
+    except OSError as e:
+        return False, f"file non leggibile: {e}"
+    if kind is None:
+        return False, f"startxref ({startxref}) non punta a una sezione xref"
+    return True, kind
+
+
+def _visible_count(node):
+    """Numero di discendenti visibili (regola di /Count per le voci aperte)."""
+    total = 0
+    for child in node.children or ():
+        total += 1
+        if child.is_open:
+            total += _visible_count(child)
+    return total
+
+
+def _fit_entries(fit):
+    typ, args = fit
+    return [NameObject(typ)] + [NullObject() if arg is None else FloatObject(arg) for arg in args]
+
+
+def outline_objects(reader, tree, first_id):
+    """Assegna i numeri di oggetto e costruisce i dizionari dell'albero degli outline.
+
+    Restituisce (riferimento alla radice /Outlines, lista di (numero, oggetto), primo numero libero).
+    """
+    objects = []
+    root_ref = IndirectObject(first_id, 0, None)
+    root = DictionaryObject({NameObject("/Type"): NameObject("/Outlines")})
+    objects.append((first_id, root))
+    next_id = first_id + 1
+
+    # Pila di (nodo genitore, riferimento del genitore, dizionario del genitore)
+    stack = [(tree.root, root_ref, root)]
+    while stack:
+        parent, parent_ref, parent_dict = stack.pop()
+        children = parent.children or ()
+        refs = [IndirectObject(next_id + i, 0, None) for i in range(len(children))]
+        next_id += len(children)
+        for i, node in enumerate(children):
+            item = DictionaryObject()
+            item[NameObject("/Title")] = create_string_object(node.title)
+            item[NameObject("/Parent")] = parent_ref
+            if node.page is not None:
+                page_ref = reader.pages[node.page].indirect_reference
+                item[NameObject("/Dest")] = ArrayObject(
+                    [IndirectObject(page_ref.idnum, page_ref.generation, None)] + _fit_entries(node.fit)
+                )
+            elif node.action is not None:
+                # Azione originale (es. link a un altro file): i riferimenti restano validi nello stesso file
+                key, value = node.action
+                item[NameObject(key)] = value
+            if i > 0:
+                item[NameObject("/Prev")] = refs[i - 1]
+            if i < len(children) - 1:
+                item[NameObject("/Next")] = refs[i + 1]
+            if node.color is not None:
+                item[NameObject("/C")] = ArrayObject([FloatObject(c) for c in node.color])
+            if node.flags:
+                item[NameObject("/F")] = NumberObject(node.flags)
+            if node.children:
+                count = _visible_count(node) if node.is_open else -len(node.children)
+                item[NameObject("/Count")] = NumberObject(count)
+                stack.append((node, refs[i], item))
+            objects.append((refs[i].idnum, item))
+        if refs:
+            parent_dict[NameObject("/First")] = refs[0]
+            parent_dict[NameObject("/Last")] = refs[-1]
+
+    root[NameObject("/Count")] = NumberObject(_visible_count(tree.root))
+    return root_ref, objects, next_id
+
+
+def write_object(buf, idnum, generation, obj):
+    buf.write(f"{idnum} {generation} obj\n".encode("ascii"))
+    obj.write_to_stream(buf)
+    buf.write(b"\nendobj\n")
+
+
+def subsections(numbers):
+    """Raggruppa numeri di oggetto ordinati in sottosezioni contigue (inizio, lunghezza)."""
+    groups = []
+    for num in numbers:
+        if groups and groups[-1][0] + groups[-1][1] == num:
+            groups[-1][1] += 1
+        else:
+            groups.append([num, 1])
+    return groups
+
+
+def _trailer_entries(reader, new_size, prev_xref):
+    trailer = reader.trailer
+    entries = {
+        NameObject("/Size"): NumberObject(new_size),
+        NameObject("/Root"): trailer.raw_get("/Root"),
+        NameObject("/Prev"): NumberObject(prev_xref),
+    }
+    for key in ("/Info", "/ID"):
+        if key in trailer:
+            entries[NameObject(key)] = trailer.raw_get(key)
+    return entries
+
+
+def replacement_objects(reader, tree, first_id=None):
+    """Catalogo aggiornato e oggetti del nuovo outline, numerati da `first_id` (default: /Size del file).
+
+    Restituisce (riferimento del catalogo, catalogo, lista di (numero, oggetto), primo numero libero).
+    """
+    catalog_ref = reader.trailer.raw_get("/Root")
+    catalog = DictionaryObject(reader.trailer["/Root"])
+    if first_id is None:
+        first_id = int(reader.trailer["/Size"])
+    outlines_ref, objects, next_free = outline_objects(reader, tree, first_id)
+    catalog[NameObject("/Outlines")] = outlines_ref
+    return catalog_ref, catalog, objects, next_free
+
+
+def build_outline_update(reader, tree, base_offset, prev_xref, xref_kind):
+    """Costruisce i byte dell'aggiornamento incrementale che sostituisce l'outline.
+
+    `tree` è l'OutlineTree da salvare; `base_offset` è la dimensione attuale del
+    file, a cui verranno accodati i byte restituiti.
+    """
+    catalog_ref, catalog, objects, next_free = replacement_objects(reader, tree)
+
+    buf = io.BytesIO()
+    buf.write(b"\n")
+    offsets = {}
+    offsets[catalog_ref.idnum] = (base_offset + buf.tell(), catalog_ref.generation)
+    write_object(buf, catalog_ref.idnum, catalog_ref.generation, catalog)
+    for idnum, obj in objects:
+        offsets[idnum] = (base_offset + buf.tell(), 0)
+        write_object(buf, idnum, 0, obj)
+
+    if xref_kind == "stream":
+        # Lo stream xref occupa a sua volta un numero di oggetto
+        xref_id = next_free
+        xref_offset = base_offset + buf.tell()
+        offsets[xref_id] = (xref_offset, 0)
+        numbers = sorted(offsets)
+        offset_width = max(4, (xref_offset.bit_length() + 7) // 8)
+        data = b"".join(
+            b"\x01" + offsets[n][0].to_bytes(offset_width, "big") + offsets[n][1].to_bytes(2, "big")
+            for n in numbers
+        )
+        xref = StreamObject()
+        xref.update(_trailer_entries(reader, xref_id + 1, prev_xref))
+        xref[NameObject("/Type")] = NameObject("/XRef")
+        xref[NameObject("/W")] = ArrayObject([NumberObject(1), NumberObject(offset_width), NumberObject(2)])
+        xref[NameObject("/Index")] = ArrayObject(
+            [NumberObject(v) for group in subsections(numbers) for v in group]
+        )
+        xref.set_data(data)
+        write_object(buf, xref_id, 0, xref)
+    else:
+        xref_offset = base_offset + buf.tell()
+        buf.write(b"xref\n")
+        # La prima sottosezione parte sempre dall'oggetto 0 (entry libera), come fanno
+        # gli editor più diffusi: alcuni lettori la usano per verificare l'indicizzazione
+        buf.write(b"0 1\n0000000000 65535 f\r\n")
+        for start, length in subsections(sorted(offsets)):
+            buf.write(f"{start} {length}\n".encode("ascii"))
+            for n in range(start, start + length):
+                offset, generation = offsets[n]
+                buf.write(f"{offset:010d} {generation:05d} n\r\n".encode("ascii"))
+        buf.write(b"trailer\n")
+        DictionaryObject(_trailer_entries(reader, next_free, prev_xref)).write_to_stream(buf)
+        buf.write(b"\n")
+
+    buf.write(f"startxref\n{xref_offset}\n%%EOF\n".encode("ascii"))
+    return buf.getvalue()
+
+
+def append_outline_update(reader, pdf_path, tree, xref_kind, before_write=None):
+    """Accoda al PDF l'aggiornamento dell'outline. Restituisce i byte scritti.
+
+    `before_write()` viene chiamata dopo aver preparato l'aggiornamento, quando il
+    reader non serve più (es. per rilasciare la mappa del file, che su Windows
+    impedirebbe di troncarlo). In caso di errore di scrittura il file viene
+    troncato alla lunghezza originale.
+    """
+    with open(pdf_path, "r+b") as f:
+        f.seek(0, os.SEEK_END)
+        original_size = f.tell()
+        prev_xref = _find_startxref(f, original_size)
+        with timed("serialize"):
+            update = build_outline_update(reader, tree, original_size, prev_xref, xref_kind)
+        if before_write is not None:
+            before_write()
+        try:
+            with timed("commit"):
+                f.seek(original_size)
+                f.write(update)
+                f.flush()
+                os.fsync(f.fileno())
+        except OSError:
+            logging.exception("Scrittura incrementale fallita, ripristino la lunghezza originale di %s", pdf_path)
+            f.truncate(original_size)
+            raise
+    return len(update)
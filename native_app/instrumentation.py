@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Misura dei tempi per fase e logging a basso costo.
+
+Ogni richiesta raccoglie la durata delle sue fasi (analisi, clonazione delle
+pagine, costruzione dell'outline, serializzazione, fsync/rename) in un
+PhaseTimer associato al thread corrente: le funzioni interne segnano le fasi
+con `timed(nome)` senza dover ricevere il timer come parametro, e fuori da una
+richiesta misurata `timed` non fa nulla.
+
+Il logging passa da una coda: i thread che elaborano le richieste accodano solo
+il record, mentre formattazione e scrittura su file (con rotazione per
+dimensione) avvengono nel thread del QueueListener. I tempi per fase vengono
+scritti come record JSON (una riga per richiesta) in un file separato.
+
+Più host possono essere attivi insieme (uno per profilo del browser o per
+porta), e due processi non possono ruotare lo stesso file: su Windows la
+rinomina fallisce finché l'altro lo tiene aperto, su POSIX l'altro continua a
+scrivere nel file rinominato. Ogni processo occupa quindi un "posto" con un
+lock esclusivo e scrive solo nei file di quel posto (`app.log`, `app.1.log`,
+...): i file restano tanti quanti i processi attivi insieme, non uno per PID.
+"""
+
+import os
+import json
+import time
+import queue
+import logging
+import threading
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+# Logger dei record strutturati con i tempi per fase
+TIMINGS_LOGGER = "native_app.timings"
+timings_logger = logging.getLogger(TIMINGS_LOGGER)
+
+LOG_FORMAT = "%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s"
+# Processi che possono scrivere insieme, ciascuno nei file del proprio posto
+MAX_LOG_SLOTS = 16
+
+_local = threading.local()
+
+
+class PhaseTimer:
+    """Durate cumulate per fase (in secondi), nell'ordine in cui le fasi iniziano."""
+
+    __slots__ = ("phases", "_start")
+
+    def __init__(self):
+        self.phases = {}
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+    def as_dict(self):
+        """Tempi in millisecondi, più il totale dall'inizio della misura."""
+        timings = {name: round(seconds * 1000, 3) for name, seconds in self.phases.items()}
+        timings["total"] = round((time.perf_counter() - self._start) * 1000, 3)
+        return timings
+
+
+@contextmanager
+def collect():
+    """Attiva un nuovo PhaseTimer per il thread corrente e lo restituisce."""
+    timer = PhaseTimer()
+    previous = getattr(_local, "timer", None)
+    _local.timer = timer
+    try:
+        yield timer
+    finally:
+        _local.timer = previous
+
+
+@contextmanager
+def timed(name):
+    """Misura il blocco come fase `name` del timer attivo (nessun effetto se non ce n'è uno)."""
+    timer = getattr(_local, "timer", None)
+    if timer is None:
+        yield
+        return
+    with timer.phase(name):
+        yield
+
+
+def write_record(**fields):
+    """Scrive un record JSON-lines con i tempi, se il logger dei tempi è attivo."""
+    if timings_logger.isEnabledFor(logging.INFO):
+        # Il dizionario viene serializzato nel thread del listener (vedi JsonLinesFormatter)
+        timings_logger.info({"ts": round(time.time(), 3), **fields})
+
+
+class JsonLinesFormatter(logging.Formatter):
+    def format(self, record):
+        if isinstance(record.msg, dict):
+            return json.dumps(record.msg, ensure_ascii=False, default=str)
+        return record.getMessage()
+
+
+class _DeferredQueueHandler(QueueHandler):
+    """QueueHandler che rimanda la formattazione al thread del listener.
+
+    Il QueueHandler standard formatta il messaggio nel thread chiamante; qui si
+    converte in testo solo l'eventuale traceback, che non può aspettare.
+    """
+
+    def prepare(self, record):
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class _SlotLock:
+    """Lock esclusivo sul file di un posto, tenuto per tutta la vita del processo."""
+
+    def __init__(self, path):
+        self.path = path
+        self._f = None
+
+    def acquire(self):
+        try:
+            f = open(self.path, "a+")
+        except OSError:
+            return False
+        try:
+            if os.name == "nt":
+                import msvcrt
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        self._f = f
+        return True
+
+    def release(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+
+# Lock del posto occupato da questo processo (rilasciati dal sistema all'uscita)
+_slot_locks = []
+
+
+def slot_path(path, slot):
+    """Percorso di `path` per il posto `slot`: il posto 0 usa il nome originale."""
+    if slot == 0:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.{slot}{ext}"
+
+
+def _claim_slot(paths):
+    """Occupa il primo posto libero per tutti i file in `paths` e ne restituisce il numero.
+
+    Il file dei tempi è condiviso tra host e daemon, che hanno log diversi: un
+    posto vale solo se sono liberi i lock di tutti i suoi file.
+    """
+    for slot in range(MAX_LOG_SLOTS):
+        locks = []
+        for path in paths:
+            lock = _SlotLock(slot_path(path, slot) + ".lock")
+            if not lock.acquire():
+                break
+            locks.append(lock)
+        else:
+            _slot_locks.extend(locks)
+            return slot
+        for lock in locks:
+            lock.release()
+    # Tutti i posti occupati: un nome legato al processo non è condiviso con nessuno
+    return f"pid{os.getpid()}"
+
+
+def setup_logging(log_path, timings_path, level=logging.INFO, max_bytes=5 * 1024 * 1024, backup_count=3):
+    """Configura il logging su coda e avvia il listener. Restituisce il QueueListener (da fermare in uscita).
+
+    I messaggi di livello inferiore a `level` vengono scartati prima di creare il
+    record; i record dei tempi vanno solo in `timings_path`. Se un altro processo
+    occupa già questi file, si usano quelli del primo posto libero (vedi slot_path).
+    """
+    slot = _claim_slot((log_path, timings_path))
+    log_path, timings_path = slot_path(log_path, slot), slot_path(timings_path, slot)
+    log_handler = RotatingFileHandler(log_path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8", delay=True)
+    log_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    log_handler.addFilter(lambda record: record.name != TIMINGS_LOGGER)
+
+    timings_handler = RotatingFileHandler(timings_path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8", delay=True)
+    timings_handler.setFormatter(JsonLinesFormatter())
+    timings_handler.addFilter(lambda record: record.name == TIMINGS_LOGGER)
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_DeferredQueueHandler(log_queue))
+    root.setLevel(level)
+    # I tempi vengono registrati anche quando il log generale è meno verboso
+    timings_logger.setLevel(logging.INFO)
+
+    listener = QueueListener(log_queue, log_handler, timings_handler, respect_handler_level=True)
+    listener.start()
+    return listener
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Coda asincrona delle modifiche ai PDF per l'host persistente.
+
+Le modifiche vengono eseguite come job su un pool di thread: PDF diversi sono
+elaborati in parallelo, mentre i job dello stesso file attendono in una coda
+per file e passano al pool uno alla volta, così non occupano thread del pool
+aspettando il lock del file (che serializza anche le modifiche sincrone).
+Ogni job invia messaggi `progress` e un messaggio finale `done` o `error` con
+il proprio job_id, così stdin resta libero di ricevere `status` e `cancel`
+mentre le scritture lunghe sono in corso.
+"""
+
+import time
+import logging
+import threading
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from document_cache import normalize_path
+
+# Intervallo minimo tra due messaggi di avanzamento dello stesso job (secondi)
+PROGRESS_INTERVAL = 0.2
+
+
+class JobCancelled(Exception):
+    """Sollevata dal callback di avanzamento quando il job è stato annullato."""
+
+
+class FileLocks:
+    """Un lock (rientrante) per ciascun file (percorso normalizzato), creato alla prima richiesta."""
+
+    def __init__(self):
+        self._locks = {}
+        self._guard = threading.Lock()
+
+    def get(self, path):
+        key = normalize_path(path)
+        with self._guard:
+            lock = self._locks.get(key)
+            if lock is None:
+                lock = self._locks[key] = threading.RLock()
+            return lock
+
+
+# Lock condivisi da tutte le modifiche, sincrone o asincrone
+file_locks = FileLocks()
+
+
+class Job:
+    """Stato di un job: queued → running → done / error / cancelled."""
+
+    __slots__ = ("job_id", "action", "path", "request_id", "send", "state", "progress", "result", "cancel_event", "created", "_last_progress")
+
+    def __init__(self, job_id, action, path, request_id=None, send=None):
+        self.job_id = job_id
+        self.action = action
+        self.path = path
+        self.request_id = request_id
+        self.send = send
+        self.state = "queued"
+        self.progress = {}
+        self.result = None
+        self.cancel_event = threading.Event()
+        self.created = time.time()
+        self._last_progress = 0.0
+
+    def describe(self):
+        info = {"job_id": self.job_id, "action": self.action, "file": self.path, "state": self.state}
+        if self.progress:
+            info["progress"] = dict(self.progress)
+        if self.result is not None:
+            info["result"] = self.result
+        return info
+
+
+class JobManager:
+    """Esegue le modifiche come job su un pool di thread e ne riporta l'avanzamento."""
+
+    def __init__(self, send, max_workers=4, keep_finished=100):
+        self._send = send
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="pdf-job")
+        self._jobs = {}
+        self._lock = threading.Lock()
+        # Job in attesa per file (percorso normalizzato): la chiave esiste finché un job del file è nel pool
+        self._waiting = {}
+        self._idle = threading.Condition(self._lock)
+        self._ids = itertools.count(1)
+        self._keep_finished = keep_finished
+
+    def submit(self, action, path, run, request_id=None, send=None):
+        """Accoda un job. `run(progress)` esegue la modifica e restituisce la risposta finale.
+
+        `progress(**info)` aggiorna l'avanzamento (inviato al browser al massimo ogni
+        PROGRESS_INTERVAL secondi, o subito con final=True) e solleva JobCancelled se
+        il job è stato annullato. Il `request_id` della richiesta originale viene
+        riportato nel messaggio finale. I messaggi del job vanno a `send` se indicato
+        (il client che lo ha richiesto), altrimenti alla funzione del manager.
+        Restituisce il Job creato.
+        """
+        job = Job(next(self._ids), action, path, request_id, send or self._send)
+        key = normalize_path(path)
+        with self._lock:
+            self._jobs[job.job_id] = job
+            self._prune()
+            waiting = self._waiting.get(key)
+            if waiting is not None:
+                # Un job dello stesso file è già nel pool: questo parte quando quello termina
+                waiting.append((job, run))
+                run = None
+            else:
+                self._waiting[key] = deque()
+        if run is not None:
+            self._executor.submit(self._run_next, key, job, run)
+        logging.info("Job %s accodato: %s su %s", job.job_id, action, path)
+        return job
+
+    def _run_next(self, key, job, run):
+        """Esegue il job e poi passa al pool il successivo dello stesso file, se c'è."""
+        try:
+            self._run(job, run)
+        finally:
+            with self._lock:
+                waiting = self._waiting[key]
+                if waiting:
+                    job, run = waiting.popleft()
+                else:
+                    del self._waiting[key]
+                    self._idle.notify_all()
+                    job = None
+            if job is not None:
+                self._executor.submit(self._run_next, key, job, run)
+
+    def _run(self, job, run):
+        if job.cancel_event.is_set():
+            self._finish(job, "cancelled", {"status": "error", "message": "Job annullato prima dell'avvio."})
+            return
+
+        def progress(final=False, **info):
+            if job.cancel_event.is_set():
+                raise JobCancelled()
+            job.progress.update(info)
+            now = time.monotonic()
+            if final or now - job._last_progress >= PROGRESS_INTERVAL:
+                job._last_progress = now
+                job.send({"type": "progress", "job_id": job.job_id, **job.progress})
+
+        with file_locks.get(job.path):
+            job.state = "running"
+            try:
+                response = run(progress)
+            except JobCancelled:
+                self._finish(job, "cancelled", {"status": "error", "message": "Job annullato."})
+                return
+            except Exception as e:
+                logging.exception("Errore imprevisto nel job %s: %s", job.job_id, e)
+                response = {"status": "error", "message": f"Errore interno durante il job: {e}"}
+
+        self._finish(job, "done" if response.get("status") == "success" else "error", response)
+
+    def _finish(self, job, state, response):
+        job.state = state
+        job.result = response
+        logging.info("Job %s terminato: %s", job.job_id, state)
+        final = {**response, "type": "error" if state != "done" else "done", "job_id": job.job_id}
+        if job.request_id is not None:
+            final["request_id"] = job.request_id
+        job.send(final)
+
+    def _prune(self):
+        finished = [j for j in self._jobs.values() if j.state in ("done", "error", "cancelled")]
+        for job in finished[:max(0, len(finished) - self._keep_finished)]:
+            del self._jobs[job.job_id]
+
+    def cancel(self, job_id):
+        """Richiede l'annullamento. Le modifiche già confermate su disco non vengono annullate."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None:
+            return None
+        if job.state in ("queued", "running"):
+            job.cancel_event.set()
+        return job
+
+    def status(self, job_id=None):
+        """Stato di un job, o di tutti i job noti se `job_id` è None."""
+        with self._lock:
+            if job_id is None:
+                return [job.describe() for job in self._jobs.values()]
+            job = self._jobs.get(job_id)
+        return job.describe() if job is not None else None
+
+    def shutdown(self):
+        """Attende la fine dei job in corso e di quelli in coda (le modifiche accettate vengono applicate)."""
+        with self._idle:
+            # I job in coda per file vengono passati al pool solo alla fine del precedente
+            while self._waiting:
+                self._idle.wait()
+        self._executor.shutdown(wait=True)
@@ -6,234 +6,772 @@ import json
 import struct
 import os
 import logging
-from pypdf import PdfReader, PdfWriter  # Importa da pypdf
+import threading
+import tempfile
+from pypdf import PdfWriter  # Importa da pypdf
 from pypdf.errors import PdfReadError
-from pypdf.generic import Destination, Fit
+
+import heading_detection
+import host_daemon
+import incremental_update
+import instrumentation
+import streaming_save
+from instrumentation import timed
+from chunked_messages import MAX_FRAME_LENGTH, ChunkAssembler, ChunkError, ChunkedWriter
+from coalescing import EditCoalescer, JournalBusy
+from document_cache import DocumentCache
+from jobs import JobCancelled, JobManager, file_locks
+from heading_detection import PageTextCache
+from outline_index import OutlineIndex
+from outline_snapshots import OutlineSnapshots, content_hash
+from streaming_save import StreamingSaveUnsupported
 
 # --- Configurazione del Logging ---
-# Crea un file di log nella directory home dell'utente per un accesso facile
+# Crea un file di log nella directory home dell'utente per un accesso facile.
+# Il logging viene attivato in __main__ (vedi instrumentation.setup_logging): i
+# messaggi passano da una coda e vengono scritti da un thread dedicato, con
+# rotazione per dimensione. Il livello si può alzare a DEBUG per la diagnostica
+# con la variabile d'ambiente EDGE_PDF_NATIVE_APP_LOG_LEVEL.
 log_file_path = os.path.join(os.path.expanduser("~"), "edge_pdf_native_app.log")
-logging.basicConfig(
-    level=logging.DEBUG,  # Livello minimo di log da registrare (DEBUG è il più verboso)
-    format='%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s',
-    filename=log_file_path,
-    filemode='a',  # 'a' per append (aggiungere al file esistente), 'w' per sovrascrivere
-    encoding='utf-8'
-)
+LOG_LEVEL = os.environ.get("EDGE_PDF_NATIVE_APP_LOG_LEVEL", "INFO").upper()
+LOG_MAX_BYTES = 5 * 1024 * 1024
+LOG_BACKUP_COUNT = 3
+# Il daemon ha un file di log suo. Gli host attivi insieme (uno per profilo o porta)
+# scrivono ciascuno in file propri, edge_pdf_native_app.1.log, ... (vedi instrumentation)
+daemon_log_file_path = os.path.join(os.path.expanduser("~"), "edge_pdf_native_app_daemon.log")
+# Caratteri massimi dei messaggi grezzi riportati nel log a livello DEBUG
+LOG_MESSAGE_PREVIEW = 500
+
+# Directory per i dati dell'applicazione (registro dei journal, indici, ...)
+APP_DATA_DIR = os.path.join(os.path.expanduser("~"), ".edge_pdf_native_app")
+
+# Cache dei documenti analizzati (usata quando l'host serve più messaggi)
+DOCUMENT_CACHE_MAX_ENTRIES = 8
+DOCUMENT_CACHE_MAX_BYTES = 512 * 1024 * 1024
+document_cache = DocumentCache(max_entries=DOCUMENT_CACHE_MAX_ENTRIES, max_bytes=DOCUMENT_CACHE_MAX_BYTES)
+
+# Indice su disco degli outline, per le azioni di sola lettura (get_outline, find_bookmarks, bookmark_exists)
+OUTLINE_INDEX_DIR = os.path.join(APP_DATA_DIR, "outline_index")
+QUERY_ACTIONS = ("get_outline", "find_bookmarks", "bookmark_exists")
+outline_index = OutlineIndex(OUTLINE_INDEX_DIR, document_cache.get)
+
+# Testo estratto per pagina, per suggest_outline (vedi heading_detection)
+PAGE_TEXT_CACHE_DIR = os.path.join(APP_DATA_DIR, "page_text")
+PAGE_TEXT_CACHE_MAX_FILES = 1000
+PAGE_TEXT_CACHE_MAX_BYTES = 256 * 1024 * 1024
+page_text_cache = PageTextCache(PAGE_TEXT_CACHE_DIR, max_files=PAGE_TEXT_CACHE_MAX_FILES, max_bytes=PAGE_TEXT_CACHE_MAX_BYTES)
+
+# Versioni dell'outline per undo/redo (vedi outline_snapshots): solo gli outline, non copie dei file
+SNAPSHOTS_DIR = os.path.join(APP_DATA_DIR, "snapshots")
+SNAPSHOTS_MAX_BYTES = 64 * 1024 * 1024
+SNAPSHOTS_MAX_VERSIONS = 100
+VERSION_ACTIONS = ("undo", "redo", "list_versions")
+outline_snapshots = OutlineSnapshots(SNAPSHOTS_DIR, max_bytes=SNAPSHOTS_MAX_BYTES, max_versions=SNAPSHOTS_MAX_VERSIONS)
+
+# Job asincroni (solo in modalità persistente, vedi serve())
+JOB_WORKERS = 4
+ASYNC_ACTIONS = ("add_bookmark", "add_bookmarks", "suggest_outline", "undo", "redo")
+job_manager = None
+
+# Modifiche sincrone: attesa massima del lock del file prima di rispondere che è occupato,
+# così il ciclo dei messaggi non resta bloccato dietro a un job lungo sullo stesso file
+FILE_LOCK_ACTIONS = ("add_bookmark", "add_bookmarks", "undo", "redo", "flush")
+SYNC_LOCK_TIMEOUT = 1.0
+
+# Accorpamento delle modifiche ravvicinate (messaggi con "coalesce": true, vedi serve())
+COALESCE_ACTIONS = ("add_bookmark", "add_bookmarks")
+COALESCE_IDLE_SECONDS = 3.0
+COALESCE_REGISTRY_PATH = os.path.join(APP_DATA_DIR, "pending_journals.txt")
+coalescer = None
+
+# Modalità daemon (native_app.py --daemon, vedi native_host.py): secondi senza
+# client connessi dopo i quali il daemon termina
+DAEMON_IDLE_SECONDS = float(os.environ.get("EDGE_PDF_NATIVE_APP_DAEMON_IDLE", 600))
+
+# Tempi per fase di ogni richiesta, un record JSON per riga
+TIMINGS_LOG_PATH = os.path.join(APP_DATA_DIR, "timings.jsonl")
 # --- Fine Configurazione ---
 
 
+class MessageDecodeError(Exception):
+    """Il corpo di un messaggio è stato letto per intero ma non è JSON/UTF-8 valido.
+
+    Il framing dello stream è ancora integro, quindi in modalità persistente
+    si può rispondere con un errore e continuare a servire i messaggi successivi.
+    """
+
+
 def read_message():
-    """Legge un messaggio dal browser via stdin secondo il protocollo Native Messaging."""
+    """Legge un messaggio dal browser via stdin secondo il protocollo Native Messaging.
+
+    Restituisce None quando lo stream è stato chiuso dal browser (fine sessione).
+    """
     try:
         # Leggi i primi 4 byte che indicano la lunghezza del messaggio
         raw_length = sys.stdin.buffer.read(4)
         if not raw_length:
-            logging.warning("Nessuna lunghezza letta da stdin (stream chiuso?). Uscita.")
-            sys.exit(0)  # Uscita pulita se lo stream è chiuso
+            logging.info("Stream stdin chiuso dal browser.")
+            return None  # Uscita pulita: il chiamante termina il ciclo
+        if len(raw_length) != 4:
+            logging.error("Prefisso di lunghezza troncato: letti %s bytes, attesi 4.", len(raw_length))
+            sys.exit(1)
 
         # Interpreta i 4 byte come un intero unsigned nativo standard
         message_length = struct.unpack('@I', raw_length)[0]
-        logging.debug(f"Lunghezza messaggio da leggere: {message_length}")
+        logging.debug("Lunghezza messaggio da leggere: %s", message_length)
 
-        # Limite di sicurezza per la dimensione del messaggio (es. 1MB)
-        MAX_MESSAGE_LENGTH = 1 * 1024 * 1024
-        if message_length > MAX_MESSAGE_LENGTH:
-            logging.error(f"Lunghezza messaggio ({message_length}) supera il limite ({MAX_MESSAGE_LENGTH}). Uscita per sicurezza.")
+        # Limite di sicurezza per un singolo frame: i messaggi più grandi arrivano a blocchi (vedi chunked_messages)
+        if message_length > MAX_FRAME_LENGTH:
+            logging.error("Lunghezza messaggio (%s) supera il limite (%s). Uscita per sicurezza.", message_length, MAX_FRAME_LENGTH)
             # Non possiamo inviare risposta se l'input è potenzialmente malizioso
             sys.exit(1)
 
         # Leggi il corpo del messaggio
         message_bytes = sys.stdin.buffer.read(message_length)
         if len(message_bytes) != message_length:
-             logging.error(f"Errore lettura messaggio: letti {len(message_bytes)} bytes, attesi {message_length}.")
+             logging.error("Errore lettura messaggio: letti %s bytes, attesi %s.", len(message_bytes), message_length)
              sys.exit(1)
 
         # Decodifica il messaggio come UTF-8 e poi deserializza JSON
         message_str = message_bytes.decode('utf-8')
-        logging.debug(f"Messaggio grezzo ricevuto: {message_str}")
+        logging.debug("Messaggio grezzo ricevuto: %.*s", LOG_MESSAGE_PREVIEW, message_str)
         return json.loads(message_str)
 
     except struct.error as e:
-        logging.exception(f"Errore unpack lunghezza messaggio: {e}")
+        logging.exception("Errore unpack lunghezza messaggio: %s", e)
         sys.exit(1)
     except (json.JSONDecodeError, UnicodeDecodeError) as e:
-        logging.exception(f"Errore decodifica messaggio (JSON/UTF-8): {e}")
-        sys.exit(1)
+        logging.exception("Errore decodifica messaggio (JSON/UTF-8): %s", e)
+        raise MessageDecodeError(str(e)) from e
     except Exception as e:
-        logging.exception(f"Errore imprevisto durante la lettura del messaggio: {e}")
+        logging.exception("Errore imprevisto durante la lettura del messaggio: %s", e)
         sys.exit(1)
 
 
-def send_message(message_dict):
-    """Invia un messaggio al browser via stdout secondo il protocollo Native Messaging."""
-    try:
-        message_str = json.dumps(message_dict)
-        message_bytes = message_str.encode('utf-8')
-        message_length = len(message_bytes)
+# I job in background e il ciclo principale scrivono su stdout da thread diversi
+_stdout_lock = threading.Lock()
+
 
-        logging.debug(f"Invio messaggio di lunghezza: {message_length}")
+def _write_frame(message_bytes):
+    with _stdout_lock:
         # Scrivi la lunghezza (4 byte, intero unsigned nativo standard)
-        sys.stdout.buffer.write(struct.pack('@I', message_length))
+        sys.stdout.buffer.write(struct.pack('@I', len(message_bytes)))
         # Scrivi il corpo del messaggio
         sys.stdout.buffer.write(message_bytes)
         # Assicura che il messaggio sia inviato immediatamente
         sys.stdout.buffer.flush()
-        logging.debug(f"Risposta inviata: {message_str}")
+
+
+# I messaggi oltre il limite del browser (1 MB) vengono inviati a blocchi
+_stdout_writer = ChunkedWriter(_write_frame)
+
+
+def send_message(message_dict):
+    """Invia un messaggio al browser via stdout secondo il protocollo Native Messaging."""
+    try:
+        message_str = json.dumps(message_dict)
+        logging.debug("Invio messaggio di lunghezza: %s", len(message_str))
+        _stdout_writer.send(message_str)
+        logging.debug("Risposta inviata: %.*s", LOG_MESSAGE_PREVIEW, message_str)
 
     except Exception as e:
         # Se l'invio fallisce, possiamo solo loggare l'errore.
-        logging.exception(f"Errore durante l'invio del messaggio a stdout: {e}")
+        logging.exception("Errore durante l'invio del messaggio a stdout: %s", e)
         # Potrebbe essere che il browser abbia chiuso la connessione.
 
 
 def file_is_pdf(path):
     """Verifica base se il percorso è un file e finisce con .pdf (case-insensitive)."""
     is_pdf = os.path.isfile(path) and path.lower().endswith(".pdf")
-    logging.debug(f"Verifica se è un file PDF valido: '{path}' -> {is_pdf}")
+    logging.debug("Verifica se è un file PDF valido: '%s' -> %s", path, is_pdf)
     return is_pdf
 
 
-# Nota: La gestione degli outline esistenti in pypdf è un po' diversa
-# Questa funzione è semplificata e potrebbe non rilevare tutti i bookmark esistenti
-# su una pagina se sono nidificati in modo complesso.
-def bookmark_exists_on_page(reader: PdfReader, page_zero_indexed: int) -> bool:
-    """Verifica semplificata se esiste già un bookmark che punta alla pagina specificata."""
-    try:
-        for item in reader.outline:
-            # reader.get_destination_page_number(item) può essere complesso
-            # Usiamo un controllo più diretto se disponibile o logghiamo se non riusciamo
-            try:
-                # Il modo diretto per ottenere la pagina da un item outline può variare
-                # Controlliamo se l'item punta direttamente a una pagina
-                page_index = reader.get_page_number(item.page) # Tentativo, potrebbe non funzionare per tutti i tipi di destinazione
-                if page_index == page_zero_indexed:
-                    logging.debug(f"Trovato bookmark esistente per pagina indice {page_zero_indexed}")
-                    return True
-            except Exception:
-                 # Ignora item che non puntano direttamente a pagine o causano errori
-                 pass
-            # Potremmo dover navigare ricorsivamente negli item nidificati,
-            # ma per ora manteniamo semplice.
-    except Exception as e:
-        logging.warning(f"Errore durante la verifica dei bookmark esistenti: {e}")
+# Nota: le pagine dei bookmark sono già risolte nell'albero dell'outline del
+# documento (OutlineTree), quindi vengono considerati anche quelli nidificati.
+def bookmark_exists_on_page(doc, page_zero_indexed: int) -> bool:
+    """Verifica se esiste già un bookmark (a qualsiasi livello) che punta alla pagina specificata."""
+    for node in doc.outline:
+        if node.page == page_zero_indexed:
+            logging.debug("Trovato bookmark esistente per pagina indice %s", page_zero_indexed)
+            return True
     return False
 
-def create_structure(reader, outlines, title, page_index, parent=None, ):
-    if parent is None:
-        page_obj = reader.pages[page_index]
-        new_outline = Destination(title=title, page=page_obj , fit=Fit(fit_type="/Fit"))
-        outlines.append(new_outline)
+def parent_label(parent):
+    """Descrizione del genitore di una entry per i messaggi di errore."""
+    if isinstance(parent, tuple):
+        return f"'{parent[0]}' (pagina {parent[1] + 1})"
+    return f"'{parent}'"
 
-        def get_page_number(dest):
-            try:
-                return reader.get_page_number(dest.page)
-            except Exception:
-                return float("inf")  # Se non si riesce, lo mettiamo in fondo
-
-        # Ordina la lista principale mantenendo l’ordine originale dei nidificati
-        outlines.sort(key=lambda d: get_page_number(d) if isinstance(d, Destination) else float("inf"))
-        return outlines
-    return None
-
-def insert_bookmark(reader: PdfReader, writer: PdfWriter, item, parent=None):
-    """Copia un bookmark esistente in un nuovo writer."""
-    if isinstance(item, list):
-        # Se l'item è una lista, è un bookmark nidificato
-        for sub_item in item:
-            insert_bookmark(reader, writer, sub_item, parent)
-    elif isinstance(item, dict):
-        # Se l'item è un dizionario, è un bookmark semplice
-        page_index = reader.get_page_number(item.page)  # Potrebbe non funzionare per tutti i tipi di destinazione
-        writer.add_outline_item(title=item.title, page_number=page_index, parent=parent)
-
-def add_bookmark_to_pdf(pdf_path, bookmark_title, page_zero_indexed):
-    """Aggiunge un bookmark a un file PDF usando pypdf."""
-    output_path_final = pdf_path
-    output_path_temp = pdf_path.replace(".pdf", "_temp.pdf")
 
-    try:
-        logging.info(f"Tentativo di aggiungere bookmark '{bookmark_title}' a pagina indice {page_zero_indexed} del file: {pdf_path}")
+def merge_bookmarks(doc, tree, entries):
+    """Inserisce più bookmark nell'albero dell'outline in un solo passaggio.
 
-        # Verifica esistenza file sorgente
-        if not os.path.isfile(pdf_path):
-            logging.error(f"File PDF sorgente non trovato: {pdf_path}")
-            return False, f"File non trovato: {pdf_path}"
+    `entries` è una lista di (titolo, indice_pagina_0, genitore): il genitore è None,
+    un titolo (il primo nodo con quel titolo) oppure (titolo, indice_pagina_0), che
+    distingue i titoli ripetuti. Ogni livello toccato viene ordinato al più una volta,
+    poi i nuovi bookmark vengono inseriti per ricerca binaria. Restituisce, per ogni
+    entry, None se inserita oppure il messaggio di errore.
+    """
+    num_pages = doc.num_pages
+    sorted_parents = set()
+    by_key = None  # titolo e (titolo, pagina) → primo nodo, costruito solo se qualche entry ha un genitore
+    errors = []
+    for title, page_index, parent in entries:
+        if not (0 <= page_index < num_pages):
+            errors.append(f"Numero pagina {page_index + 1} non valido. Il PDF ha {num_pages} pagine (da 1 a {num_pages}).")
+            continue
 
-        # Apre il PDF esistente
-        reader = PdfReader(pdf_path)
-        writer = PdfWriter()
+        if parent is None:
+            parent_node = tree.root
+        else:
+            if by_key is None:
+                by_key = {}
+                for node in tree:
+                    by_key.setdefault(node.title, node)
+                    by_key.setdefault((node.title, node.page), node)
+            parent_node = by_key.get(parent)
+            if parent_node is None:
+                errors.append(f"Bookmark genitore {parent_label(parent)} non trovato.")
+                continue
+
+        if id(parent_node) not in sorted_parents:
+            tree.sort_children(parent_node)
+            sorted_parents.add(id(parent_node))
+        node = tree.insert(title, page_index, parent_node)
+        if by_key is not None:
+            by_key.setdefault(title, node)
+            by_key.setdefault((title, page_index), node)
+        errors.append(None)
+
+    return errors
 
-        # Verifica validità numero di pagina
-        num_pages = len(reader.pages)
-        if not (0 <= page_zero_indexed < num_pages):
-            msg = f"Numero pagina {page_zero_indexed + 1} non valido. Il PDF ha {num_pages} pagine (da 1 a {num_pages})."
-            logging.error(msg)
-            return False, msg
 
-        # Clona tutte le pagine dal reader al writer
-        # writer.clone_document_from_reader(reader) # Metodo più moderno se si vogliono copiare anche metadati/outline
-        for page in reader.pages:
+class _ProgressStream:
+    """File di output che riporta al callback di avanzamento i byte scritti."""
+
+    def __init__(self, f, progress):
+        self._f = f
+        self._progress = progress
+        self.bytes_written = 0
+
+    def write(self, data):
+        written = self._f.write(data)
+        self.bytes_written += len(data)
+        self._progress(stage="writing", bytes_written=self.bytes_written)
+        return written
+
+    def __getattr__(self, name):
+        return getattr(self._f, name)
+
+
+def _no_progress(**info):
+    pass
+
+
+def _write_streaming(doc, tree, output_path_temp, progress):
+    """Riscrive il PDF copiando byte per byte gli oggetti invariati. False se il file non lo consente."""
+    try:
+        # Prima di aprire il file di output: i casi non supportati non devono scrivere nulla
+        streaming_save.check_streamable(doc.reader)
+        with open(output_path_temp, "wb", buffering=streaming_save.COPY_CHUNK) as out_f:
+            with timed("serialize"):
+                written = streaming_save.write_rewritten(doc.reader, tree, out_f, progress)
+            with timed("commit"):
+                out_f.flush()
+                os.fsync(out_f.fileno())
+    except StreamingSaveUnsupported as e:
+        logging.info("Copia diretta degli oggetti non possibile (%s), uso PdfWriter.", e)
+        return False
+    logging.info("PDF riscritto copiando gli oggetti invariati (%s bytes).", written)
+    return True
+
+
+def _write_with_pdfwriter(doc, tree, output_path_temp, progress):
+    """Riscrive il PDF clonando le pagine in un PdfWriter (per i file cifrati o non copiabili)."""
+    reader = doc.reader
+    writer = PdfWriter()
+
+    # Clona tutte le pagine dal reader al writer
+    # writer.clone_document_from_reader(reader) # Metodo più moderno se si vogliono copiare anche metadati/outline
+    total_pages = doc.num_pages
+    with timed("clone"):
+        for pages_cloned, page in enumerate(reader.pages, start=1):
              writer.add_page(page)
+             progress(stage="cloning", pages_cloned=pages_cloned, total_pages=total_pages)
 
         # Copia i metadati se presenti
         metadata = reader.metadata
         if metadata:
             writer.add_metadata(metadata)
 
-        # Verifica (semplificata) se esiste già un bookmark sulla pagina
-        # if bookmark_exists_on_page(reader, page_zero_indexed):
-        #     msg = f"Esiste già un bookmark per la pagina {page_zero_indexed + 1}."
-        #     logging.warning(msg)
-        #     # Decidi se questo è un errore o solo un avviso
-        #     # return False, msg # Scommenta per bloccare se esiste già
+    # Inserisce gli outline nel nuovo pdf, preservando la gerarchia
+    with timed("outline_build"):
+        tree.write_to_writer(writer)
 
-        outlines = create_structure(reader, reader.outline, bookmark_title, page_zero_indexed)
+    # Scrive il PDF modificato su un file temporaneo
+    logging.debug("Scrivo modifiche su file temporaneo: %s", output_path_temp)
+    with open(output_path_temp, "wb") as out_f:
+        with timed("serialize"):
+            writer.write(_ProgressStream(out_f, progress))
+        with timed("commit"):
+            out_f.flush()
+            os.fsync(out_f.fileno())
 
-        # Inserisce gli outline nel nuovo pdf
-        insert_bookmark(reader=reader, writer=writer, item=outlines)
 
-        # Aggiunge il nuovo bookmark (outline item)
-        logging.debug(f"Aggiungo bookmark '{bookmark_title}' a pagina indice {page_zero_indexed}")
-        # Il metodo add_outline_item è quello corretto in pypdf > 2.11
-        #writer.add_outline_item(title=bookmark_title, page_number=page_zero_indexed, parent=None)
+def _temp_output_path(pdf_path):
+    """Crea un file temporaneo nella stessa directory del PDF (os.replace resta atomico) e ne restituisce il percorso."""
+    directory, name = os.path.split(os.path.abspath(pdf_path))
+    fd, temp_path = tempfile.mkstemp(prefix=os.path.splitext(name)[0] + "_", suffix="_temp.pdf", dir=directory)
+    os.close(fd)
+    try:
+        # Il file sostituito mantiene i permessi dell'originale (mkstemp crea file accessibili solo all'utente)
+        os.chmod(temp_path, os.stat(pdf_path).st_mode & 0o7777)
+        if os.path.samefile(temp_path, pdf_path):
+            raise OSError(f"Il file temporaneo coincide con il PDF da modificare: {pdf_path}")
+    except OSError:
+        os.remove(temp_path)
+        raise
+    return temp_path
 
-        # Scrive il PDF modificato su un file temporaneo
-        logging.debug(f"Scrivo modifiche su file temporaneo: {output_path_temp}")
-        with open(output_path_temp, "wb") as out_f:
-            writer.write(out_f)
 
-        # Se la scrittura temporanea ha successo, sostituisce il vecchio file modificato (se esiste)
-        # o rinomina il file temporaneo nel nome finale.
-        logging.debug(f"Rinomino {output_path_temp} in {output_path_final}")
-        if os.path.exists(output_path_final):
-            os.remove(output_path_final)
-        os.rename(output_path_temp, output_path_final)
+def _release_document(doc, pdf_path):
+    """Chiude la mappa del file prima di modificarlo. L'analisi esce prima dalla cache:
+    le altre richieste rileggono il file invece di ricevere un reader chiuso."""
+    document_cache.invalidate(pdf_path)
+    doc.close()
 
-        logging.info(f"Bookmark aggiunto con successo. PDF modificato salvato in: {output_path_final}")
-        return True, output_path_final
 
-    except PdfReadError as e:
-        logging.exception(f"Errore lettura PDF (file corrotto o protetto?): {pdf_path} - {e}")
-        return False, f"Errore durante la lettura del PDF: {e}. Il file potrebbe essere corrotto o protetto da password."
-    except Exception as e:
-        logging.exception(f"Errore imprevisto durante l'aggiunta del bookmark: {e}")
+def save_outline(doc, pdf_path, tree, incremental=True, progress=None):
+    """Salva l'albero dell'outline nel PDF e restituisce il percorso del file scritto.
+
+    Se `incremental` è True e il file lo consente, il nuovo outline viene accodato
+    al PDF originale (salvataggio incrementale); altrimenti il file viene riscritto
+    per intero passando da un file temporaneo, copiando direttamente gli oggetti
+    invariati quando possibile. `progress(**info)` riceve pagine clonate e byte
+    scritti; può interrompere il salvataggio sollevando un'eccezione finché il
+    file originale non è stato toccato. `doc` deve essere in uso (vedi
+    DocumentCache.acquire): prima di modificare il file viene tolto dalla cache
+    e la sua mappa viene chiusa.
+    """
+    progress = progress or _no_progress
+    output_path_final = pdf_path
+
+    # Salvataggio incrementale: accoda solo l'outline aggiornato al file originale
+    if incremental:
+        appendable, detail = incremental_update.check_appendable(doc.reader, pdf_path)
+        if appendable:
+            progress(stage="committing", final=True)
+            written = incremental_update.append_outline_update(
+                doc.reader, pdf_path, tree, detail, before_write=lambda: _release_document(doc, pdf_path))
+            logging.info("Outline salvato con salvataggio incrementale (%s bytes accodati): %s", written, output_path_final)
+            return output_path_final
+        logging.info("Salvataggio incrementale non possibile (%s), riscrivo l'intero file.", detail)
+
+    output_path_temp = _temp_output_path(pdf_path)
+    try:
+        if not _write_streaming(doc, tree, output_path_temp, progress):
+            _write_with_pdfwriter(doc, tree, output_path_temp, progress)
+
+        # Ultima occasione per annullare: da qui in poi il file originale viene sostituito
+        progress(stage="committing", final=True)
+
+        # Il file temporaneo (già su disco dopo fsync) sostituisce l'originale in modo atomico
+        logging.debug("Sostituisco %s con %s", output_path_final, output_path_temp)
+        with timed("commit"):
+            # Su Windows un file mappato in memoria non può essere sostituito
+            _release_document(doc, pdf_path)
+            os.replace(output_path_temp, output_path_final)
+            streaming_save.fsync_directory(output_path_final)
+    except Exception:
         # Prova a pulire il file temporaneo se esiste
         if os.path.exists(output_path_temp):
             try:
                 os.remove(output_path_temp)
             except OSError:
-                logging.warning(f"Impossibile rimuovere il file temporaneo: {output_path_temp}")
-        return False, f"Errore interno durante la modifica del PDF: {e}"
+                logging.warning("Impossibile rimuovere il file temporaneo: %s", output_path_temp)
+        raise
+
+    logging.info("PDF modificato salvato in: %s", output_path_final)
+    return output_path_final
+
+
+def add_bookmarks_to_pdf(pdf_path, entries, incremental=True, progress=None, keep_history=True, raise_os_errors=False):
+    """Aggiunge più bookmark a un file PDF con una sola lettura e una sola scrittura.
+
+    `entries` è una lista di (titolo, indice_pagina_0, titolo_genitore o None).
+    Restituisce (successo, percorso_o_errore, errori_per_entry): le entry non valide
+    vengono scartate e riportate, le altre vengono salvate insieme. Le modifiche
+    allo stesso file sono serializzate dal suo lock. Con `keep_history` False non
+    vengono aggiornati l'indice degli outline né la cronologia per undo/redo
+    (modifiche in blocco, vedi bulk_bookmarks). Con `raise_os_errors` gli OSError
+    (file bloccato, disco pieno) vengono sollevati invece di essere riportati, per
+    chi può riprovare più tardi (vedi coalescing).
+    """
+    with file_locks.get(pdf_path):
+        return _add_bookmarks_locked(pdf_path, entries, incremental, progress or _no_progress, keep_history, raise_os_errors)
+
+
+def _add_bookmarks_locked(pdf_path, entries, incremental, progress, keep_history=True, raise_os_errors=False):
+    doc = None
+    try:
+        logging.info("Tentativo di aggiungere %s bookmark al file: %s", len(entries), pdf_path)
+
+        # Verifica esistenza file sorgente
+        if not os.path.isfile(pdf_path):
+            logging.error("File PDF sorgente non trovato: %s", pdf_path)
+            return False, f"File non trovato: {pdf_path}", [None] * len(entries)
+
+        # Apre il PDF esistente (o lo riprende dalla cache se non è cambiato su disco)
+        progress(stage="parsing")
+        with timed("parse"):
+            doc = document_cache.acquire(pdf_path)
+
+        # Verifica (semplificata) se esiste già un bookmark sulla pagina
+        # if bookmark_exists_on_page(doc, page_zero_indexed):
+        #     msg = f"Esiste già un bookmark per la pagina {page_zero_indexed + 1}."
+        #     logging.warning(msg)
+        #     # Decidi se questo è un errore o solo un avviso
+        #     # return False, msg # Scommenta per bloccare se esiste già
+
+        with timed("outline_build"):
+            tree = doc.outline_copy()
+            errors = merge_bookmarks(doc, tree, entries)
+        added = errors.count(None)
+        if added == 0:
+            msg = "Nessun bookmark valido da aggiungere."
+            logging.error(msg)
+            return False, msg, errors
+
+        # Impronta del file prima della modifica: dice se la cronologia delle versioni lo conosce già
+        before_hash = content_hash(pdf_path) if keep_history else None
+        try:
+            output_path = save_outline(doc, pdf_path, tree, incremental, progress)
+        finally:
+            # Il file è stato (o potrebbe essere stato) modificato: l'analisi in cache non è più valida
+            document_cache.invalidate(pdf_path)
+        if keep_history:
+            _after_outline_saved(output_path, doc, tree)
+            try:
+                with timed("snapshot"):
+                    outline_snapshots.record(output_path, doc.outline, before_hash, tree, "add_bookmarks", added)
+            except (OSError, ValueError) as e:
+                logging.warning("Versione dell'outline non registrata per %s (undo non disponibile): %s", output_path, e)
+        logging.info("%s bookmark aggiunti con successo a: %s", added, output_path)
+        return True, output_path, errors
+
+    except JobCancelled:
+        logging.info("Modifica annullata prima del salvataggio: %s", pdf_path)
+        raise
+    except PdfReadError as e:
+        logging.exception("Errore lettura PDF (file corrotto o protetto?): %s - %s", pdf_path, e)
+        return False, f"Errore durante la lettura del PDF: {e}. Il file potrebbe essere corrotto o protetto da password.", [None] * len(entries)
+    except OSError as e:
+        if raise_os_errors:
+            raise
+        logging.exception("Errore imprevisto durante l'aggiunta dei bookmark: %s", e)
+        return False, f"Errore interno durante la modifica del PDF: {e}", [None] * len(entries)
+    except Exception as e:
+        logging.exception("Errore imprevisto durante l'aggiunta dei bookmark: %s", e)
+        return False, f"Errore interno durante la modifica del PDF: {e}", [None] * len(entries)
+    finally:
+        if doc is not None:
+            doc.release()
+
+
+def _after_outline_saved(output_path, doc, tree):
+    try:
+        # L'outline appena scritto è già noto: l'indice non deve rianalizzare il file
+        outline_index.store(output_path, doc.num_pages, tree)
+    except OSError as e:
+        logging.warning("Indice outline non aggiornato per %s: %s", output_path, e)
+
 
+def add_bookmark_to_pdf(pdf_path, bookmark_title, page_zero_indexed, incremental=True, progress=None):
+    """Aggiunge un bookmark a un file PDF usando pypdf."""
+    success, result, errors = add_bookmarks_to_pdf(pdf_path, [(bookmark_title, page_zero_indexed, None)], incremental, progress)
+    if not success and errors[0] is not None:
+        # Riporta il motivo specifico (es. pagina fuori intervallo)
+        return False, errors[0]
+    return success, result
+
+
+def parse_bookmark_params(params):
+    """Valida i parametri di un bookmark (titolo e pagina 1-based).
+
+    Restituisce (titolo, indice_pagina_0, None) oppure (None, None, messaggio_di_errore).
+    """
+    bookmark_name = params.get("bookmark_name")
+    page_one_based = params.get("page") # Numero di pagina dall'utente (1-based)
+
+    if bookmark_name is None or page_one_based is None:
+        logging.error("Parametri mancanti: 'bookmark_name' o 'page'.")
+        return None, None, "Parametri 'bookmark_name' e 'page' necessari per aggiungere un bookmark."
+
+    if not isinstance(bookmark_name, str) or not bookmark_name.strip():
+         logging.error("Nome bookmark non valido: '%s'", bookmark_name)
+         return None, None, "Il nome del bookmark non può essere vuoto."
+
+    try:
+        # Converte la pagina in intero (dall'utente, 1-based)
+        page_one_based_int = int(page_one_based)
+        if page_one_based_int < 1:
+             logging.error("Numero pagina non valido: %s. Deve essere >= 1.", page_one_based_int)
+             return None, None, f"Numero pagina non valido: {page_one_based_int}. Deve essere 1 o maggiore."
+        # Converte in indice 0-based per pypdf
+        page_zero_indexed = page_one_based_int - 1
+    except (ValueError, TypeError):
+        logging.error("Numero pagina non valido: '%s'. Deve essere un intero.", page_one_based)
+        return None, None, f"Il numero di pagina fornito ('{page_one_based}') non è un numero intero valido."
+
+    return bookmark_name.strip(), page_zero_indexed, None
+
+
+def parse_bookmark_entries(bookmarks):
+    """Valida una lista di bookmark {bookmark_name, page, parent?, parent_page?}.
 
-def process_message(message):
-    """Elabora il messaggio ricevuto e determina l'azione da intraprendere."""
+    Con `parent_page` (1-based) il genitore è l'entry (parent, indice_pagina_0),
+    altrimenti il primo bookmark con titolo `parent`. Restituisce (entry_valide, posizioni_nella_lista, risultati): `risultati` ha un
+    elemento per bookmark, già valorizzato con l'errore per quelli scartati.
+    """
+    results = [None] * len(bookmarks)
+    entries = []
+    positions = []
+    for i, entry in enumerate(bookmarks):
+        if not isinstance(entry, dict):
+            results[i] = {"index": i, "status": "error", "message": "Ogni bookmark deve essere un oggetto."}
+            continue
+        bookmark_name, page_zero_indexed, error = parse_bookmark_params(entry)
+        parent = entry.get("parent")
+        if error is None and parent is not None and (not isinstance(parent, str) or not parent.strip()):
+            error = "Il titolo del bookmark genitore deve essere una stringa non vuota."
+        parent_page = entry.get("parent_page")
+        if error is None and parent_page is not None:
+            if parent is None:
+                error = "'parent_page' richiede anche 'parent'."
+            else:
+                _, parent_page, error = parse_bookmark_params({"bookmark_name": parent, "page": parent_page})
+        if error is not None:
+            results[i] = {"index": i, "status": "error", "message": error}
+            continue
+        if parent:
+            parent = parent.strip() if parent_page is None else (parent.strip(), parent_page)
+        entries.append((bookmark_name, page_zero_indexed, parent or None))
+        positions.append(i)
+    return entries, positions, results
+
+
+def _optional_int(params, name, minimum):
+    """Parametro intero facoltativo. Restituisce (valore o None, messaggio_di_errore o None)."""
+    value = params.get(name)
+    if value is None:
+        return None, None
+    try:
+        value = int(value)
+    except (ValueError, TypeError):
+        return None, f"Il parametro '{name}' ('{value}') non è un numero intero valido."
+    if value < minimum:
+        return None, f"Il parametro '{name}' deve essere {minimum} o maggiore."
+    return value, None
+
+
+def process_outline_query(file_directory, action, params):
+    """Azioni di sola lettura sull'outline, servite dall'indice su disco (vedi outline_index).
+
+    - get_outline: voci in pre-ordine con livello e pagina (tutte, oppure al più
+      `limit` a partire da `offset`);
+    - find_bookmarks: voci il cui titolo contiene `query` e/o con pagina tra
+      `first_page` e `last_page` (1-based, inclusi), al più `limit`;
+    - bookmark_exists: se esiste una voce con titolo `bookmark_name` e/o sulla pagina `page`.
+    """
+    ints = {}
+    for name, minimum in (("offset", 0), ("limit", 1), ("first_page", 1), ("last_page", 1), ("page", 1)):
+        ints[name], error = _optional_int(params, name, minimum)
+        if error is not None:
+            return {"status": "error", "message": error}
+    limit = ints["limit"]
+
+    try:
+        with timed("index"):
+            index = outline_index.get(file_directory)
+    except (PdfReadError, OSError) as e:
+        logging.error("Impossibile leggere l'outline di %s: %s", file_directory, e)
+        return {"status": "error", "message": f"Errore durante la lettura del PDF: {e}"}
+
+    if action == "get_outline":
+        offset = ints["offset"] or 0
+        entries = index.outline(offset, limit)
+        response = {"status": "success", "num_pages": index.num_pages, "count": len(index), "outline": entries}
+        if offset + len(entries) < len(index):
+            response["next_offset"] = offset + len(entries)
+        return response
+
+    if action == "find_bookmarks":
+        query = params.get("query")
+        if query is not None and not isinstance(query, str):
+            return {"status": "error", "message": "Il parametro 'query' deve essere una stringa."}
+        if not query and ints["first_page"] is None and ints["last_page"] is None:
+            return {"status": "error", "message": "Specificare 'query' oppure un intervallo di pagine ('first_page', 'last_page')."}
+        matches = index.find(
+            query,
+            ints["first_page"] - 1 if ints["first_page"] is not None else None,
+            ints["last_page"] - 1 if ints["last_page"] is not None else None,
+        )
+        return {
+            "status": "success",
+            "num_pages": index.num_pages,
+            "count": len(matches),
+            "results": [index.describe(i) for i in matches[:limit]],
+        }
+
+    # action == "bookmark_exists"
+    title = params.get("bookmark_name")
+    if title is not None and not isinstance(title, str):
+        return {"status": "error", "message": "Il parametro 'bookmark_name' deve essere una stringa."}
+    title = title.strip() if title else None
+    if title is None and ints["page"] is None:
+        return {"status": "error", "message": "Specificare 'bookmark_name' e/o 'page'."}
+    page = ints["page"] - 1 if ints["page"] is not None else None
+    return {"status": "success", "exists": index.exists(title, page)}
+
+
+def process_version_action(file_directory, action, params, progress=None):
+    """Cronologia delle versioni dell'outline (vedi outline_snapshots).
+
+    - list_versions: versioni registrate, dalla più vecchia, con quella corrente;
+    - undo / redo: riscrive nel file l'outline della versione precedente o
+      successiva (di `steps` posizioni, default 1).
+    """
+    if action == "list_versions":
+        history = outline_snapshots.history(file_directory)
+        versions, current = history["versions"], history["current"]
+        return {
+            "status": "success",
+            "current": current,
+            "can_undo": current > 0,
+            "can_redo": 0 <= current < len(versions) - 1,
+            # Il file non corrisponde più alla versione corrente (modificato da un altro programma)
+            "modified_externally": current >= 0 and versions[current]["file_hash"] != content_hash(file_directory),
+            "versions": [
+                {"version": i, "time": v["time"], "action": v["action"], "bookmarks": v["bookmarks"],
+                 "count": v["count"], "current": i == current}
+                for i, v in enumerate(versions)
+            ],
+        }
+
+    steps, error = _optional_int(params, "steps", 1)
+    if error is not None:
+        return {"status": "error", "message": error}
+    steps = steps or 1
+    # Le modifiche accorpate ancora nel journal fanno parte della cronologia: vanno salvate prima
+    if coalescer is not None:
+        coalescer.flush(file_directory)
+    with file_locks.get(file_directory):
+        return _move_to_version_locked(file_directory, -steps if action == "undo" else steps, progress or _no_progress)
+
+
+def _move_to_version_locked(pdf_path, delta, progress):
+    doc = None
+    try:
+        progress(stage="parsing")
+        with timed("parse"):
+            doc = document_cache.acquire(pdf_path)
+        with timed("snapshot"):
+            # Un outline cambiato fuori dall'host diventa una versione, così l'undo non lo perde
+            history = outline_snapshots.sync(pdf_path, doc.outline)
+        versions, current = history["versions"], history["current"]
+        target = current + delta
+        if current < 0 or not 0 <= target < len(versions):
+            what = "annullare" if delta < 0 else "ripristinare"
+            return {"status": "error", "message": f"Nessuna modifica da {what} per questo file."}
+
+        with timed("outline_build"):
+            tree = outline_snapshots.get(versions[target]["snapshot"], doc.reader, doc.num_pages)
+        try:
+            output_path = save_outline(doc, pdf_path, tree, progress=progress)
+        finally:
+            document_cache.invalidate(pdf_path)
+        _after_outline_saved(output_path, doc, tree)
+        with timed("snapshot"):
+            outline_snapshots.moved_to(history, target, output_path)
+    except JobCancelled:
+        logging.info("Spostamento di versione annullato prima del salvataggio: %s", pdf_path)
+        raise
+    except (PdfReadError, OSError, ValueError) as e:
+        logging.exception("Impossibile ripristinare la versione dell'outline di %s: %s", pdf_path, e)
+        return {"status": "error", "message": f"Errore durante il ripristino della versione: {e}"}
+    finally:
+        if doc is not None:
+            doc.release()
+
+    logging.info("Outline di %s riportato alla versione %s di %s.", output_path, target, len(versions))
+    return {
+        "status": "success",
+        "message": "Modifica annullata." if delta < 0 else "Modifica ripristinata.",
+        "output_file": output_path,
+        "version": target,
+        "can_undo": target > 0,
+        "can_redo": target < len(versions) - 1,
+    }
+
+
+def suggest_outline(file_directory, params, progress=None):
+    """Propone come bookmark i titoli trovati nel testo del PDF (vedi heading_detection).
+
+    Le candidate sono in ordine di documento, al più `limit` scelte per punteggio,
+    e possono essere passate direttamente come `bookmarks` ad add_bookmarks.
+    """
+    progress = progress or _no_progress
+    limit, error = _optional_int(params, "limit", 1)
+    if error is not None:
+        return {"status": "error", "message": error}
+
+    try:
+        with timed("parse"):
+            doc = document_cache.acquire(file_directory)
+        try:
+            with timed("extract"):
+                pages = heading_detection.collect_pages(doc, file_directory, page_text_cache, progress)
+        finally:
+            doc.release()
+    except (PdfReadError, OSError) as e:
+        logging.error("Impossibile estrarre il testo di %s: %s", file_directory, e)
+        return {"status": "error", "message": f"Errore durante la lettura del PDF: {e}"}
+
+    with timed("rank"):
+        candidates = heading_detection.rank_headings(pages, limit)
+    logging.info("Azione 'suggest_outline' completata: %s titoli proposti su %s pagine.", len(candidates), doc.num_pages)
+    return {"status": "success", "num_pages": doc.num_pages, "count": len(candidates), "candidates": candidates}
+
+
+def process_message(message, progress=None):
+    """Elabora il messaggio ricevuto e determina l'azione da intraprendere.
+
+    `progress` è il callback di avanzamento quando il messaggio viene eseguito come job.
+    I tempi di ogni fase vengono registrati in TIMINGS_LOG_PATH e, se il messaggio
+    contiene `"timings": true`, restituiti anche nel campo `timings` della risposta.
+    """
+    with instrumentation.collect() as timer:
+        response = _process_message(message, progress)
+    timings = timer.as_dict()
+    instrumentation.write_record(
+        action=message.get("action"),
+        file=message.get("file_directory"),
+        status=response.get("status"),
+        timings=timings,
+    )
+    if message.get("timings"):
+        response["timings"] = timings
+    return response
+
+
+def _process_message(message, progress):
     file_directory = message.get("file_directory")
     action = message.get("action")
     params = message.get("params", {})
 
-    logging.info(f"Ricevuta richiesta: Azione='{action}', File='{file_directory}', Parametri='{params}'")
+    logging.info("Ricevuta richiesta: Azione='%s', File='%s'", action, file_directory)
+    logging.debug("Parametri: %.*s", LOG_MESSAGE_PREVIEW, params)
 
     # Validazione input base
     if not file_directory or not action:
@@ -245,65 +783,394 @@ def process_message(message):
          return {"status": "error", "message": "'file_directory' e 'action' devono essere stringhe."}
 
     if not file_is_pdf(file_directory):
-        logging.error(f"Il percorso fornito non è un file PDF valido: {file_directory}")
+        logging.error("Il percorso fornito non è un file PDF valido: %s", file_directory)
         return {"status": "error", "message": "Il percorso fornito non è un file o non ha estensione .pdf."}
 
     # Gestione Azioni
     if action == "add_bookmark":
-        bookmark_name = params.get("bookmark_name")
-        page_one_based = params.get("page") # Numero di pagina dall'utente (1-based)
-
-        if bookmark_name is None or page_one_based is None:
-            logging.error("Parametri mancanti per 'add_bookmark': 'bookmark_name' o 'page'.")
-            return {"status": "error", "message": "Parametri 'bookmark_name' e 'page' necessari per aggiungere un bookmark."}
-
-        if not isinstance(bookmark_name, str) or not bookmark_name.strip():
-             logging.error(f"Nome bookmark non valido: '{bookmark_name}'")
-             return {"status": "error", "message": "Il nome del bookmark non può essere vuoto."}
-
-        try:
-            # Converte la pagina in intero (dall'utente, 1-based)
-            page_one_based_int = int(page_one_based)
-            if page_one_based_int < 1:
-                 logging.error(f"Numero pagina non valido: {page_one_based_int}. Deve essere >= 1.")
-                 return {"status": "error", "message": f"Numero pagina non valido: {page_one_based_int}. Deve essere 1 o maggiore."}
-            # Converte in indice 0-based per pypdf
-            page_zero_indexed = page_one_based_int - 1
-        except (ValueError, TypeError):
-            logging.error(f"Numero pagina non valido: '{page_one_based}'. Deve essere un intero.")
-            return {"status": "error", "message": f"Il numero di pagina fornito ('{page_one_based}') non è un numero intero valido."}
+        bookmark_name, page_zero_indexed, error = parse_bookmark_params(params)
+        if error is not None:
+            return {"status": "error", "message": error}
 
         # Chiama la funzione per aggiungere il bookmark
-        success, result = add_bookmark_to_pdf(file_directory, bookmark_name.strip(), page_zero_indexed)
+        success, result = add_bookmark_to_pdf(file_directory, bookmark_name, page_zero_indexed, progress=progress)
 
         if success:
             logging.info("Azione 'add_bookmark' completata con successo.")
             return {"status": "success", "message": "Bookmark aggiunto con successo.", "output_file": result}
         else:
-            logging.error(f"Azione 'add_bookmark' fallita: {result}")
+            logging.error("Azione 'add_bookmark' fallita: %s", result)
             return {"status": "error", "message": result} # 'result' contiene il messaggio di errore
 
+    elif action == "add_bookmarks":
+        bookmarks = params.get("bookmarks")
+        if not isinstance(bookmarks, list) or not bookmarks:
+            logging.error("Parametro 'bookmarks' mancante o vuoto per 'add_bookmarks'.")
+            return {"status": "error", "message": "Il parametro 'bookmarks' deve essere una lista non vuota."}
+
+        # Valida tutte le entry prima di aprire il PDF
+        entries, positions, results = parse_bookmark_entries(bookmarks)
+
+        if entries:
+            success, result, errors = add_bookmarks_to_pdf(file_directory, entries, progress=progress)
+        else:
+            success, result, errors = False, "Nessun bookmark valido da aggiungere.", []
+
+        for i, error in zip(positions, errors):
+            if error is None and success:
+                results[i] = {"index": i, "status": "success"}
+            else:
+                results[i] = {"index": i, "status": "error", "message": error or result}
+
+        added = sum(1 for r in results if r["status"] == "success")
+        if success:
+            logging.info("Azione 'add_bookmarks' completata: %s aggiunti, %s scartati.", added, len(results) - added)
+            return {
+                "status": "success",
+                "message": f"{added} bookmark aggiunti, {len(results) - added} scartati.",
+                "output_file": result,
+                "results": results,
+            }
+        else:
+            logging.error("Azione 'add_bookmarks' fallita: %s", result)
+            return {"status": "error", "message": result, "results": results}
+
+    elif action in QUERY_ACTIONS:
+        return process_outline_query(file_directory, action, params)
+
+    elif action == "suggest_outline":
+        return suggest_outline(file_directory, params, progress)
+
+    elif action in VERSION_ACTIONS:
+        return process_version_action(file_directory, action, params, progress)
+
     else:
-        logging.warning(f"Azione non supportata richiesta: '{action}'")
+        logging.warning("Azione non supportata richiesta: '%s'", action)
         return {"status": "error", "message": f"Azione '{action}' non supportata."}
 
 
+def process_job_control(message):
+    """Gestisce le azioni 'status' e 'cancel' sui job asincroni."""
+    action = message.get("action")
+    job_id = message.get("params", {}).get("job_id")
+
+    if job_manager is None:
+        return {"status": "error", "message": "Nessuna coda di job attiva."}
+
+    if action == "status":
+        if job_id is None:
+            return {"status": "success", "jobs": job_manager.status()}
+        job = job_manager.status(job_id)
+        if job is None:
+            return {"status": "error", "message": f"Job {job_id} non trovato."}
+        return {"status": "success", "job": job}
+
+    # action == "cancel"
+    if job_id is None:
+        return {"status": "error", "message": "Parametro 'job_id' necessario per annullare un job."}
+    job = job_manager.cancel(job_id)
+    if job is None:
+        return {"status": "error", "message": f"Job {job_id} non trovato."}
+    logging.info("Richiesto annullamento del job %s (stato: %s)", job_id, job.state)
+    return {"status": "success", "message": "Annullamento richiesto.", "job": job.describe()}
+
+
+def submit_job(message, request_id, send=None):
+    """Accoda un'azione di modifica come job e restituisce subito la conferma con il job_id."""
+    def run(progress):
+        return process_message(message, progress)
+
+    job = job_manager.submit(message["action"], message["file_directory"], run, request_id, send)
+    return {"status": "accepted", "message": "Modifica accodata.", "job_id": job.job_id}
+
+
+def coalesce_edit(message):
+    """Registra una modifica nel journal del file e la conferma subito; la scrittura avviene dopo."""
+    file_directory = message.get("file_directory")
+    action = message.get("action")
+    params = message.get("params", {})
+
+    if not file_is_pdf(file_directory):
+        return {"status": "error", "message": "Il percorso fornito non è un file o non ha estensione .pdf."}
+
+    if action == "add_bookmark":
+        bookmark_name, page_zero_indexed, error = parse_bookmark_params(params)
+        if error is not None:
+            return {"status": "error", "message": error}
+        entries, positions, results = [(bookmark_name, page_zero_indexed, None)], [0], [None]
+    else:
+        bookmarks = params.get("bookmarks")
+        if not isinstance(bookmarks, list) or not bookmarks:
+            return {"status": "error", "message": "Il parametro 'bookmarks' deve essere una lista non vuota."}
+        entries, positions, results = parse_bookmark_entries(bookmarks)
+
+    # Pagine e genitori si verificano ora: una entry accettata non deve poter fallire al salvataggio
+    try:
+        doc = document_cache.get(file_directory)
+    except Exception as e:
+        logging.exception("Errore lettura PDF durante la validazione: %s", e)
+        return {"status": "error", "message": f"Errore durante la lettura del PDF: {e}"}
+    num_pages = doc.num_pages
+
+    accepted = []
+    titles = None  # titoli utilizzabili come genitore, calcolati solo se servono
+    for i, entry in zip(positions, entries):
+        title, page_index, parent = entry
+        if page_index >= num_pages:
+            results[i] = {"index": i, "status": "error",
+                          "message": f"Numero pagina {page_index + 1} non valido. Il PDF ha {num_pages} pagine (da 1 a {num_pages})."}
+            continue
+        if parent is not None:
+            if titles is None:
+                # Voci dell'outline, modifiche ancora nel journal ed entry precedenti di questa richiesta
+                titles = set()
+                known = [(node.title, node.page) for node in doc.outline]
+                known.extend(pending[:2] for pending in coalescer.pending(file_directory))
+                known.extend(accepted_entry[:2] for accepted_entry in accepted)
+                for known_title, known_page in known:
+                    titles.update((known_title, (known_title, known_page)))
+            if parent not in titles:
+                results[i] = {"index": i, "status": "error", "message": f"Bookmark genitore {parent_label(parent)} non trovato."}
+                continue
+        results[i] = {"index": i, "status": "queued"}
+        accepted.append(entry)
+        if titles is not None:
+            titles.update((title, (title, page_index)))
+
+    if not accepted:
+        message_text = results[0]["message"] if len(results) == 1 else "Nessun bookmark valido da aggiungere."
+        return {"status": "error", "message": message_text, "results": results}
+
+    try:
+        pending = coalescer.add(file_directory, accepted)
+    except JournalBusy:
+        # Le modifiche accorpate del file sono di un altro host attivo: questa viene salvata subito
+        logging.info("Journal di %s in uso da un altro host, applico la modifica senza accorparla.", file_directory)
+        return process_when_file_free(message, process_message)
+    logging.info("%s modifiche registrate nel journal di %s (%s in sospeso)", len(accepted), file_directory, pending)
+    return {
+        "status": "success",
+        "message": "Bookmark registrato, verrà salvato a breve." if len(accepted) == 1 else f"{len(accepted)} bookmark registrati, verranno salvati a breve.",
+        "output_file": file_directory,
+        "pending": pending,
+        "results": results,
+    }
+
+
+def process_flush(message):
+    """Applica subito le modifiche accorpate di un file (o di tutti i file)."""
+    if coalescer is None:
+        return {"status": "error", "message": "Accorpamento delle modifiche non attivo."}
+    outcomes = coalescer.flush(message.get("file_directory") or None)
+    failed = [o for o in outcomes if o["status"] != "success"]
+    return {
+        "status": "error" if failed else "success",
+        "message": f"{len(outcomes)} file aggiornati, {len(failed)} con errori.",
+        "files": outcomes,
+    }
+
+
+def process_when_file_free(message, process):
+    """Esegue `process(message)` con il lock del file, se si libera entro SYNC_LOCK_TIMEOUT.
+
+    Le modifiche sincrone girano sul thread che legge i messaggi (stdin o la
+    sessione del daemon): se un job o un flush sta scrivendo lo stesso file, la
+    richiesta viene respinta come occupata invece di bloccare 'status' e 'cancel'.
+    """
+    file_directory = message.get("file_directory")
+    if not isinstance(file_directory, str) or not file_directory:
+        return process(message)
+    lock = file_locks.get(file_directory)
+    if not lock.acquire(timeout=SYNC_LOCK_TIMEOUT):
+        logging.info("File %s in corso di modifica, richiesta '%s' respinta.", file_directory, message.get("action"))
+        return {
+            "status": "error",
+            "busy": True,
+            "message": "Il file è in corso di modifica: riprova tra poco oppure invia la richiesta con \"async\": true.",
+        }
+    try:
+        return process(message)
+    finally:
+        lock.release()
+
+
+def handle_message(message, send=None):
+    """Elabora un singolo messaggio e restituisce la risposta, riportando il request_id.
+
+    Le azioni di modifica con `"async": true` vengono eseguite come job in background
+    (solo in modalità persistente): la risposta immediata contiene il job_id, seguita
+    da messaggi 'progress' e da un messaggio finale 'done' o 'error'. Con
+    `"coalesce": true` la modifica viene registrata nel journal e salvata insieme
+    alle altre dopo COALESCE_IDLE_SECONDS di inattività (o con l'azione 'flush').
+    `send` invia i messaggi successivi dei job al client che li ha richiesti
+    (in modalità daemon); per default vanno su stdout. Le modifiche sincrone
+    rispondono con `"busy": true` se il file resta occupato oltre SYNC_LOCK_TIMEOUT.
+    """
+    request_id = message.get("request_id") if isinstance(message, dict) else None
+    try:
+        if not isinstance(message, dict):
+            response = {"status": "error", "message": "Il messaggio deve essere un oggetto JSON."}
+        elif message.get("action") in ("status", "cancel"):
+            response = process_job_control(message)
+        elif message.get("action") == "flush":
+            response = process_when_file_free(message, process_flush)
+        elif (message.get("coalesce") and coalescer is not None
+              and message.get("action") in COALESCE_ACTIONS
+              and isinstance(message.get("file_directory"), str)):
+            response = coalesce_edit(message)
+        elif (message.get("async") and job_manager is not None
+              and message.get("action") in ASYNC_ACTIONS
+              and isinstance(message.get("file_directory"), str)):
+            response = submit_job(message, request_id, send)
+        elif message.get("action") in FILE_LOCK_ACTIONS:
+            response = process_when_file_free(message, process_message)
+        else:
+            response = process_message(message)
+    except Exception as e:
+        # Un errore su un messaggio non deve far cadere l'host persistente
+        logging.exception("Errore imprevisto durante l'elaborazione del messaggio: %s", e)
+        response = {
+            "status": "error",
+            "message": f"Errore interno critico nell'applicazione nativa: {e}"
+        }
+    if request_id is not None:
+        response["request_id"] = request_id
+    return response
+
+
+def apply_coalesced_edits(pdf_path, entries):
+    """Applica le modifiche accorpate di un file, registrandone i tempi come le altre richieste."""
+    success, os_error = False, None
+    with instrumentation.collect() as timer:
+        try:
+            success, result, errors = add_bookmarks_to_pdf(pdf_path, entries, raise_os_errors=True)
+        except OSError as e:
+            os_error = e  # errore temporaneo: il coalescer riproverà
+    instrumentation.write_record(
+        action="flush",
+        file=pdf_path,
+        status="success" if success else "error",
+        bookmarks=len(entries),
+        timings=timer.as_dict(),
+    )
+    if os_error is not None:
+        raise os_error
+    return success, result, errors
+
+
+def outline_contains(pdf_path, entries):
+    """True se ogni entry (titolo, pagina) è presente nell'outline del file, contando i duplicati."""
+    remaining = {}
+    for title, page_index, _ in entries:
+        remaining[(title, page_index)] = remaining.get((title, page_index), 0) + 1
+    for node in document_cache.get(pdf_path).outline:
+        key = (node.title, node.page)
+        if remaining.get(key):
+            remaining[key] -= 1
+    return not any(remaining.values())
+
+
+def start_services(send):
+    """Crea la coda dei job e l'accorpamento delle modifiche; `send` riceve le notifiche."""
+    global job_manager, coalescer
+    job_manager = JobManager(send, max_workers=JOB_WORKERS)
+    coalescer = EditCoalescer(
+        apply_coalesced_edits,
+        COALESCE_REGISTRY_PATH,
+        idle_seconds=COALESCE_IDLE_SECONDS,
+        notify=send,
+        is_applied=outline_contains,
+    )
+    # Modifiche rimaste nei journal dopo una chiusura improvvisa
+    coalescer.recover()
+
+
+def stop_services():
+    """Completa le modifiche già accettate prima di uscire."""
+    global job_manager, coalescer
+    coalescer.shutdown()
+    coalescer = None
+    job_manager.shutdown()
+    job_manager = None
+    heading_detection.shutdown()
+
+
+def serve():
+    """Serve i messaggi in arrivo finché il browser non chiude stdin.
+
+    Con chrome.runtime.sendNativeMessage il browser invia un solo messaggio e
+    chiude lo stream; con chrome.runtime.connectNative la porta resta aperta e
+    lo stesso processo serve tutte le richieste, evitando di pagare ogni volta
+    l'avvio dell'interprete e l'import di pypdf. Le modifiche asincrone girano
+    su un pool di thread, così stdin resta reattivo durante le scritture lunghe.
+    I messaggi oltre 1 MB arrivano a blocchi e vengono ricomposti prima di essere elaborati.
+    """
+    start_services(send_message)
+    assembler = ChunkAssembler()
+    served = 0
+    try:
+        while True:
+            try:
+                received_message = read_message()
+            except MessageDecodeError as e:
+                send_message({"status": "error", "message": f"Messaggio non valido (JSON/UTF-8): {e}"})
+                continue
+
+            if received_message is None:
+                break
+
+            try:
+                received_message = assembler.feed(received_message)
+            except ChunkError as e:
+                logging.error("Messaggio a blocchi scartato: %s", e)
+                send_message({"status": "error", "message": str(e), "stream": e.stream})
+                continue
+            if received_message is None:
+                continue  # blocco intermedio
+
+            send_message(handle_message(received_message))
+            served += 1
+    finally:
+        stop_services()
+
+    logging.info("Sessione terminata: %s messaggi elaborati.", served)
+
+
+def serve_daemon():
+    """Modalità daemon: un solo processo serve tutti i client che si connettono al socket locale.
+
+    I client sono i processi native_host.py avviati dal browser. Cache, job e
+    modifiche accorpate sono condivisi tra tutte le finestre e i profili; il
+    daemon termina dopo DAEMON_IDLE_SECONDS senza client connessi.
+    """
+    server = host_daemon.DaemonServer(handle_message, APP_DATA_DIR, idle_seconds=DAEMON_IDLE_SECONDS)
+    # L'esito delle modifiche accorpate va a tutti i client connessi. I servizi partono solo
+    # dopo il lock di istanza unica: un daemon perdente non deve recuperare i journal
+    server.serve_forever(on_start=lambda: start_services(server.broadcast), on_stop=stop_services)
+
+
 # --- Blocco Principale di Esecuzione ---
 if __name__ == '__main__':
+    # Il browser passa come argomenti l'origine dell'estensione (e su Windows
+    # --parent-window): la modalità daemon si riconosce solo dal flag esplicito
+    daemon_mode = "--daemon" in sys.argv[1:]
+    os.makedirs(APP_DATA_DIR, exist_ok=True)
+    log_listener = instrumentation.setup_logging(
+        daemon_log_file_path if daemon_mode else log_file_path,
+        TIMINGS_LOG_PATH,
+        level=getattr(logging, LOG_LEVEL, logging.INFO),
+        max_bytes=LOG_MAX_BYTES,
+        backup_count=LOG_BACKUP_COUNT,
+    )
     logging.info("--- Avvio Native App PDF ---")
     try:
-        # Leggi un singolo messaggio da stdin
-        received_message = read_message()
-
-        if received_message:
-            # Elabora il messaggio
-            response_message = process_message(received_message)
-            # Invia la risposta a stdout
-            send_message(response_message)
-            logging.info("Elaborazione completata, risposta inviata.")
+        if daemon_mode:
+            serve_daemon()
         else:
-             # read_message ha già loggato l'errore o l'uscita pulita
-             logging.warning("Nessun messaggio valido ricevuto o stream chiuso.")
+            serve()
+
+    except KeyboardInterrupt:
+        logging.info("Interruzione richiesta, chiusura.")
 
     except Exception as e:
         # Cattura eccezioni impreviste nel flusso principale
@@ -316,8 +1183,9 @@ if __name__ == '__main__':
             }
             send_message(error_response)
         except Exception as send_e:
-            logging.error(f"Impossibile inviare messaggio di errore critico al browser: {send_e}")
+            logging.error("Impossibile inviare messaggio di errore critico al browser: %s", send_e)
 
     finally:
         logging.info("--- Chiusura Native App PDF ---")
-        logging.shutdown() # Assicura che tutti i log siano scritti prima di uscire
\ No newline at end of file
+        log_listener.stop()  # Svuota la coda dei log
+        logging.shutdown() # Assicura che tutti i log siano scritti prima di uscire
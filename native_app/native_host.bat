@@ -0,0 +1,9 @@
+@echo off
+REM Modalita' daemon: host leggero che inoltra i messaggi al daemon condiviso
+REM (avviato automaticamente alla prima connessione).
+REM Lancia lo script Python usando l'interprete python.
+REM Assicurati che 'python' sia nel tuo PATH di sistema
+REM o fornisci il percorso completo a python.exe.
+REM "%~dp0" espande al percorso della directory dove si trova questo file .bat
+
+python "%~dp0native_host.py" 
@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Host nativo leggero per la modalità daemon.
+
+Si connette al daemon condiviso (avviandolo se non è in esecuzione) e inoltra i
+frame del protocollo Native Messaging tra il browser e il daemon. Non importa
+pypdf né il resto dell'applicazione, quindi parte in pochi millisecondi. Se il
+daemon non può essere avviato, esegue l'host completo in questo processo.
+
+Per attivare la modalità daemon, il manifest dell'host nativo deve puntare a
+native_host.bat invece che a native_app.bat.
+"""
+
+import os
+import sys
+
+import host_daemon
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+# Stessa directory di native_app.APP_DATA_DIR
+APP_DATA_DIR = os.path.join(os.path.expanduser("~"), ".edge_pdf_native_app")
+NATIVE_APP_SCRIPT = os.path.join(_HERE, "native_app.py")
+DAEMON_COMMAND = [sys.executable, NATIVE_APP_SCRIPT, "--daemon"]
+
+
+def main():
+    try:
+        sock = host_daemon.connect_or_spawn(APP_DATA_DIR, DAEMON_COMMAND)
+    except (OSError, ValueError, KeyError) as e:
+        sys.stderr.write(f"Daemon non disponibile ({e}), avvio l'host completo.\n")
+        import runpy
+        runpy.run_path(NATIVE_APP_SCRIPT, run_name="__main__")
+        return
+    host_daemon.relay(sock)
+
+
+if __name__ == "__main__":
+    main()
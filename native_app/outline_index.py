@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Indice persistente degli outline per le azioni di sola lettura.
+
+Le azioni get_outline, find_bookmarks e bookmark_exists non devono rianalizzare
+il PDF a ogni apertura del popup: per ogni file l'indice conserva numero di
+pagine e voci dell'outline (titolo, pagina, livello, genitore) in un piccolo
+file JSON sotto la directory dei dati dell'applicazione. Il file di indice è
+valido finché mtime e dimensione del PDF non cambiano; altrimenti viene
+ricostruito dal documento analizzato (vedi DocumentCache). Dopo ogni modifica
+fatta dall'host l'indice viene riscritto direttamente dall'albero salvato.
+
+Le voci sono memorizzate in pre-ordine come liste parallele, così il caricamento
+è una sola lettura JSON anche per outline con decine di migliaia di voci.
+"""
+
+import os
+import json
+import bisect
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from document_cache import normalize_path
+
+# Da incrementare quando cambia il formato dei file di indice
+INDEX_VERSION = 1
+INDEX_SUFFIX = ".json"
+
+
+class OutlineIndexEntry:
+    """Outline di un PDF in pre-ordine: `parents[i]` è la posizione del genitore (-1 per il primo livello)."""
+
+    __slots__ = ("path", "mtime_ns", "size", "num_pages", "titles", "pages", "parents", "_levels", "_folded", "_by_page")
+
+    def __init__(self, path, mtime_ns, size, num_pages, titles, pages, parents):
+        self.path = path
+        self.mtime_ns = mtime_ns
+        self.size = size
+        self.num_pages = num_pages
+        self.titles = titles
+        self.pages = pages
+        self.parents = parents
+        # Calcolati alla prima ricerca che li usa
+        self._levels = None
+        self._folded = None
+        self._by_page = None
+
+    def __len__(self):
+        return len(self.titles)
+
+    @classmethod
+    def from_tree(cls, path, st, num_pages, tree):
+        titles, pages, parents = [], [], []
+        position = {}
+        for node in tree:
+            position[id(node)] = len(titles)
+            titles.append(node.title)
+            pages.append(node.page)
+            parents.append(position.get(id(node.parent), -1))
+        return cls(path, st.st_mtime_ns, st.st_size, num_pages, titles, pages, parents)
+
+    @classmethod
+    def from_json(cls, data):
+        if data.get("version") != INDEX_VERSION:
+            raise ValueError(f"versione dell'indice {data.get('version')} non supportata")
+        entry = cls(data["path"], data["mtime_ns"], data["size"], data["num_pages"],
+                    data["titles"], data["pages"], data["parents"])
+        if not (len(entry.titles) == len(entry.pages) == len(entry.parents)):
+            raise ValueError("liste dell'indice di lunghezza diversa")
+        return entry
+
+    def to_json(self):
+        return {
+            "version": INDEX_VERSION,
+            "path": self.path,
+            "mtime_ns": self.mtime_ns,
+            "size": self.size,
+            "num_pages": self.num_pages,
+            "titles": self.titles,
+            "pages": self.pages,
+            "parents": self.parents,
+        }
+
+    def matches_stat(self, st):
+        return self.mtime_ns == st.st_mtime_ns and self.size == st.st_size
+
+    # --- Interrogazioni ---
+
+    def levels(self):
+        """Profondità di ogni voce (0 per il primo livello)."""
+        if self._levels is None:
+            levels = []
+            for parent in self.parents:
+                levels.append(levels[parent] + 1 if parent >= 0 else 0)
+            self._levels = levels
+        return self._levels
+
+    def describe(self, i):
+        """Voce `i` come inviata all'estensione (pagina 1-based, None se non risolvibile)."""
+        page = self.pages[i]
+        return {"title": self.titles[i], "page": page + 1 if page is not None else None, "level": self.levels()[i]}
+
+    def outline(self, offset=0, limit=None):
+        """Voci in pre-ordine con il loro livello, a partire da `offset`."""
+        end = len(self.titles) if limit is None else min(len(self.titles), offset + limit)
+        return [self.describe(i) for i in range(offset, end)]
+
+    def _on_pages(self, first_page, last_page):
+        """Posizioni (in pre-ordine) delle voci con pagina tra `first_page` e `last_page` (0-based, inclusi)."""
+        if self._by_page is None:
+            self._by_page = sorted((page, i) for i, page in enumerate(self.pages) if page is not None)
+        start = bisect.bisect_left(self._by_page, (first_page, -1))
+        end = bisect.bisect_right(self._by_page, (last_page, len(self.titles)))
+        return sorted(i for _, i in self._by_page[start:end])
+
+    def find(self, text=None, first_page=None, last_page=None):
+        """Posizioni delle voci il cui titolo contiene `text` (senza distinzione di maiuscole)
+        e la cui pagina è nell'intervallo dato (0-based, estremi inclusi)."""
+        if first_page is not None or last_page is not None:
+            candidates = self._on_pages(
+                first_page if first_page is not None else 0,
+                last_page if last_page is not None else self.num_pages,
+            )
+        else:
+            candidates = range(len(self.titles))
+        if not text:
+            return list(candidates)
+        if self._folded is None:
+            self._folded = [title.casefold() for title in self.titles]
+        text = text.casefold()
+        folded = self._folded
+        return [i for i in candidates if text in folded[i]]
+
+    def exists(self, title=None, page=None):
+        """True se c'è una voce con il titolo esatto e/o sulla pagina (0-based) indicati."""
+        if page is not None:
+            candidates = self._on_pages(page, page)
+        else:
+            candidates = range(len(self.titles))
+        return any(title is None or self.titles[i] == title for i in candidates)
+
+
+class OutlineIndex:
+    """Indici degli outline su disco, con una piccola cache LRU in memoria.
+
+    `load_document(path)` restituisce il documento analizzato (con `outline` e
+    `num_pages`) quando l'indice va ricostruito.
+    """
+
+    def __init__(self, directory, load_document, max_memory_entries=32, max_files=1000):
+        self.directory = directory
+        self._load_document = load_document
+        self.max_memory_entries = max_memory_entries
+        self.max_files = max_files
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _index_path(self, key):
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, digest + INDEX_SUFFIX)
+
+    def get(self, path):
+        """Restituisce l'OutlineIndexEntry aggiornato di `path`, ricostruendolo se il file è cambiato."""
+        key = normalize_path(path)
+        st = os.stat(path)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.matches_stat(st):
+                self._entries.move_to_end(key)
+                return entry
+
+        entry = self._read(key)
+        if entry is not None and entry.matches_stat(st):
+            self._remember(key, entry)
+            return entry
+
+        logging.debug("Indice outline assente o non aggiornato per %s, lo ricostruisco.", path)
+        doc = self._load_document(path)
+        entry = OutlineIndexEntry.from_tree(key, st, doc.num_pages, doc.outline)
+        # Come nella cache dei documenti: un'analisi fatta mentre il file cambiava non va salvata
+        st_after = os.stat(path)
+        if entry.matches_stat(st_after):
+            self._write(key, entry)
+            self._remember(key, entry)
+        return entry
+
+    def store(self, path, num_pages, tree):
+        """Aggiorna l'indice di `path` con l'albero appena salvato, senza rianalizzare il file."""
+        key = normalize_path(path)
+        entry = OutlineIndexEntry.from_tree(key, os.stat(path), num_pages, tree)
+        self._write(key, entry)
+        self._remember(key, entry)
+
+    def _remember(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_memory_entries:
+                self._entries.popitem(last=False)
+
+    def _read(self, key):
+        try:
+            with open(self._index_path(key), "r", encoding="utf-8") as f:
+                entry = OutlineIndexEntry.from_json(json.load(f))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.warning("Indice outline di %s non leggibile, lo ricostruisco: %s", key, e)
+            return None
+        # Due percorsi con lo stesso hash non devono condividere l'indice
+        return entry if entry.path == key else None
+
+    def _write(self, key, entry):
+        index_path = self._index_path(key)
+        temp_path = f"{index_path}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(entry.to_json(), f, ensure_ascii=False, separators=(",", ":"))
+            os.replace(temp_path, index_path)
+        except OSError as e:
+            # L'indice è solo un'accelerazione: si riproverà alla prossima richiesta
+            logging.warning("Impossibile salvare l'indice outline di %s: %s", key, e)
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            return
+        self._prune()
+
+    def _prune(self):
+        """Elimina gli indici scritti meno di recente oltre `max_files` (PDF spostati o cancellati)."""
+        try:
+            files = [e for e in os.scandir(self.directory) if e.name.endswith(INDEX_SUFFIX)]
+            if len(files) <= self.max_files:
+                return
+            files.sort(key=lambda e: e.stat().st_mtime)
+            for e in files[:len(files) - self.max_files]:
+                os.remove(e.path)
+        except OSError as e:
+            logging.debug("Pulizia degli indici outline non riuscita: %s", e)
@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Versioni dell'outline dei PDF modificati, per undo e redo.
+
+Invece di conservare copie intere dei file, ogni modifica registra solo
+l'outline risultante: l'albero serializzato (titoli, pagine, gerarchia, fit,
+stile e azioni originali) viene compresso e salvato in un archivio indicizzato
+per contenuto (SHA-256), quindi outline identici occupano spazio una sola volta.
+Per ogni PDF una cronologia elenca le versioni (snapshot, impronta del file,
+ora, azione) e la posizione corrente: undo e redo riscrivono nel file l'outline
+di un'altra versione, con lo stesso salvataggio usato per le modifiche.
+
+L'impronta del file (dimensione e hash del primo e dell'ultimo blocco) permette
+di riconoscere una modifica fatta fuori dall'host: in quel caso l'outline
+attuale viene registrato come nuova versione prima di tornare indietro.
+
+L'archivio ha un limite di dimensione: quando viene superato si eliminano le
+versioni più vecchie e gli snapshot non più usati da nessuna cronologia.
+"""
+
+import io
+import os
+import json
+import time
+import zlib
+import hashlib
+import logging
+import threading
+
+from pypdf.generic import read_object
+
+from document_cache import normalize_path
+from jobs import file_locks
+from outline_tree import OutlineNode, OutlineTree
+
+SNAPSHOT_VERSION = 1
+OBJECTS_DIR = "objects"
+HISTORY_DIR = "history"
+OBJECT_SUFFIX = ".json.z"
+# Byte letti all'inizio e alla fine del file per la sua impronta
+CONTENT_HASH_BLOCK = 64 * 1024
+# Gli snapshot scritti (o riutilizzati) da poco non vengono eliminati: un altro
+# processo potrebbe non aver ancora salvato la cronologia che li usa
+GC_GRACE_SECONDS = 300
+
+
+def content_hash(path):
+    """Impronta del file: dimensione e SHA-256 del primo e dell'ultimo blocco.
+
+    Ogni salvataggio (incrementale o completo) cambia la coda del file, quindi
+    basta a riconoscere la versione senza leggere file da centinaia di MB.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        digest.update(str(size).encode("ascii"))
+        digest.update(f.read(CONTENT_HASH_BLOCK))
+        if size > CONTENT_HASH_BLOCK:
+            f.seek(max(CONTENT_HASH_BLOCK, size - CONTENT_HASH_BLOCK))
+            digest.update(f.read(CONTENT_HASH_BLOCK))
+    return digest.hexdigest()
+
+
+# --- Serializzazione dell'albero ---
+
+def _serialize_action(action):
+    if action is None:
+        return None
+    key, value = action
+    buf = io.BytesIO()
+    value.write_to_stream(buf)
+    return [key, buf.getvalue().decode("latin-1")]
+
+
+def serialize_tree(tree):
+    """Byte canonici (JSON) dell'albero: una voce per nodo in pre-ordine, con la posizione del genitore."""
+    nodes = []
+    position = {id(tree.root): -1}
+    for node in tree:
+        position[id(node)] = len(nodes)
+        typ, args = node.fit
+        nodes.append([
+            node.title,
+            node.page,
+            position[id(node.parent)],
+            node.is_open,
+            [typ, list(args)],
+            list(node.color) if node.color is not None else None,
+            node.flags,
+            _serialize_action(node.action),
+        ])
+    return json.dumps({"v": SNAPSHOT_VERSION, "nodes": nodes}, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def deserialize_tree(data, reader, num_pages):
+    """Ricostruisce l'OutlineTree. Le azioni originali vengono rilette nel contesto di `reader`;
+    le pagine che non esistono più nel documento restano senza destinazione."""
+    payload = json.loads(data.decode("utf-8"))
+    if payload.get("v") != SNAPSHOT_VERSION:
+        raise ValueError(f"versione dello snapshot {payload.get('v')} non supportata")
+    tree = OutlineTree()
+    nodes = []
+    for title, page, parent, is_open, fit, color, flags, action in payload["nodes"]:
+        if page is not None and not (0 <= page < num_pages):
+            page = None
+        if action is not None:
+            action = (action[0], read_object(io.BytesIO(action[1].encode("latin-1")), reader))
+        node = OutlineNode(
+            title,
+            page=page,
+            fit=(fit[0], tuple(fit[1])),
+            parent=nodes[parent] if parent >= 0 else tree.root,
+            is_open=is_open,
+            color=tuple(color) if color is not None else None,
+            flags=flags,
+            action=action,
+        )
+        tree.append(node)
+        nodes.append(node)
+    return tree
+
+
+class OutlineSnapshots:
+    """Archivio degli snapshot e cronologia delle versioni di ogni file.
+
+    Le cronologie vanno lette e modificate con il lock del file (vedi jobs.file_locks);
+    la pulizia riscrive quelle degli altri file solo se il loro lock è libero.
+    """
+
+    def __init__(self, directory, max_bytes=64 * 1024 * 1024, max_versions=100):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_versions = max_versions
+        self._objects_dir = os.path.join(directory, OBJECTS_DIR)
+        self._history_dir = os.path.join(directory, HISTORY_DIR)
+        self._lock = threading.Lock()
+        self._stored_bytes = None  # calcolato alla prima scrittura
+
+    # --- Snapshot ---
+
+    def _object_path(self, digest):
+        return os.path.join(self._objects_dir, digest + OBJECT_SUFFIX)
+
+    def put(self, tree):
+        """Salva l'albero (se non è già presente) e ne restituisce l'hash."""
+        data = serialize_tree(tree)
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._object_path(digest)
+        if os.path.exists(path):
+            # Già presente: aggiorna solo la data, che protegge lo snapshot dalla pulizia
+            os.utime(path)
+            return digest
+        os.makedirs(self._objects_dir, exist_ok=True)
+        compressed = zlib.compress(data, 6)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(compressed)
+        os.replace(temp_path, path)
+        with self._lock:
+            if self._stored_bytes is not None:
+                self._stored_bytes += len(compressed)
+        return digest
+
+    def get(self, digest, reader, num_pages):
+        with open(self._object_path(digest), "rb") as f:
+            return deserialize_tree(zlib.decompress(f.read()), reader, num_pages)
+
+    # --- Cronologia ---
+
+    def _history_path(self, key):
+        return os.path.join(self._history_dir, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".json")
+
+    def history(self, path):
+        """Cronologia di `path`: {"path", "versions": [...], "current": posizione o -1}."""
+        key = normalize_path(path)
+        try:
+            with open(self._history_path(key), "r", encoding="utf-8") as f:
+                history = json.load(f)
+            if history.get("path") == key:
+                return history
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logging.warning("Cronologia delle versioni di %s non leggibile, la ricomincio: %s", path, e)
+        return {"path": key, "versions": [], "current": -1}
+
+    def _save_history(self, history):
+        os.makedirs(self._history_dir, exist_ok=True)
+        history_path = self._history_path(history["path"])
+        temp_path = f"{history_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(history, f, ensure_ascii=False)
+        os.replace(temp_path, history_path)
+
+    def _append(self, history, tree, file_hash, action, count):
+        # Una nuova modifica dopo un undo scarta le versioni successive (come in un editor)
+        del history["versions"][history["current"] + 1:]
+        history["versions"].append({
+            "snapshot": self.put(tree),
+            "file_hash": file_hash,
+            "time": round(time.time(), 3),
+            "action": action,
+            "bookmarks": len(tree),
+            "count": count,
+        })
+        excess = len(history["versions"]) - self.max_versions
+        if excess > 0:
+            del history["versions"][:excess]
+        history["current"] = len(history["versions"]) - 1
+
+    def record(self, path, before_tree, before_hash, after_tree, action, count=None):
+        """Registra una modifica: l'outline prima (se la cronologia non lo conosce già) e dopo il salvataggio."""
+        history = self.history(path)
+        versions = history["versions"]
+        if history["current"] < 0 or versions[history["current"]]["file_hash"] != before_hash:
+            # Prima modifica registrata o file cambiato fuori dall'host: serve lo stato di partenza
+            self._append(history, before_tree, before_hash, "original" if not versions else "external", None)
+        self._append(history, after_tree, content_hash(path), action, count)
+        self._save_history(history)
+        self._maybe_collect()
+
+    def sync(self, path, tree):
+        """Se il file non corrisponde alla versione corrente, registra il suo outline come nuova versione.
+
+        Da chiamare prima di undo/redo, così le modifiche esterne non vanno perse. Restituisce la cronologia.
+        """
+        history = self.history(path)
+        file_hash = content_hash(path)
+        if history["current"] >= 0 and history["versions"][history["current"]]["file_hash"] != file_hash:
+            self._append(history, tree, file_hash, "external", None)
+            self._save_history(history)
+        return history
+
+    def moved_to(self, history, position, path):
+        """Segna `position` come versione corrente, ora scritta nel file `path`."""
+        history["versions"][position]["file_hash"] = content_hash(path)
+        history["current"] = position
+        self._save_history(history)
+
+    # --- Pulizia ---
+
+    def _scan_objects(self):
+        try:
+            return [(e.path, e.stat()) for e in os.scandir(self._objects_dir) if e.name.endswith(OBJECT_SUFFIX)]
+        except FileNotFoundError:
+            return []
+
+    def _maybe_collect(self):
+        with self._lock:
+            if self._stored_bytes is None:
+                self._stored_bytes = sum(st.st_size for _, st in self._scan_objects())
+            if self._stored_bytes <= self.max_bytes:
+                return
+        self.collect_garbage()
+
+    def collect_garbage(self):
+        """Elimina gli snapshot non usati e, se l'archivio supera ancora il limite, le versioni più vecchie."""
+        histories = []
+        try:
+            entries = list(os.scandir(self._history_dir))
+        except FileNotFoundError:
+            entries = []
+        for entry in entries:
+            if not entry.name.endswith(".json"):
+                continue
+            try:
+                with open(entry.path, "r", encoding="utf-8") as f:
+                    histories.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+
+        objects = {os.path.basename(path)[:-len(OBJECT_SUFFIX)]: (path, st) for path, st in self._scan_objects()}
+        total = sum(st.st_size for _, st in objects.values())
+        # Versioni dalla più vecchia: la corrente di ogni file non viene mai eliminata
+        candidates = sorted(
+            ((v["time"], i, j) for i, h in enumerate(histories) for j, v in enumerate(h["versions"]) if j != h["current"]),
+        )
+        evicted = set()
+
+        def unreferenced():
+            used = {v["snapshot"] for i, h in enumerate(histories)
+                    for j, v in enumerate(h["versions"]) if (i, j) not in evicted}
+            now = time.time()
+            return [d for d, (_, st) in objects.items() if d not in used and now - st.st_mtime > GC_GRACE_SECONDS]
+
+        garbage = unreferenced()
+        freed = sum(objects[d][1].st_size for d in garbage)
+        # Se serve, elimina le versioni più vecchie a blocchi finché gli snapshot liberati bastano
+        step = max(1, len(candidates) // 10)
+        while total - freed > self.max_bytes and candidates:
+            for _, i, j in candidates[:step]:
+                evicted.add((i, j))
+            del candidates[:step]
+            garbage = unreferenced()
+            freed = sum(objects[d][1].st_size for d in garbage)
+
+        # Le cronologie da accorciare vengono rilette e riscritte con il lock del loro file:
+        # una modifica in corso su quel file non va persa. Se il lock è occupato la
+        # cronologia resta com'è (e i suoi snapshot restano in archivio)
+        dropped_count = 0
+        for i in sorted({i for i, _ in evicted}):
+            dropped = {(v["snapshot"], v["time"]) for j, v in enumerate(histories[i]["versions"]) if (i, j) in evicted}
+            history, removed = self._drop_versions(histories[i]["path"], dropped)
+            if history is not None:
+                histories[i] = history
+                dropped_count += removed
+        evicted.clear()
+        garbage = unreferenced()
+        freed = sum(objects[d][1].st_size for d in garbage)
+
+        for digest in garbage:
+            try:
+                os.remove(objects[digest][0])
+            except OSError:
+                pass
+        with self._lock:
+            self._stored_bytes = total - freed
+        logging.info("Pulizia snapshot: %s eliminati, %s versioni scartate, %s byte in archivio.",
+                     len(garbage), dropped_count, total - freed)
+
+    def _drop_versions(self, key, dropped):
+        """Toglie dalla cronologia di `key` le versioni (snapshot, ora) in `dropped`, tranne la corrente.
+
+        Restituisce (cronologia aggiornata, versioni tolte), o (None, 0) se il lock del file è occupato.
+        """
+        lock = file_locks.get(key)
+        if not lock.acquire(blocking=False):
+            logging.debug("Cronologia di %s in uso, non la accorcio.", key)
+            return None, 0
+        try:
+            history = self.history(key)
+            versions = history["versions"]
+            current = versions[history["current"]] if history["current"] >= 0 else None
+            kept = [v for v in versions if v is current or (v["snapshot"], v["time"]) not in dropped]
+            if len(kept) < len(versions):
+                history["versions"] = kept
+                history["current"] = kept.index(current) if current is not None else -1
+                self._save_history(history)
+            return history, len(versions) - len(kept)
+        finally:
+            lock.release()
@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Modello compatto dell'outline (segnalibri) di un PDF.
+
+L'albero viene costruito con una sola visita dei dizionari /Outlines del
+documento, senza materializzare le Destination di pypdf, e ogni nodo tiene solo
+titolo, indice di pagina, fit, stato aperto/chiuso e relazioni padre/figli.
+Così anche manuali con decine di migliaia di voci restano leggeri in memoria e
+la gerarchia viene preservata in lettura e in scrittura.
+"""
+
+import logging
+
+from pypdf.generic import ArrayObject, DictionaryObject, Fit, NameObject, NullObject
+
+# Fit predefinito per i nuovi bookmark: pagina intera
+DEFAULT_FIT = ("/Fit", ())
+_UNRESOLVED = float("inf")
+
+
+class OutlineNode:
+    """Voce dell'outline. `page` è l'indice 0-based o None se la destinazione non è risolvibile."""
+
+    __slots__ = ("title", "page", "fit", "parent", "children", "is_open", "color", "flags", "action")
+
+    def __init__(self, title, page=None, fit=DEFAULT_FIT, parent=None, is_open=True, color=None, flags=0, action=None):
+        self.title = title
+        self.page = page
+        self.fit = fit
+        self.parent = parent
+        self.children = None  # lista creata solo quando serve, per risparmiare memoria sulle foglie
+        self.is_open = is_open
+        self.color = color
+        self.flags = flags
+        # (chiave, valore) dell'azione o destinazione originale (/A o /Dest), conservata
+        # solo per le voci che non puntano a una pagina del documento
+        self.action = action
+
+    def __repr__(self):
+        return f"OutlineNode({self.title!r}, page={self.page})"
+
+    @property
+    def sort_key(self):
+        return _UNRESOLVED if self.page is None else self.page
+
+    def child_list(self):
+        if self.children is None:
+            self.children = []
+        return self.children
+
+
+def _number_or_none(value):
+    value = value.get_object() if hasattr(value, "get_object") else value
+    if value is None or isinstance(value, NullObject):
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _fit_from_array(dest):
+    if len(dest) < 2:
+        return DEFAULT_FIT
+    return str(dest[1]), tuple(_number_or_none(arg) for arg in dest[2:])
+
+
+class OutlineTree:
+    """Albero dell'outline con radice fittizia (`root`) e operazioni di modifica."""
+
+    __slots__ = ("root", "_size")
+
+    def __init__(self):
+        self.root = OutlineNode("", parent=None)
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        """Visita in profondità (pre-ordine), nell'ordine in cui le voci compaiono nel PDF."""
+        stack = list(reversed(self.root.children or ()))
+        while stack:
+            node = stack.pop()
+            yield node
+            if node.children:
+                stack.extend(reversed(node.children))
+
+    # --- Costruzione ---
+
+    @classmethod
+    def from_reader(cls, reader, pages):
+        """Costruisce l'albero con una sola visita dei dizionari /Outlines del reader.
+
+        `pages` è il PageIndex del documento, usato per risolvere le destinazioni.
+        """
+        tree = cls()
+        try:
+            catalog = reader.trailer["/Root"]
+            outlines = catalog.get("/Outlines")
+            outlines = outlines.get_object() if outlines is not None else None
+        except Exception as e:
+            logging.warning("Impossibile leggere la radice degli outline: %s", e)
+            return tree
+        if not isinstance(outlines, DictionaryObject) or "/First" not in outlines:
+            return tree
+
+        visited = set()
+        # Pila di (riferimento al prossimo fratello da leggere, nodo genitore)
+        stack = [(outlines.raw_get("/First"), tree.root)]
+        while stack:
+            ref, parent = stack.pop()
+            while ref is not None:
+                key = (ref.idnum, ref.generation) if hasattr(ref, "idnum") else id(ref)
+                if key in visited:
+                    logging.warning("Ciclo nella catena degli outline, interrompo la lettura del livello.")
+                    break
+                visited.add(key)
+                item = ref.get_object()
+                if not isinstance(item, DictionaryObject):
+                    break
+                node = tree._node_from_item(item, pages, parent)
+                parent.child_list().append(node)
+                tree._size += 1
+                if "/First" in item:
+                    # Prima il livello corrente, poi i figli: l'ordine dei fratelli è preservato
+                    stack.append((item.raw_get("/First"), node))
+                ref = item.raw_get("/Next") if "/Next" in item else None
+        return tree
+
+    @staticmethod
+    def _node_from_item(item, pages, parent):
+        title = item.get("/Title", "")
+        title = str(title.get_object()) if hasattr(title, "get_object") else str(title)
+
+        dest = None
+        if "/Dest" in item:
+            dest = item["/Dest"]
+        elif "/A" in item:
+            action = item["/A"]
+            if action.get("/S") == "/GoTo" and "/D" in action:
+                dest = action["/D"]
+        if isinstance(dest, DictionaryObject) and "/D" in dest:
+            dest = dest["/D"]
+
+        page = pages.resolve(dest) if dest is not None else None
+        fit = DEFAULT_FIT
+        action = None
+        if page is not None:
+            if isinstance(dest, ArrayObject):
+                fit = _fit_from_array(dest)
+            elif isinstance(dest, str):
+                named = pages.named_destination(dest)
+                if named is not None:
+                    fit = _fit_from_array(named.dest_array)
+        elif "/A" in item:
+            action = ("/A", item.raw_get("/A"))
+        elif "/Dest" in item:
+            action = ("/Dest", item.raw_get("/Dest"))
+
+        count = item.get("/Count", 0)
+        color = item.get("/C")
+        return OutlineNode(
+            title,
+            page=page,
+            fit=fit,
+            parent=parent,
+            is_open=not (isinstance(count, int) and count < 0),
+            color=tuple(float(c) for c in color) if color is not None else None,
+            flags=int(item.get("/F", 0)),
+            action=action,
+        )
+
+    def copy(self):
+        """Copia profonda dei nodi (le azioni originali restano condivise)."""
+        tree = OutlineTree()
+        stack = [(self.root, tree.root)]
+        while stack:
+            src, dst = stack.pop()
+            if not src.children:
+                continue
+            dst.children = []
+            for child in src.children:
+                new = OutlineNode(child.title, child.page, child.fit, dst, child.is_open, child.color, child.flags, child.action)
+                dst.children.append(new)
+                stack.append((child, new))
+        tree._size = self._size
+        return tree
+
+    # --- Ricerca ---
+
+    def find(self, title):
+        """Primo nodo (in pre-ordine) con il titolo dato, o None."""
+        for node in self:
+            if node.title == title:
+                return node
+        return None
+
+    def nodes_on_page(self, page):
+        return [node for node in self if node.page == page]
+
+    # --- Modifiche ---
+
+    def sort_children(self, parent=None):
+        """Ordina per pagina i figli di `parent` (ordinamento stabile), solo se non sono già in ordine."""
+        parent = parent or self.root
+        children = parent.children
+        if not children:
+            return False
+        if all(children[i].sort_key <= children[i + 1].sort_key for i in range(len(children) - 1)):
+            return False
+        children.sort(key=lambda node: node.sort_key)
+        return True
+
+    def _sorted_position(self, children, key):
+        # Ricerca binaria: a parità di pagina il nuovo nodo va dopo quelli esistenti
+        lo, hi = 0, len(children)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if children[mid].sort_key > key:
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo
+
+    def insert(self, title, page, parent=None, index=None, fit=DEFAULT_FIT):
+        """Inserisce un nuovo nodo sotto `parent` (radice se None).
+
+        Se `index` è None il nodo viene posizionato per pagina con ricerca binaria
+        (i figli devono essere già ordinati, vedi sort_children).
+        """
+        parent = parent or self.root
+        node = OutlineNode(title, page=page, fit=fit, parent=parent)
+        children = parent.child_list()
+        if index is None:
+            index = self._sorted_position(children, node.sort_key)
+        children.insert(index, node)
+        self._size += 1
+        return node
+
+    def append(self, node):
+        """Aggiunge `node` in fondo ai figli del suo genitore (`node.parent`), senza riordinare."""
+        node.parent.child_list().append(node)
+        self._size += 1
+
+    def _detach(self, node):
+        siblings = node.parent.children
+        siblings.remove(node)
+        if not siblings:
+            node.parent.children = None
+
+    def move(self, node, new_parent=None, index=None):
+        """Sposta `node` (con tutto il sottoalbero) sotto `new_parent`, in posizione `index` o per pagina."""
+        new_parent = new_parent or self.root
+        ancestor = new_parent
+        while ancestor is not None:
+            if ancestor is node:
+                raise ValueError("Impossibile spostare un bookmark dentro se stesso o un suo discendente.")
+            ancestor = ancestor.parent
+        self._detach(node)
+        node.parent = new_parent
+        children = new_parent.child_list()
+        if index is None:
+            index = self._sorted_position(children, node.sort_key)
+        children.insert(index, node)
+
+    def rename(self, node, title):
+        node.title = title
+
+    def delete(self, node):
+        """Rimuove `node` e tutti i suoi discendenti."""
+        removed = 1
+        stack = list(node.children or ())
+        while stack:
+            child = stack.pop()
+            removed += 1
+            stack.extend(child.children or ())
+        self._detach(node)
+        node.parent = None
+        self._size -= removed
+
+    # --- Scrittura ---
+
+    def write_to_writer(self, writer):
+        """Aggiunge l'intero albero a un PdfWriter con una sola visita.
+
+        Le voci senza pagina risolvibile mantengono l'azione originale (es. link
+        URI, GoToR o /Dest non risolvibile), copiata nel writer come in
+        incremental_update.outline_objects; senza azione restano senza destinazione.
+        """
+        refs = {id(self.root): None}
+        for node in self:
+            typ, args = node.fit
+            ref = writer.add_outline_item(
+                title=node.title,
+                page_number=node.page,
+                parent=refs[id(node.parent)],
+                color=node.color,
+                bold=bool(node.flags & 2),
+                italic=bool(node.flags & 1),
+                fit=Fit(typ, args),
+                is_open=node.is_open,
+            )
+            if node.page is None and node.action is not None:
+                # I riferimenti dell'azione puntano al file letto: clone li traduce nel writer
+                key, value = node.action
+                ref.get_object()[NameObject(key)] = value.clone(writer)
+            refs[id(node)] = ref
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Indice precalcolato riferimento-di-pagina → numero di pagina.
+
+`PdfReader.get_page_number` esegue una ricerca lineare nella lista delle pagine
+a ogni chiamata: su outline grandi e documenti lunghi il costo diventa
+quadratico. Qui l'albero delle pagine viene percorso una sola volta e ogni
+risoluzione successiva è un accesso a dizionario. Anche le destinazioni con
+nome e quelle remote vengono risolte una volta sola e memorizzate.
+"""
+
+import logging
+
+from pypdf.generic import ArrayObject, DictionaryObject, IndirectObject, NullObject
+
+# Chiave di ordinamento per le destinazioni che non puntano a una pagina del documento
+UNRESOLVED = float("inf")
+
+
+class PageIndex:
+    """Mappa (idnum, generazione) → indice 0-based delle pagine di un reader."""
+
+    __slots__ = ("reader", "by_reference", "num_pages", "_named")
+
+    def __init__(self, reader):
+        self.reader = reader
+        self.by_reference = {}
+        for i, page in enumerate(reader.pages):
+            ref = page.indirect_reference
+            if ref is not None:
+                self.by_reference[(ref.idnum, ref.generation)] = i
+        self.num_pages = len(reader.pages)
+        self._named = None  # nome → Destination, popolato alla prima richiesta
+
+    def page_number(self, page):
+        """Indice di una pagina (PageObject o riferimento indiretto), o None."""
+        ref = page if isinstance(page, IndirectObject) else getattr(page, "indirect_reference", None)
+        if ref is None:
+            return None
+        return self.by_reference.get((ref.idnum, ref.generation))
+
+    def named_destination(self, name):
+        """Destination associata a un nome, o None. Le destinazioni con nome vengono lette una sola volta."""
+        if self._named is None:
+            try:
+                self._named = {str(key): dest for key, dest in self.reader.named_destinations.items()}
+            except Exception as e:
+                logging.warning("Impossibile leggere le destinazioni con nome: %s", e)
+                self._named = {}
+        return self._named.get(str(name))
+
+    def named_page_number(self, name):
+        """Indice della pagina a cui punta una destinazione con nome, o None."""
+        dest = self.named_destination(name)
+        return self.page_number(dest.raw_get("/Page")) if dest is not None else None
+
+    def resolve(self, dest):
+        """Indice di pagina per qualsiasi forma di destinazione, o None se non risolvibile.
+
+        Accetta Destination (come in `reader.outline`), PageObject, riferimenti
+        indiretti, array di destinazione esplicita e nomi. Le destinazioni remote
+        (numero di pagina di un altro file) e quelle vuote non sono risolvibili.
+        """
+        if isinstance(dest, IndirectObject):
+            page_number = self.page_number(dest)
+            if page_number is not None:
+                return page_number
+            dest = dest.get_object()
+        if isinstance(dest, DictionaryObject) and "/Page" in dest:
+            # Destination o dizionario equivalente
+            return self.resolve(dest.raw_get("/Page"))
+        if isinstance(dest, DictionaryObject) and "/D" in dest:
+            return self.resolve(dest["/D"])
+        if isinstance(dest, ArrayObject):
+            return self.resolve(dest[0]) if len(dest) > 0 else None
+        if isinstance(dest, str):
+            return self.named_page_number(dest)
+        if dest is None or isinstance(dest, (NullObject, int)):
+            return None
+        return self.page_number(dest)
+
+    def sort_key(self, dest):
+        """Chiave di ordinamento per pagina; le destinazioni non risolvibili vanno in fondo."""
+        page_number = self.resolve(dest)
+        return UNRESOLVED if page_number is None else page_number
@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Riscrittura completa di un PDF a memoria costante.
+
+Quando il salvataggio incrementale non è possibile (xref danneggiata o con
+indici sfasati) il file va riscritto per intero. Invece di caricare tutte le
+pagine in un PdfWriter, qui gli oggetti invariati (immagini, font, contenuti,
+object stream) vengono copiati byte per byte dal file mappato in memoria verso
+il file di output, senza decodificarli, a blocchi di dimensione fissa. Solo il
+catalogo e l'outline vengono generati; alla fine si scrive una nuova xref
+completa. La memoria usata non dipende dalla dimensione del documento.
+"""
+
+import os
+import re
+import mmap
+import logging
+
+from pypdf.generic import ArrayObject, DictionaryObject, IndirectObject, NameObject, NumberObject, StreamObject
+
+from incremental_update import replacement_objects, subsections, write_object
+
+# Dimensione dei blocchi copiati e del buffer del file di output
+COPY_CHUNK = 1024 * 1024
+
+_HEADER_RE = re.compile(rb"\s*(\d+)\s+(\d+)\s+obj")
+_LENGTH_RE = re.compile(rb"/Length(?![A-Za-z0-9_.])\s*(\d+)(?:\s+(\d+)\s+R)?")
+_SKIP_TYPE_RE = re.compile(rb"/Type\s*/XRef(?![A-Za-z0-9])|/Linearized(?![A-Za-z0-9])")
+_DICT_TOKEN_RE = re.compile(rb"[()<>%]")
+_STRING_TOKEN_RE = re.compile(rb"[()\\]")
+_NEWLINE_RE = re.compile(rb"[\r\n]")
+_WHITESPACE = b" \t\r\n\f\x00"
+
+
+class StreamingSaveUnsupported(Exception):
+    """Il file non può essere riscritto copiando gli oggetti: va usato il salvataggio con PdfWriter."""
+
+
+def source_buffer(reader):
+    """Buffer con i byte del file letto da `reader` (mmap o BytesIO)."""
+    stream = reader.stream
+    if isinstance(stream, mmap.mmap):
+        return stream
+    if hasattr(stream, "getvalue"):
+        return stream.getvalue()
+    raise StreamingSaveUnsupported("sorgente non mappabile")
+
+
+def check_streamable(reader):
+    """Solleva StreamingSaveUnsupported se il file non può essere copiato oggetto per oggetto.
+
+    Va chiamata prima di aprire il file di output, così i casi non supportati
+    passano al PdfWriter senza aver scritto nulla.
+    """
+    if reader.is_encrypted:
+        raise StreamingSaveUnsupported("PDF cifrato")
+    return source_buffer(reader)
+
+
+# --- Scansione degli oggetti ---
+
+def _skip_whitespace(buf, pos, end):
+    while pos < end and buf[pos] in _WHITESPACE:
+        pos += 1
+    return pos
+
+
+def _skip_string(buf, pos, end):
+    """Posizione dopo la stringa letterale che inizia in `pos` (parentesi annidate ed escape)."""
+    depth = 0
+    while True:
+        match = _STRING_TOKEN_RE.search(buf, pos, end)
+        if match is None:
+            raise StreamingSaveUnsupported("stringa non terminata")
+        pos = match.start()
+        token = buf[pos]
+        if token == 0x5C:  # backslash: il carattere successivo è letterale
+            pos += 2
+            continue
+        depth += 1 if token == 0x28 else -1
+        pos += 1
+        if depth == 0:
+            return pos
+
+
+def _skip_dictionary(buf, pos, end):
+    """Posizione dopo il dizionario che inizia in `pos` con '<<'."""
+    depth = 0
+    while True:
+        match = _DICT_TOKEN_RE.search(buf, pos, end)
+        if match is None:
+            raise StreamingSaveUnsupported("dizionario non terminato")
+        pos = match.start()
+        token = buf[pos]
+        if token == 0x28:  # '('
+            pos = _skip_string(buf, pos, end)
+        elif token == 0x25:  # '%': commento fino a fine riga
+            newline = _NEWLINE_RE.search(buf, pos, end)
+            pos = newline.end() if newline else end
+        elif token == 0x3C:  # '<'
+            if pos + 1 < end and buf[pos + 1] == 0x3C:
+                depth += 1
+                pos += 2
+            else:
+                closing = buf.find(b">", pos, end)  # stringa esadecimale
+                if closing < 0:
+                    raise StreamingSaveUnsupported("stringa esadecimale non terminata")
+                pos = closing + 1
+        elif token == 0x3E:  # '>'
+            if pos + 1 < end and buf[pos + 1] == 0x3E:
+                depth -= 1
+                pos += 2
+                if depth == 0:
+                    return pos
+            else:
+                pos += 1
+        else:  # ')' isolata: non valida, ma la si ignora come fanno i lettori tolleranti
+            pos += 1
+
+
+def _resolve_length(reader, match):
+    if match.group(2) is None:
+        return int(match.group(1))
+    value = reader.get_object(IndirectObject(int(match.group(1)), int(match.group(2)), reader))
+    return int(value)
+
+
+def locate_object(reader, buf, offset, idnum, generation):
+    """Estensione (inizio, fine) dell'oggetto `idnum generation obj ... endobj` all'offset dato.
+
+    Restituisce anche i byte del dizionario (o b"" se l'oggetto non è un
+    dizionario), usati per riconoscere gli oggetti da non copiare. I dati degli
+    stream non vengono letti: la fine si ricava da /Length.
+    """
+    end = len(buf)
+    header = _HEADER_RE.match(buf, offset)
+    if header is None or (int(header.group(1)), int(header.group(2))) != (idnum, generation):
+        raise StreamingSaveUnsupported(f"oggetto {idnum} {generation} non trovato all'offset {offset}")
+    start = header.start(1)
+    pos = _skip_whitespace(buf, header.end(), end)
+
+    dictionary = b""
+    if buf[pos:pos + 2] == b"<<":
+        dict_end = _skip_dictionary(buf, pos, end)
+        dictionary = buf[pos:dict_end]
+        pos = _skip_whitespace(buf, dict_end, end)
+        if buf[pos:pos + 6] == b"stream":
+            data_start = pos + 6
+            if buf[data_start:data_start + 1] == b"\r":
+                data_start += 1
+            if buf[data_start:data_start + 1] == b"\n":
+                data_start += 1
+            length = _LENGTH_RE.search(dictionary)
+            pos = data_start + _resolve_length(reader, length) if length else data_start
+            pos = _skip_whitespace(buf, pos, end)
+            if buf[pos:pos + 9] != b"endstream":
+                # /Length errato: si cerca il primo 'endstream' dopo l'inizio dei dati
+                pos = buf.find(b"endstream", data_start, end)
+                if pos < 0:
+                    raise StreamingSaveUnsupported(f"stream dell'oggetto {idnum} non terminato")
+            pos += 9
+
+    endobj = buf.find(b"endobj", pos, end)
+    if endobj < 0:
+        raise StreamingSaveUnsupported(f"oggetto {idnum} senza 'endobj'")
+    return start, endobj + 6, dictionary
+
+
+def old_outline_ids(reader):
+    """Numeri di oggetto del vecchio albero /Outlines, che nel file riscritto non servono più."""
+    ids = set()
+    try:
+        ref = reader.trailer["/Root"].raw_get("/Outlines")
+    except (KeyError, AttributeError):
+        return ids
+    stack = [ref]
+    while stack:
+        ref = stack.pop()
+        if not isinstance(ref, IndirectObject) or ref.idnum in ids:
+            continue
+        ids.add(ref.idnum)
+        item = ref.get_object()
+        if isinstance(item, DictionaryObject):
+            for key in ("/First", "/Next"):
+                if key in item:
+                    stack.append(item.raw_get(key))
+    return ids
+
+
+# --- Scrittura ---
+
+class _OutputFile:
+    """File di output bufferizzato che tiene traccia della posizione corrente."""
+
+    def __init__(self, f):
+        self._f = f
+        self.position = 0
+
+    def write(self, data):
+        self._f.write(data)
+        self.position += len(data)
+
+    def copy(self, buf, start, end):
+        for chunk_start in range(start, end, COPY_CHUNK):
+            self.write(buf[chunk_start:min(chunk_start + COPY_CHUNK, end)])
+
+
+def _trailer_entries(reader, size, root_ref):
+    entries = {NameObject("/Size"): NumberObject(size), NameObject("/Root"): root_ref}
+    for key in ("/Info", "/ID"):
+        if key in reader.trailer:
+            entries[NameObject(key)] = reader.trailer.raw_get(key)
+    return entries
+
+
+def write_rewritten(reader, tree, f, progress):
+    """Scrive in `f` il PDF completo con l'outline di `tree`, copiando gli oggetti invariati.
+
+    `progress(**info)` riceve i byte copiati. Solleva StreamingSaveUnsupported se
+    il file non si presta alla copia diretta (es. cifrato o con oggetti non localizzabili).
+    """
+    buf = check_streamable(reader)
+    out = _OutputFile(f)
+
+    catalog_ref = reader.trailer.raw_get("/Root")
+    skipped = old_outline_ids(reader)
+    skipped.add(catalog_ref.idnum)
+
+    # Oggetti in uso: (numero, generazione, offset) per quelli scritti direttamente nel file
+    direct = []
+    for generation, entries in reader.xref.items():
+        if generation == 65535:
+            continue
+        free = reader.xref_free_entry.get(generation, {})
+        for idnum, offset in entries.items():
+            if idnum and idnum not in skipped and not free.get(idnum, False):
+                direct.append((offset, idnum, generation))
+    direct.sort()
+    compressed = {idnum: location for idnum, location in reader.xref_objStm.items() if idnum not in skipped}
+
+    highest = max([idnum for _, idnum, _ in direct] + list(compressed) + [int(reader.trailer.get("/Size", 0)) - 1])
+    _, catalog, objects, next_free = replacement_objects(reader, tree, first_id=highest + 1)
+
+    out.write(reader.pdf_header.encode("latin-1") + b"\n%\xe2\xe3\xcf\xd3\n")
+    xref = {}  # numero → (tipo, campo 2, campo 3) come in uno stream xref
+    total_bytes = len(buf)
+    for offset, idnum, generation in direct:
+        start, end, dictionary = locate_object(reader, buf, offset, idnum, generation)
+        if _SKIP_TYPE_RE.search(dictionary):
+            # Vecchie xref in forma di stream e dizionari di linearizzazione non sono più validi
+            continue
+        xref[idnum] = (1, out.position, generation)
+        out.copy(buf, start, end)
+        out.write(b"\n")
+        progress(stage="copying", bytes_copied=out.position, total_bytes=total_bytes)
+    for idnum, (stream_id, index) in compressed.items():
+        xref[idnum] = (2, stream_id, index)
+
+    # Nuovo catalogo (stesso numero dell'originale) e nuovo outline
+    xref[catalog_ref.idnum] = (1, out.position, catalog_ref.generation)
+    write_object(out, catalog_ref.idnum, catalog_ref.generation, catalog)
+    for idnum, obj in objects:
+        xref[idnum] = (1, out.position, 0)
+        write_object(out, idnum, 0, obj)
+
+    root_ref = IndirectObject(catalog_ref.idnum, catalog_ref.generation, None)
+    if compressed:
+        _write_xref_stream(out, reader, xref, next_free, root_ref)
+    else:
+        _write_xref_table(out, reader, xref, next_free, root_ref)
+    return out.position
+
+
+def _write_xref_table(out, reader, xref, size, root_ref):
+    xref_offset = out.position
+    lines = [f"xref\n0 {size}\n".encode("ascii"), b"0000000000 65535 f\r\n"]
+    for idnum in range(1, size):
+        entry = xref.get(idnum)
+        if entry is None:
+            lines.append(b"0000000000 65535 f\r\n")
+        else:
+            lines.append(f"{entry[1]:010d} {entry[2]:05d} n\r\n".encode("ascii"))
+        if len(lines) >= 4096:
+            out.write(b"".join(lines))
+            lines = []
+    lines.append(b"trailer\n")
+    out.write(b"".join(lines))
+    DictionaryObject(_trailer_entries(reader, size, root_ref)).write_to_stream(out)
+    out.write(f"\nstartxref\n{xref_offset}\n%%EOF\n".encode("ascii"))
+
+
+def _write_xref_stream(out, reader, xref, size, root_ref):
+    xref_id = size
+    xref_offset = out.position
+    xref[xref_id] = (1, xref_offset, 0)
+    numbers = sorted(xref)
+    width2 = max(4, (max(entry[1] for entry in xref.values()).bit_length() + 7) // 8)
+    width3 = max(2, (max(entry[2] for entry in xref.values()).bit_length() + 7) // 8)
+    data = b"".join(
+        bytes([xref[n][0]]) + xref[n][1].to_bytes(width2, "big") + xref[n][2].to_bytes(width3, "big")
+        for n in numbers
+    )
+    stream = StreamObject()
+    stream.update(_trailer_entries(reader, xref_id + 1, root_ref))
+    stream[NameObject("/Type")] = NameObject("/XRef")
+    stream[NameObject("/W")] = ArrayObject([NumberObject(1), NumberObject(width2), NumberObject(width3)])
+    stream[NameObject("/Index")] = ArrayObject([NumberObject(v) for group in subsections(numbers) for v in group])
+    stream.set_data(data)
+    write_object(out, xref_id, 0, stream)
+    out.write(f"startxref\n{xref_offset}\n%%EOF\n".encode("ascii"))
+
+
+def fsync_directory(path):
+    """Rende persistente la rinomina di `path` (solo dove le directory si possono aprire)."""
+    if os.name == "nt":
+        return
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError as e:
+        logging.debug("Impossibile aprire la directory per fsync: %s", e)
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Test dell'accorpamento delle modifiche (coalescing): journal, recupero e fallimenti.
+
+    python -m unittest test_coalescing      (dalla cartella native_app)
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import native_app
+from benchmark import generate_pdf
+from coalescing import EditCoalescer, journal_path, read_journal
+from outline_index import OutlineIndex
+from outline_snapshots import OutlineSnapshots
+from test_pdf_saving import outline_of, reparse
+
+
+class FakeEdits:
+    """apply_edits registrato: restituisce (o solleva) gli esiti preparati, poi il successo."""
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = []
+
+    def __call__(self, path, entries):
+        self.calls.append(list(entries))
+        outcome = self.outcomes.pop(0) if self.outcomes else None
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome or (True, path, [None] * len(entries))
+
+
+class CoalescerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix="native_app_coalesce_")
+        self.registry = os.path.join(self.work_dir, "data", "pending_journals.txt")
+        self.pdf = os.path.join(self.work_dir, "doc.pdf")
+        with open(self.pdf, "wb") as f:
+            f.write(b"%PDF-1.7\n")
+        self.coalescers = []
+
+    def tearDown(self):
+        for coalescer in self.coalescers:
+            coalescer.shutdown()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def coalescer(self, apply_edits, idle_seconds=60, is_applied=None):
+        notified = []
+        flushed = threading.Event()
+
+        def notify(outcome):
+            notified.append(outcome)
+            flushed.set()
+
+        coalescer = EditCoalescer(apply_edits, self.registry, idle_seconds=idle_seconds,
+                                  notify=notify, is_applied=is_applied)
+        coalescer.notified, coalescer.flushed = notified, flushed
+        self.coalescers.append(coalescer)
+        return coalescer
+
+    def write_journal(self, lines):
+        with open(journal_path(self.pdf), "w", encoding="utf-8") as f:
+            for line in lines:
+                f.write(json.dumps(line) + "\n")
+        os.makedirs(os.path.dirname(self.registry), exist_ok=True)
+        with open(self.registry, "w", encoding="utf-8") as f:
+            f.write(self.pdf + "\n")
+
+    def assert_journal_gone(self):
+        self.assertFalse(os.path.exists(journal_path(self.pdf)))
+        with open(self.registry, encoding="utf-8") as f:
+            self.assertNotIn(self.pdf, f.read())
+
+    def test_flush_applies_batch_and_removes_journal(self):
+        edits = FakeEdits()
+        coalescer = self.coalescer(edits)
+        coalescer.add(self.pdf, [("A", 0, None)])
+        self.assertEqual(coalescer.add(self.pdf, [("B", 1, "A")]), 2)
+        self.assertEqual(read_journal(journal_path(self.pdf)), ([("A", 0, None), ("B", 1, "A")], None))
+        outcomes = coalescer.flush(self.pdf)
+        self.assertEqual(edits.calls, [[("A", 0, None), ("B", 1, "A")]])
+        self.assertEqual([o["status"] for o in outcomes], ["success"])
+        self.assert_journal_gone()
+
+    def test_recover_applies_orphaned_journal(self):
+        self.write_journal([{"title": "A", "page": 0, "parent": None}, {"title": "B", "page": 1, "parent": None}])
+        edits = FakeEdits()
+        coalescer = self.coalescer(edits)
+        self.assertEqual(coalescer.recover(), 2)
+        coalescer.flush()
+        self.assertEqual(edits.calls, [[("A", 0, None), ("B", 1, None)]])
+        self.assert_journal_gone()
+
+    def test_recover_skips_batch_already_written(self):
+        # Crash dopo la scrittura del PDF e prima della pulizia del journal
+        st = os.stat(self.pdf)
+        self.write_journal([
+            {"title": "A", "page": 0, "parent": None},
+            {"applying": {"entries": 1, "size": st.st_size, "mtime_ns": st.st_mtime_ns}},
+            {"title": "B", "page": 1, "parent": None},
+        ])
+        with open(self.pdf, "ab") as f:
+            f.write(b"% aggiornamento\n")
+        edits = FakeEdits()
+        coalescer = self.coalescer(edits, is_applied=lambda path, entries: entries == [("A", 0, None)])
+        self.assertEqual(coalescer.recover(), 1)
+        coalescer.flush()
+        self.assertEqual(edits.calls, [[("B", 1, None)]])
+
+    def test_recover_reapplies_when_file_unchanged(self):
+        # Crash prima della scrittura: il file è quello annotato, la modifica va applicata
+        st = os.stat(self.pdf)
+        self.write_journal([
+            {"title": "A", "page": 0, "parent": None},
+            {"applying": {"entries": 1, "size": st.st_size, "mtime_ns": st.st_mtime_ns}},
+        ])
+        edits = FakeEdits()
+        coalescer = self.coalescer(edits, is_applied=lambda path, entries: True)
+        self.assertEqual(coalescer.recover(), 1)
+        coalescer.flush()
+        self.assertEqual(edits.calls, [[("A", 0, None)]])
+
+    def test_recover_leaves_journal_of_active_host(self):
+        owner = self.coalescer(FakeEdits())
+        owner.add(self.pdf, [("A", 0, None)])
+        other = self.coalescer(FakeEdits())
+        self.assertEqual(other.recover(), 0)
+        self.assertEqual(other.flush(), [])
+        self.assertEqual(read_journal(journal_path(self.pdf))[0], [("A", 0, None)])
+
+    def test_rejected_entries_are_dropped(self):
+        # Errore definitivo (es. genitore inesistente): riprovare darebbe lo stesso esito
+        edits = FakeEdits((False, "Nessun bookmark valido da aggiungere.", ["Bookmark genitore 'X' non trovato."]))
+        coalescer = self.coalescer(edits)
+        coalescer.add(self.pdf, [("A", 0, "X")])
+        outcome, = coalescer.flush(self.pdf)
+        self.assertEqual(outcome["status"], "error")
+        self.assertEqual(outcome["errors"], ["Bookmark genitore 'X' non trovato."])
+        self.assert_journal_gone()
+        self.assertEqual(coalescer.pending(self.pdf), [])
+        self.assertEqual(coalescer.flush(), [])
+        self.assertEqual(len(edits.calls), 1)
+
+    def test_transient_error_is_retried(self):
+        edits = FakeEdits(PermissionError("file in uso"))
+        coalescer = self.coalescer(edits, idle_seconds=0.05)
+        coalescer.add(self.pdf, [("A", 0, None)])
+        outcome, = coalescer.flush(self.pdf)
+        self.assertEqual(outcome["status"], "error")
+        # Le entry restano in sospeso, senza le annotazioni del tentativo fallito
+        self.assertEqual(coalescer.pending(self.pdf), [("A", 0, None)])
+        self.assertEqual(read_journal(journal_path(self.pdf)), ([("A", 0, None)], None))
+        # Il nuovo tentativo parte da solo
+        coalescer.flushed.clear()
+        self.assertTrue(coalescer.flushed.wait(5))
+        self.assertEqual(coalescer.notified[-1]["status"], "success")
+        self.assertEqual(edits.calls, [[("A", 0, None)], [("A", 0, None)]])
+        self.assert_journal_gone()
+
+
+class CoalesceEditTest(unittest.TestCase):
+    """Validazione delle modifiche accorpate e salvataggio reale (native_app)."""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix="native_app_coalesce_")
+        self._saved = native_app.outline_index, native_app.outline_snapshots, native_app.coalescer
+        native_app.outline_index = OutlineIndex(os.path.join(self.work_dir, "index"), native_app.document_cache.get)
+        native_app.outline_snapshots = OutlineSnapshots(os.path.join(self.work_dir, "snapshots"))
+        native_app.coalescer = EditCoalescer(
+            native_app.apply_coalesced_edits,
+            os.path.join(self.work_dir, "pending_journals.txt"),
+            idle_seconds=60,
+            is_applied=native_app.outline_contains,
+        )
+        self.pdf = os.path.join(self.work_dir, "doc.pdf")
+        generate_pdf(self.pdf, 8, outline_nodes=2, shape="flat", page_bytes=128)
+        native_app.document_cache.clear()
+
+    def tearDown(self):
+        native_app.coalescer.shutdown()
+        native_app.outline_index, native_app.outline_snapshots, native_app.coalescer = self._saved
+        native_app.document_cache.clear()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def coalesce(self, bookmarks):
+        return native_app.coalesce_edit({"file_directory": self.pdf, "action": "add_bookmarks", "params": {"bookmarks": bookmarks}})
+
+    def test_unknown_parent_is_rejected_before_queueing(self):
+        response = self.coalesce([{"bookmark_name": "Orfano", "page": 2, "parent": "Inesistente"}])
+        self.assertEqual(response["status"], "error")
+        self.assertIn("Inesistente", response["message"])
+        self.assertEqual(native_app.coalescer.pending(self.pdf), [])
+        self.assertFalse(os.path.exists(journal_path(self.pdf)))
+
+    def test_parents_from_outline_journal_and_request(self):
+        self.assertEqual(self.coalesce([{"bookmark_name": "Capitolo", "page": 3}])["status"], "success")
+        response = self.coalesce([
+            {"bookmark_name": "Sezione", "page": 4, "parent": "Capitolo"},
+            {"bookmark_name": "Paragrafo", "page": 5, "parent": "Sezione"},
+            {"bookmark_name": "Figlio", "page": 2, "parent": "Voce 1"},
+            {"bookmark_name": "Orfano", "page": 2, "parent": "Nessuno"},
+        ])
+        self.assertEqual([r["status"] for r in response["results"]], ["queued", "queued", "queued", "error"])
+        outcome, = native_app.coalescer.flush(self.pdf)
+        self.assertEqual((outcome["status"], outcome["applied"], outcome["failed"]), ("success", 4, 0))
+        outline = outline_of(reparse(self.pdf))
+        for entry in (("Capitolo", 2, 0), ("Sezione", 3, 1), ("Paragrafo", 4, 2), ("Figlio", 1, 1)):
+            self.assertIn(entry, outline)
+        self.assertFalse(os.path.exists(journal_path(self.pdf)))
+
+    def test_parent_with_page_among_repeated_titles(self):
+        response = self.coalesce([
+            {"bookmark_name": "Introduzione", "page": 3},
+            {"bookmark_name": "Introduzione", "page": 6},
+            {"bookmark_name": "Scopo", "page": 7, "parent": "Introduzione", "parent_page": 6},
+            {"bookmark_name": "Altro", "page": 7, "parent": "Introduzione", "parent_page": 5},
+        ])
+        self.assertEqual([r["status"] for r in response["results"]], ["queued", "queued", "queued", "error"])
+        self.assertIn("pagina 5", response["results"][3]["message"])
+        # Il genitore con la pagina sopravvive al journal
+        self.assertIn(("Scopo", 6, ("Introduzione", 5)), read_journal(journal_path(self.pdf))[0])
+        outcome, = native_app.coalescer.flush(self.pdf)
+        self.assertEqual(outcome["status"], "success")
+        outline = outline_of(reparse(self.pdf))
+        self.assertIn(("Scopo", 6, 1), outline)
+        self.assertEqual(outline[outline.index(("Scopo", 6, 1)) - 1], ("Introduzione", 5, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
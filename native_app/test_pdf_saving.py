@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Test di regressione della serializzazione dei PDF (incremental_update e streaming_save).
+
+Ogni risultato viene riletto con PdfReader(strict=True) risolvendo tutti gli
+oggetti, su sorgenti con tabella xref classica e con xref stream e object
+stream, per il salvataggio incrementale e per la riscrittura completa.
+
+    python -m unittest test_pdf_saving      (dalla cartella native_app)
+"""
+
+import io
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+from pypdf import PdfReader, PdfWriter
+from pypdf.generic import ArrayObject, DictionaryObject, NameObject, NumberObject, StreamObject, TextStringObject
+
+import heading_detection
+import native_app
+import streaming_save
+from benchmark import generate_pdf
+from outline_index import OutlineIndex
+from outline_snapshots import OutlineSnapshots
+
+PAGES = 12
+
+
+def to_object_streams(source, destination):
+    """Riscrive `source` con tutti gli oggetti non stream in un object stream e una xref stream."""
+    reader = PdfReader(source)
+    size = int(reader.trailer["/Size"])
+    direct, compressed = {}, {}
+    for idnum in range(1, size):
+        obj = reader.get_object(idnum)
+        if obj is None:
+            continue
+        buf = io.BytesIO()
+        obj.write_to_stream(buf)
+        (direct if isinstance(obj, StreamObject) else compressed)[idnum] = buf.getvalue()
+
+    out = io.BytesIO()
+    out.write(b"%PDF-1.7\n%\xe2\xe3\xcf\xd3\n")
+    xref = {}
+    for idnum, data in direct.items():
+        xref[idnum] = (1, out.tell(), 0)
+        out.write(b"%d 0 obj\n%s\nendobj\n" % (idnum, data))
+
+    objstm_id, xref_id = size, size + 1
+    header, body = [], b""
+    for index, (idnum, data) in enumerate(compressed.items()):
+        header.append(b"%d %d" % (idnum, len(body)))
+        body += data + b"\n"
+        xref[idnum] = (2, objstm_id, index)
+    header = b" ".join(header) + b"\n"
+    xref[objstm_id] = (1, out.tell(), 0)
+    out.write(b"%d 0 obj\n<< /Type /ObjStm /N %d /First %d /Length %d >>\nstream\n%s%s\nendstream\nendobj\n"
+              % (objstm_id, len(compressed), len(header), len(header) + len(body), header, body))
+
+    xref[xref_id] = (1, out.tell(), 0)
+    rows = b"".join(struct.pack(">BIH", *xref.get(i, (0, 0, 65535 if i == 0 else 0))) for i in range(xref_id + 1))
+    root = reader.trailer.raw_get("/Root")
+    out.write(b"%d 0 obj\n<< /Type /XRef /Size %d /W [1 4 2] /Root %d %d R /Length %d >>\nstream\n%s\nendstream\nendobj\n"
+              % (xref_id, xref_id + 1, root.idnum, root.generation, len(rows), rows))
+    out.write(b"startxref\n%d\n%%%%EOF\n" % xref[xref_id][1])
+    with open(destination, "wb") as f:
+        f.write(out.getvalue())
+
+
+def reparse(path):
+    """Rilegge il file in modo rigoroso, risolvendo ogni oggetto della xref."""
+    reader = PdfReader(path, strict=True)
+    for generation, entries in reader.xref.items():
+        for idnum in entries:
+            if idnum:
+                reader.get_object(idnum)
+    for idnum in reader.xref_objStm:
+        reader.get_object(idnum)
+    return reader
+
+
+def outline_of(reader, items=None, level=0):
+    """Outline come lista di (titolo, pagina 0-based, livello), in ordine di documento."""
+    result = []
+    for item in reader.outline if items is None else items:
+        if isinstance(item, list):
+            result.extend(outline_of(reader, item, level + 1))
+        else:
+            result.append((item.title, reader.get_destination_page_number(item), level))
+    return result
+
+
+def outline_items(reader):
+    """Dizionari delle voci dell'outline per titolo, a qualsiasi livello."""
+    items = {}
+    stack = [reader.trailer["/Root"]["/Outlines"].get("/First")]
+    while stack:
+        item = stack.pop()
+        if item is None:
+            continue
+        item = item.get_object()
+        items[str(item["/Title"])] = item
+        stack.extend((item.get("/Next"), item.get("/First")))
+    return items
+
+
+class PdfSavingTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        # Indici e versioni dell'outline non devono finire nella directory dell'utente
+        cls.data_dir = tempfile.mkdtemp(prefix="native_app_data_")
+        cls._saved = native_app.outline_index, native_app.outline_snapshots
+        native_app.outline_index = OutlineIndex(os.path.join(cls.data_dir, "index"), native_app.document_cache.get)
+        native_app.outline_snapshots = OutlineSnapshots(os.path.join(cls.data_dir, "snapshots"))
+
+    @classmethod
+    def tearDownClass(cls):
+        native_app.outline_index, native_app.outline_snapshots = cls._saved
+        shutil.rmtree(cls.data_dir, ignore_errors=True)
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix="native_app_save_")
+        native_app.document_cache.clear()
+
+    def tearDown(self):
+        native_app.document_cache.clear()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def make_source(self, kind, name="source.pdf"):
+        """PDF con outline annidato (3 livelli), con tabella xref ("table") o object stream ("objstm")."""
+        path = os.path.join(self.work_dir, name)
+        generate_pdf(path, PAGES, outline_nodes=6, shape="nested", page_bytes=256)
+        if kind == "objstm":
+            table_path = path + ".table.pdf"
+            os.replace(path, table_path)
+            to_object_streams(table_path, path)
+            os.remove(table_path)
+            self.assertTrue(PdfReader(path).xref_objStm, "la sorgente deve avere oggetti in un object stream")
+        return path
+
+    def add(self, path, entries, incremental):
+        success, result, errors = native_app.add_bookmarks_to_pdf(path, entries, incremental=incremental)
+        self.assertTrue(success, result)
+        self.assertEqual(errors, [None] * len(entries))
+        return result
+
+    def check_saved(self, path, original):
+        reader = reparse(path)
+        self.assertEqual(len(reader.pages), PAGES)
+        outline = outline_of(reader)
+        # L'outline originale (annidato) è preservato, i nuovi bookmark sono al loro livello
+        for entry in original:
+            self.assertIn(entry, outline)
+        self.assertIn(("Nuovo", 10, 0), outline)
+        self.assertIn(("Figlio", 5, 1), outline)
+        return reader
+
+    def run_case(self, kind, incremental, name="source.pdf"):
+        path = self.make_source(kind, name)
+        original = outline_of(reparse(path))
+        self.assertIn(1, [level for _, _, level in original])
+        with open(path, "rb") as f:
+            original_bytes = f.read()
+        self.assertEqual(self.add(path, [("Nuovo", 10, None), ("Figlio", 5, "Voce 1")], incremental), path)
+        self.check_saved(path, original)
+        with open(path, "rb") as f:
+            saved = f.read()
+        # Il salvataggio incrementale accoda soltanto; la riscrittura produce un file nuovo
+        self.assertEqual(saved.startswith(original_bytes), incremental)
+        # Un secondo salvataggio sul risultato (catena /Prev o file riscritto) resta valido
+        self.add(path, [("Ultimo", 11, None)], incremental)
+        self.assertIn(("Ultimo", 11, 0), outline_of(self.check_saved(path, original)))
+        self.assertEqual(os.listdir(self.work_dir), [name])
+
+    def test_incremental_table_xref(self):
+        self.run_case("table", incremental=True)
+
+    def test_incremental_xref_stream(self):
+        self.run_case("objstm", incremental=True)
+
+    def test_rewrite_table_xref(self):
+        self.run_case("table", incremental=False)
+
+    def test_rewrite_xref_stream(self):
+        self.run_case("objstm", incremental=False)
+
+    def test_rewrite_uppercase_extension(self):
+        # Il file temporaneo non deve coincidere con l'originale (".PDF" non contiene ".pdf")
+        self.run_case("table", incremental=False, name="SCAN.PDF")
+
+    def test_stale_startxref_is_repaired(self):
+        # startxref oltre la fine del file: pypdf ripara la xref, ma non su una mappa
+        path = self.make_source("table")
+        with open(path, "rb") as f:
+            data = f.read()
+        position = data.rindex(b"startxref")
+        with open(path, "wb") as f:
+            f.write(data[:position] + b"startxref\n%d\n%%%%EOF\n" % (len(data) + 5000))
+        for incremental in (True, False):
+            with self.subTest(incremental=incremental):
+                self.assertEqual(self.add(path, [(f"Riparato {incremental}", 2, None)], incremental), path)
+                reader = reparse(path)
+                self.assertEqual(len(reader.pages), PAGES)
+                self.assertIn((f"Riparato {incremental}", 2, 0), outline_of(reader))
+
+    def test_cached_document_does_not_keep_file_open(self):
+        path = self.make_source("table")
+        doc = native_app.document_cache.get(path)
+        self.assertIsNone(doc.mapped)
+        with native_app.document_cache.open(path) as same:
+            self.assertIs(same, doc)
+            self.assertIsNotNone(doc.mapped)
+            self.assertTrue(doc.reader.pages[3].get_contents().get_data())
+        self.assertIsNone(doc.mapped)
+        self.add(path, [("Nuovo", 10, None)], incremental=True)
+        self.assertIsNone(doc.mapped)
+
+    def test_save_does_not_close_a_reader_in_use(self):
+        # Una lettura in corso (es. suggest_outline) sullo stesso file mentre un salvataggio lo riscrive
+        path = self.make_source("table")
+        with native_app.document_cache.open(path) as doc:
+            self.add(path, [("Nuovo", 10, None)], incremental=False)
+            self.assertIsNotNone(doc.reader.pages[3].get_contents().get_data())
+            # Il documento è uscito dalla cache: chi arriva dopo rilegge il file salvato
+            self.assertIsNot(native_app.document_cache.get(path), doc)
+        self.assertIsNone(doc.mapped)
+        self.assertIn(("Nuovo", 10, 0), outline_of(reparse(path)))
+
+    def test_pdfwriter_keeps_original_actions(self):
+        # Riscrittura con PdfWriter (es. file cifrati): le voci senza pagina risolvibile mantengono la loro azione
+        source = self.make_source("table", "plain.pdf")
+        writer = PdfWriter(clone_from=source)
+        actions = {
+            "Sito": ("/A", DictionaryObject({NameObject("/S"): NameObject("/URI"),
+                                              NameObject("/URI"): TextStringObject("https://example.org/")})),
+            "Altro file": ("/A", DictionaryObject({NameObject("/S"): NameObject("/GoToR"),
+                                                    NameObject("/F"): TextStringObject("altro.pdf"),
+                                                    NameObject("/D"): ArrayObject([NumberObject(0), NameObject("/Fit")])})),
+            "Nome mancante": ("/Dest", TextStringObject("inesistente")),
+        }
+        for title, (key, value) in actions.items():
+            writer.add_outline_item(title, None).get_object()[NameObject(key)] = value
+        path = os.path.join(self.work_dir, "actions.pdf")
+        with open(path, "wb") as f:
+            writer.write(f)
+
+        target = os.path.join(self.work_dir, "actions_out.pdf")
+        with native_app.document_cache.open(path) as doc:
+            tree = doc.outline_copy()
+            tree.insert("Nuovo", 10)
+            native_app._write_with_pdfwriter(doc, tree, target, native_app._no_progress)
+        reader = reparse(target)
+        items = outline_items(reader)
+        self.assertEqual(items["Sito"]["/A"]["/URI"], "https://example.org/")
+        self.assertEqual(items["Altro file"]["/A"]["/S"], "/GoToR")
+        self.assertEqual(items["Altro file"]["/A"]["/F"], "altro.pdf")
+        self.assertEqual(items["Nome mancante"]["/Dest"], "inesistente")
+        self.assertIn(("Nuovo", 10, 0), outline_of(reader))
+
+    def test_suggested_headings_with_repeated_titles(self):
+        # Ogni capitolo ha la sua "Introduzione": le sottosezioni vanno sotto quella giusta
+        lines = [("Capitolo 1", 20), ("Introduzione", 16), ("Scopo", 14),
+                 ("Capitolo 2", 20), ("Introduzione", 16), ("Scopo", 14)]
+        pages = [{"sizes": {"10": 2000, str(size): len(text)}, "lines": [[text, size, False, 0.1]]} for text, size in lines]
+        candidates = heading_detection.rank_headings(pages)
+        self.assertEqual([(c["parent"], c["parent_page"]) for c in candidates],
+                         [(None, None), ("Capitolo 1", 1), ("Introduzione", 2),
+                          (None, None), ("Capitolo 2", 4), ("Introduzione", 5)])
+
+        path = os.path.join(self.work_dir, "headings.pdf")
+        generate_pdf(path, len(lines), page_bytes=128)
+        entries, _, results = native_app.parse_bookmark_entries(candidates)
+        self.assertEqual(results, [None] * len(lines))
+        success, _, errors = native_app.add_bookmarks_to_pdf(path, entries)
+        self.assertTrue(success)
+        self.assertEqual(errors, [None] * len(lines))
+        self.assertEqual(outline_of(reparse(path)), [
+            ("Capitolo 1", 0, 0), ("Introduzione", 1, 1), ("Scopo", 2, 2),
+            ("Capitolo 2", 3, 0), ("Introduzione", 4, 1), ("Scopo", 5, 2),
+        ])
+
+    def test_streaming_rewrite_copies_objects(self):
+        for kind in ("table", "objstm"):
+            with self.subTest(kind=kind):
+                path = self.make_source(kind, f"{kind}.pdf")
+                with native_app.document_cache.open(path) as doc:
+                    tree = doc.outline_copy()
+                    tree.insert("Nuovo", 10)
+                    target = os.path.join(self.work_dir, f"{kind}_out.pdf")
+                    with open(target, "wb") as f:
+                        streaming_save.write_rewritten(doc.reader, tree, f, native_app._no_progress)
+                    source_page = doc.reader.pages[3].get_contents().get_data()
+                reader = reparse(target)
+                self.assertEqual(outline_of(reader), outline_of(reparse(path)) + [("Nuovo", 10, 0)])
+                self.assertEqual(reader.pages[3].get_contents().get_data(), source_page)
+
+
+if __name__ == "__main__":
+    unittest.main()